@@ -36,9 +36,9 @@ import gzip
 import os
 import shutil
 import tempfile
+import urllib.request
 
 import numpy as np
-from six.moves import urllib
 import tensorflow.compat.v1 as tf
 
 
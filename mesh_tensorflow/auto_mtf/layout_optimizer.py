@@ -37,7 +37,6 @@ import itertools
 from absl import logging
 from mesh_tensorflow.auto_mtf import print_cp_model_solution
 from mesh_tensorflow.auto_mtf import scheduler
-import six
 from ortools.sat.python import cp_model
 
 
@@ -269,8 +268,7 @@ class LayoutOptimizer(object):
     """Builds the objective function of the IP."""
     # Break ties in favor of more assignments.
     scale = len(self._layout_validator.splittable_mtf_dimension_names) + 1
-    objective = scale * self._memory_var - sum(six.itervalues(
-        self._global_vars))
+    objective = scale * self._memory_var - sum(self._global_vars.values())
     self._model.Minimize(objective)
 
   def _get_memory_contents(self):
@@ -421,7 +419,7 @@ def _generate_assignments(splittable_dimensions, mesh_dimension_to_size):
         splittable dimension, whose value is either a mesh dimension or None.
   """
   assignments = []
-  for assignment_size in six.moves.xrange(
+  for assignment_size in range(
       1 + min(len(splittable_dimensions), len(mesh_dimension_to_size))):
     for s_dims_chosen in itertools.combinations(splittable_dimensions,
                                                 assignment_size):
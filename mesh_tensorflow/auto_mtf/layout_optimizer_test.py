@@ -22,7 +22,6 @@ from __future__ import print_function
 import mesh_tensorflow as mtf
 from mesh_tensorflow.auto_mtf import layout_optimizer
 from mesh_tensorflow.auto_mtf import memory_estimator
-import six
 import tensorflow.compat.v1 as tf
 
 
@@ -98,7 +97,7 @@ class OptimizeLayoutTest(tf.test.TestCase):
   def testOptimizeLayoutRepetition(self):
     x1 = mtf.zeros(self.mesh, "a:10,b:5")
     x2 = mtf.zeros(self.mesh, "b:5,c:20")
-    for _ in six.moves.xrange(100):
+    for _ in range(100):
       mtf.einsum([x1, x2], "a:10,c:20")
     optimizer = self.get_layout_optimizer()
 
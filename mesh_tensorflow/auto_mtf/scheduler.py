@@ -29,7 +29,6 @@ from __future__ import print_function
 
 import collections
 import heapq
-import six
 
 
 def minimize_peak_memory(graph, scheduler_alg):
@@ -61,7 +60,7 @@ def _minimize_peak_memory_naive(graph):
   Returns:
     an iterable of integers representing the schedule.
   """
-  return six.moves.range(graph.get_num_operations())
+  return range(graph.get_num_operations())
 
 
 def _minimize_peak_memory_list(graph):
@@ -19,16 +19,130 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import functools
+
 from mesh_tensorflow import ops_with_redefined_builtins as mtf
 
 import tensorflow.compat.v1 as tf
 
 
+# If True, the elementwise tails of dense(), layer_norm(), batch_norm() and
+# sigmoid_cross_entropy_with_logits() are built inside an XLA jit scope so
+# that they compile to a single fused kernel.  Off by default, since XLA
+# auto-clustering regresses performance on some backends.
+_USE_XLA = False
+
+
+def _maybe_xla_compile(tf_fn):
+  """Wraps tf_fn so that the ops it creates get clustered by XLA."""
+  if not _USE_XLA:
+    return tf_fn
+  def my_fn(*args):
+    with tf.xla.experimental.jit_scope():
+      return tf_fn(*args)
+  return my_fn
+
+
+def _affine(x, a, b):
+  """Computes x * a + b as a single operation.
+
+  Args:
+    x: a mtf.Tensor
+    a: a mtf.Tensor whose shape is a subset of x.shape
+    b: a mtf.Tensor with the same shape as a
+
+  Returns:
+    a mtf.Tensor with the same shape as x.
+  """
+  def tf_fn(x, a, b):
+    return x * a + b
+  def grad_function(op, dy):
+    x, a, b = op.inputs
+    return [dy * a,
+            mtf.reduce_sum(dy * x, output_shape=a.shape),
+            mtf.reduce_sum(dy, output_shape=b.shape)]
+  return mtf.cwise_with_broadcasting(
+      _maybe_xla_compile(tf_fn), [x, a, b], output_shape=x.shape,
+      grad_function=grad_function, name="affine")
+
+
+def _normalize(x, mean, variance, scale, bias, epsilon):
+  """Computes (x - mean) * rsqrt(variance + epsilon) * scale + bias.
+
+  The whole elementwise chain is a single operation, so that it reads x once.
+  If the statistics and the scale have the same shape (as in batch_norm), they
+  are first folded into one multiplier and one offset, so that the per-element
+  work is a single multiply-add.
+
+  Args:
+    x: a mtf.Tensor
+    mean: a mtf.Tensor whose shape is a subset of x.shape
+    variance: a mtf.Tensor with the same shape as mean
+    scale: a mtf.Tensor whose shape is a subset of x.shape
+    bias: a mtf.Tensor with the same shape as scale
+    epsilon: a floating point number
+
+  Returns:
+    a mtf.Tensor with the same shape as x.
+  """
+  if mean.shape == scale.shape:
+    a = scale * mtf.rsqrt(variance + epsilon)
+    return _affine(x, a, bias - mean * a)
+  def tf_fn(x, mean, variance, scale, bias):
+    return (x - mean) * tf.math.rsqrt(variance + epsilon) * scale + bias
+  def grad_function(op, dy):
+    x, mean, variance, scale, bias = op.inputs
+    rstd = mtf.rsqrt(variance + epsilon)
+    x_centered = x - mean
+    dx_norm = dy * scale
+    dx = dx_norm * rstd
+    dmean = -mtf.reduce_sum(dx, output_shape=mean.shape)
+    dvariance = mtf.reduce_sum(
+        dx_norm * x_centered, output_shape=variance.shape) * (
+            mtf.square(rstd) * rstd * -0.5)
+    dscale = mtf.reduce_sum(dy * x_centered * rstd, output_shape=scale.shape)
+    dbias = mtf.reduce_sum(dy, output_shape=bias.shape)
+    return [dx, dmean, dvariance, dscale, dbias]
+  return mtf.cwise_with_broadcasting(
+      _maybe_xla_compile(tf_fn), [x, mean, variance, scale, bias],
+      output_shape=x.shape, grad_function=grad_function, name="normalize")
+
+
+@functools.lru_cache(maxsize=None)
+def _dense_stddev(sizes):
+  """Returns product(sizes) ** -0.5, the stddev of a dense kernel."""
+  return mtf.list_product(sizes) ** -0.5
+
+
+def dense_kernel(mesh, reduced_dims, output_dims, variable_dtype,
+                 expert_dims=None):
+  """Creates the kernel variable of dense() in the current variable scope.
+
+  Args:
+    mesh: a mtf.Mesh
+    reduced_dims: a list of mtf.Dimension - the input dimensions
+    output_dims: a list of mtf.Dimension
+    variable_dtype: a mtf.VariableDType
+    expert_dims: an optional list of mtf.Dimension
+
+  Returns:
+    a mtf.Tensor with shape expert_dims + reduced_dims + output_dims.
+  """
+  stddev = _dense_stddev(tuple(d.size for d in reduced_dims))
+  return mtf.get_variable(
+      mesh,
+      "kernel",
+      mtf.Shape((expert_dims or []) + reduced_dims + output_dims),
+      initializer=tf.random_normal_initializer(stddev=stddev),
+      dtype=variable_dtype)
+
+
 def dense(x, output_dim, reduced_dims=None, expert_dims=None,
           use_bias=True, activation=None,
           master_dtype=tf.float32,
           slice_dtype=tf.float32,
           variable_dtype=None,
+          compute_dtype=None,
           name=None):
   """Dense layer doing (kernel*x + bias) computation.
 
@@ -45,6 +159,9 @@ def dense(x, output_dim, reduced_dims=None, expert_dims=None,
     master_dtype: a tf.dtype (deprecated - use variable_dtype)
     slice_dtype: a tf.dtype (deprecated - use variable_dtype)
     variable_dtype: a mtf.VariableDType
+    compute_dtype: an optional tf.dtype (e.g. tf.bfloat16).  If given, x and
+      the kernel are cast to this dtype for the matmul, and the result is cast
+      back to x.dtype.
     name: a string used for tf.variable_scope.
 
   Returns:
@@ -60,20 +177,17 @@ def dense(x, output_dim, reduced_dims=None, expert_dims=None,
     expert_dims = []
   if reduced_dims is None:
     reduced_dims = x.shape.dims[-1:]
-  w_shape = mtf.Shape(expert_dims + reduced_dims + output_dims)
   output_shape = mtf.Shape(
       [d for d in x.shape.dims if d not in reduced_dims] + output_dims)
 
   with tf.variable_scope(name, default_name="dense"):
-    stddev = mtf.list_product(d.size for d in reduced_dims) ** -0.5
-    w = mtf.get_variable(
-        x.mesh,
-        "kernel",
-        w_shape,
-        initializer=tf.random_normal_initializer(stddev=stddev),
-        dtype=variable_dtype)
+    w = dense_kernel(x.mesh, reduced_dims, output_dims, variable_dtype,
+                     expert_dims=expert_dims)
+    output_dtype = x.dtype
+    if compute_dtype is not None:
+      x = mtf.cast(x, compute_dtype)
     w = mtf.cast(w, x.dtype)
-    y = mtf.einsum([x, w], output_shape)
+    b = None
     if use_bias:
       b = mtf.get_variable(
           x.mesh,
@@ -81,10 +195,158 @@ def dense(x, output_dim, reduced_dims=None, expert_dims=None,
           mtf.Shape(expert_dims + output_dims),
           initializer=tf.zeros_initializer(),
           dtype=variable_dtype)
-      y += b
-    if activation is not None:
-      y = activation(y)
-    return y
+      b = mtf.cast(b, x.dtype)
+    if activation is mtf.relu or (activation is None and use_bias):
+      # Apply the bias and activation in the epilogue of the matmul.
+      y = mtf.einsum_bias_activation(
+          x, w, b, output_shape, activation, xla_epilogue=_USE_XLA)
+    else:
+      y = mtf.einsum([x, w], output_shape)
+      if b is not None:
+        y += b
+      if activation is not None:
+        y = activation(y)
+    return mtf.cast(y, output_dtype)
+
+
+@functools.lru_cache(maxsize=None)
+def _blocks_halo_sizes(fn_name, filter_size, padding, transpose=False):
+  """Validates the arguments of a conv*_with_blocks function.
+
+  The result is memoized, since every call of a conv*_with_blocks layer with
+  the same arguments would redo the same checks.
+
+  Args:
+    fn_name: a string, the name of the calling function (for error messages).
+    filter_size: a tuple of integers.
+    padding: a string.
+    transpose: a boolean, whether this is a transposed convolution.
+
+  Returns:
+    a tuple of integers, the halo size in each spatial dimension.
+
+  Raises:
+    NotImplementedError: if padding is not "SAME".
+  """
+  for size in filter_size:
+    # Transposed convolutions take even filter sizes, others odd ones.
+    assert size % 2 == (0 if transpose else 1)
+  # Padding 'VALID' is not supported yet.
+  if padding != "SAME":
+    raise NotImplementedError("%s requires padding=SAME" % fn_name)
+  # TODO(lehou): figure out the halo_size in general cases.
+  return tuple(size // 2 - (1 if transpose else 0) for size in filter_size)
+
+
+def _is_symmetric_same_padding(filter_size, strides, padding):
+  """Whether "SAME" padding pads each spatial dimension by filter_size // 2."""
+  return (padding == "SAME" and
+          all(stride == 1 for stride in strides) and
+          all(size % 2 == 1 for size in filter_size))
+
+
+@functools.lru_cache(maxsize=None)
+def _filter_dims(filter_size):
+  """Returns the mtf.Dimensions ("fd", "fh", "fw") of a 2D or 3D filter.
+
+  Args:
+    filter_size: a tuple of integers.
+
+  Returns:
+    a tuple of mtf.Dimension.  It is shared between calls, hence immutable.
+  """
+  names = ["fd", "fh", "fw"][-len(filter_size):]
+  return tuple(mtf.Dimension(n, size) for n, size in zip(names, filter_size))
+
+
+def _conv_kernel(x, output_dim, filter_size, filter_initializer,
+                 variable_dtype, transpose=False):
+  """Creates the kernel variable of a 2D or 3D convolution of x.
+
+  Args:
+    x: a mtf.Tensor whose last dimension is the input channel dimension.
+    output_dim: a mtf.Dimension, indicating the output channel dimension.
+    filter_size: a list or tuple of length 2 or 3.
+    filter_initializer: the initializer for tf.get_variable.
+    variable_dtype: a mtf.VariableDType
+    transpose: a boolean, whether this is a transposed convolution, whose
+      kernel has the output channels before the input channels.
+
+  Returns:
+    a mtf.Tensor of shape [filter dims..., in_channels_dim, output_dim], or
+    [filter dims..., output_dim, in_channels_dim] if transpose is True.
+  """
+  channel_dims = [x.shape[-1], output_dim]
+  if transpose:
+    channel_dims.reverse()
+  if variable_dtype is None:
+    variable_dtype = mtf.VariableDType(activation_dtype=x.dtype)
+  return mtf.get_variable(
+      x.mesh, "kernel", list(_filter_dims(tuple(filter_size))) + channel_dims,
+      initializer=filter_initializer, dtype=variable_dtype)
+
+
+def _multi_halo_exchange(x, exchanges):
+  """Halo exchange along several block dimensions.
+
+  Each entry of exchanges is a triple (blocks_dim, block_size_dim, halo_size).
+  The exchanges are done in order, each one on the output of the previous one,
+  so that the corner regions of multi-dimensional halos are also filled in.
+  If blocks_dim is None, block_size_dim is zero-padded by halo_size on each
+  side instead.  Entries with halo_size <= 0 are skipped.
+
+  Args:
+    x: a mtf.Tensor.
+    exchanges: a list of triples (mtf.Dimension or None, mtf.Dimension,
+      integer)
+
+  Returns:
+    a mtf.Tensor with the same shape as x, other than in each block_size_dim,
+    whose size is increased by 2*halo_size.
+  """
+  for blocks_dim, block_size_dim, halo_size in exchanges:
+    if halo_size <= 0:
+      continue
+    if blocks_dim is None:
+      x = mtf.pad(x, [halo_size, halo_size], block_size_dim.name)
+    else:
+      x = mtf.halo_exchange(x, blocks_dim, block_size_dim, halo_size)
+  return x
+
+
+def _conv_with_halo_exchange(x, conv_fn, exchanges):
+  """Runs a "VALID" convolution on x after a halo exchange.
+
+  Equivalent to conv_fn(_multi_halo_exchange(x, exchanges)), where conv_fn
+  has stride 1 and filter size 2*halo_size+1 along each block_size_dim.
+
+  The exchange along the first split blocks dimension is overlapped with the
+  computation: the interior of each block does not depend on the halo, so it
+  is convolved separately from the 2*halo_size edge rows, and only the latter
+  wait for the neighbors.
+
+  Args:
+    x: a mtf.Tensor.
+    conv_fn: a function from mtf.Tensor to mtf.Tensor.
+    exchanges: a list of triples (blocks_dim, block_size_dim, halo_size), as
+      in _multi_halo_exchange().
+
+  Returns:
+    a mtf.Tensor.
+  """
+  for i, (blocks_dim, block_size_dim, halo_size) in enumerate(exchanges):
+    if (blocks_dim is not None and halo_size > 0 and
+        block_size_dim.size >= 3 * halo_size):
+      break
+  else:
+    return conv_fn(_multi_halo_exchange(x, exchanges))
+  x = _multi_halo_exchange(x, exchanges[:i] + exchanges[i + 1:])
+  interior = conv_fn(x)
+  x = mtf.halo_exchange(x, blocks_dim, block_size_dim, halo_size)
+  first = conv_fn(mtf.slice(x, 0, 3 * halo_size, block_size_dim.name))
+  last = conv_fn(mtf.slice(x, block_size_dim.size - halo_size, 3 * halo_size,
+                           block_size_dim.name))
+  return mtf.concat([first, interior, last], block_size_dim.name)
 
 
 def conv2d(x, output_dim, filter_size=(3, 3),
@@ -105,15 +367,9 @@ def conv2d(x, output_dim, filter_size=(3, 3),
   Returns:
     a mtf.Tensor.
   """
-  fh_dim = mtf.Dimension("fh", filter_size[0])
-  fw_dim = mtf.Dimension("fw", filter_size[1])
-  input_dim = x.shape[-1]
   with tf.variable_scope(name, default_name="conv2d"):
-    if variable_dtype is None:
-      variable_dtype = mtf.VariableDType(activation_dtype=x.dtype)
-    conv_filter = mtf.get_variable(
-        x.mesh, "kernel", [fh_dim, fw_dim, input_dim, output_dim],
-        initializer=filter_initializer, dtype=variable_dtype)
+    conv_filter = _conv_kernel(
+        x, output_dim, filter_size, filter_initializer, variable_dtype)
     # Pad stride in batch and channel dimensions.
     strides = [1] + list(strides) + [1]
 
@@ -154,29 +410,30 @@ def conv2d_with_blocks(
     A Tensor of shape
       [batch, h_blocks_dim, w_blocks_dim, h_dim, w_dim, out_channels_dim]
   """
-  # If h_blocks_dim and w_blocks_dim are not split, directly call conv2d.
-  if h_blocks_dim is None and w_blocks_dim is None:
+  # If h_blocks_dim and w_blocks_dim are not split, directly call conv2d,
+  # unless the SAME padding can be done by an explicit symmetric pad (stride 1,
+  # odd filter), so that the convolution is always "VALID".
+  if (h_blocks_dim is None and w_blocks_dim is None and
+      not _is_symmetric_same_padding(filter_size, strides, padding)):
     return conv2d(x, output_dim,
                   filter_size, strides, padding, filter_initializer,
                   variable_dtype, name)
 
-  assert filter_size[0] % 2 == 1
-  assert filter_size[1] % 2 == 1
-
-  # Padding 'VALID' is not supported yet.
-  if padding != "SAME":
-    raise NotImplementedError("conv2d_with_blocks requires padding=SAME")
+  h_halo, w_halo = _blocks_halo_sizes(
+      "conv2d_with_blocks", tuple(filter_size), padding)
 
   # Halo exchange for h_blocks and w_blocks.
   h_dim, w_dim = x.shape.dims[-3:-1]
-  for blocks_dim, block_size_dim, halo_size in [
-      (h_blocks_dim, h_dim, filter_size[0] // 2),
-      (w_blocks_dim, w_dim, filter_size[1] // 2)]:
-    if halo_size > 0:
-      if blocks_dim is not None:
-        x = mtf.halo_exchange(x, blocks_dim, block_size_dim, halo_size)
-      else:
-        x = mtf.pad(x, [halo_size, halo_size], block_size_dim.name)
+  exchanges = [(h_blocks_dim, h_dim, h_halo), (w_blocks_dim, w_dim, w_halo)]
+  if tuple(strides) == (1, 1):
+    with tf.variable_scope(name, default_name="conv2d"):
+      conv_filter = _conv_kernel(
+          x, output_dim, filter_size, filter_initializer, variable_dtype)
+      def conv_fn(t):
+        return mtf.Conv2dOperation(
+            t, conv_filter, [1, 1, 1, 1], "VALID").outputs[0]
+      return _conv_with_halo_exchange(x, conv_fn, exchanges)
+  x = _multi_halo_exchange(x, exchanges)
   return conv2d(x, output_dim,
                 filter_size, strides, "VALID", filter_initializer,
                 variable_dtype, name)
@@ -203,15 +460,10 @@ def conv2d_transpose(x, output_dim,
   Returns:
     a mtf.Tensor.
   """
-  fh_dim = mtf.Dimension("fh", filter_size[0])
-  fw_dim = mtf.Dimension("fw", filter_size[1])
-  input_dim = x.shape[-1]
   with tf.variable_scope(name, default_name="conv2d_transpose"):
-    if variable_dtype is None:
-      variable_dtype = mtf.VariableDType(activation_dtype=x.dtype)
-    conv_filter = mtf.get_variable(
-        x.mesh, "kernel", [fh_dim, fw_dim, output_dim, input_dim],
-        initializer=filter_initializer, dtype=variable_dtype)
+    conv_filter = _conv_kernel(
+        x, output_dim, filter_size, filter_initializer, variable_dtype,
+        transpose=True)
     # Pad stride in batch and channel dimensions.
     strides = [1] + list(strides) + [1]
 
@@ -263,25 +515,14 @@ def conv2d_transpose_with_blocks(
         variable_dtype, name)
 
   # Now only supports even-sized filters.
-  assert filter_size[0] % 2 == 0
-  assert filter_size[1] % 2 == 0
-
-  # Padding 'VALID' is not supported yet.
-  if padding != "SAME":
-    raise NotImplementedError(
-        "conv2d_transpose_with_blocks requires padding=SAME")
+  h_halo, w_halo = _blocks_halo_sizes(
+      "conv2d_transpose_with_blocks", tuple(filter_size), padding,
+      transpose=True)
 
   # Halo exchange for h_blocks and w_blocks.
-  # TODO(lehou): figure out the halo_size in general cases.
   h_dim, w_dim = x.shape.dims[-3:-1]
-  for blocks_dim, block_size_dim, halo_size in [
-      (h_blocks_dim, h_dim, filter_size[0] // 2 - 1),
-      (w_blocks_dim, w_dim, filter_size[1] // 2 - 1)]:
-    if halo_size > 0:
-      if blocks_dim is not None:
-        x = mtf.halo_exchange(x, blocks_dim, block_size_dim, halo_size)
-      else:
-        x = mtf.pad(x, [halo_size, halo_size], block_size_dim.name)
+  x = _multi_halo_exchange(
+      x, [(h_blocks_dim, h_dim, h_halo), (w_blocks_dim, w_dim, w_halo)])
 
   return conv2d_transpose(
       x, output_dim, filter_size, strides, "VALID", filter_initializer,
@@ -309,16 +550,9 @@ def conv3d(x, output_dim, filter_size=(3, 3, 3),
   Returns:
     a mtf.Tensor.
   """
-  fd_dim = mtf.Dimension("fd", filter_size[0])
-  fh_dim = mtf.Dimension("fh", filter_size[1])
-  fw_dim = mtf.Dimension("fw", filter_size[2])
-  input_dim = x.shape[-1]
   with tf.variable_scope(name, default_name="conv3d"):
-    if variable_dtype is None:
-      variable_dtype = mtf.VariableDType(activation_dtype=x.dtype)
-    conv_filter = mtf.get_variable(
-        x.mesh, "kernel", [fd_dim, fh_dim, fw_dim, input_dim, output_dim],
-        initializer=filter_initializer, dtype=variable_dtype)
+    conv_filter = _conv_kernel(
+        x, output_dim, filter_size, filter_initializer, variable_dtype)
     # Pad stride in batch and channel dimensions.
     strides = [1] + list(strides) + [1]
 
@@ -363,34 +597,37 @@ def conv3d_with_blocks(
       [batch, d_blocks_dim, h_blocks_dim, w_blocks_dim,
        d_dim, h_dim, w_dim, out_channels_dim]
   """
-  # If d_blocks_dim and h_blocks_dim are not split, directly call conv3d.
-  if d_blocks_dim is None and h_blocks_dim is None:
+  # If d_blocks_dim and h_blocks_dim are not split, directly call conv3d,
+  # unless the SAME padding can be done by an explicit symmetric pad (stride 1,
+  # odd filter), so that the convolution is always "VALID".
+  if (d_blocks_dim is None and h_blocks_dim is None and
+      not _is_symmetric_same_padding(filter_size, strides, padding)):
     return conv3d(x, output_dim,
                   filter_size, strides, padding, filter_initializer,
                   variable_dtype, name)
 
-  assert filter_size[0] % 2 == 1
-  assert filter_size[1] % 2 == 1
-  assert filter_size[2] % 2 == 1
-
-  # Padding 'VALID' is not supported yet.
-  if padding != "SAME":
-    raise NotImplementedError("conv3d_with_blocks requires padding=SAME")
+  d_halo, h_halo, w_halo = _blocks_halo_sizes(
+      "conv3d_with_blocks", tuple(filter_size), padding)
 
   # Halo exchange for d_blocks and h_blocks.
   d_dim, h_dim, w_dim = x.shape.dims[-4:-1]
-  for blocks_dim, block_size_dim, halo_size in [
-      (d_blocks_dim, d_dim, filter_size[0] // 2),
-      (h_blocks_dim, h_dim, filter_size[1] // 2)]:
-    if halo_size > 0:
-      if blocks_dim is not None:
-        x = mtf.halo_exchange(x, blocks_dim, block_size_dim, halo_size)
-      else:
-        x = mtf.pad(x, [halo_size, halo_size], block_size_dim.name)
+  exchanges = [(d_blocks_dim, d_dim, d_halo), (h_blocks_dim, h_dim, h_halo)]
+  if tuple(strides) == (1, 1, 1):
+    with tf.variable_scope(name, default_name="conv3d"):
+      conv_filter = _conv_kernel(
+          x, output_dim, filter_size, filter_initializer, variable_dtype)
+      # The w dimension is not split, so it is zero-padded by the convolution
+      # itself rather than by an explicit mtf.pad.
+      def conv_fn(t):
+        return mtf.Conv3dOperation(
+            t, conv_filter, [1, 1, 1, 1, 1],
+            ["VALID", "VALID", "SAME"]).outputs[0]
+      return _conv_with_halo_exchange(x, conv_fn, exchanges)
 
   # Pad w dimension with zeros.
-  x = mtf.pad(x, [filter_size[2] // 2, filter_size[2] // 2],
+  x = mtf.pad(x, [w_halo, w_halo],
               dim_name=w_dim.name, name="conv3d_pad_w_dim")
+  x = _multi_halo_exchange(x, exchanges)
   return conv3d(x, output_dim,
                 filter_size, strides, "VALID", filter_initializer,
                 variable_dtype, name)
@@ -419,16 +656,10 @@ def conv3d_transpose(x, output_dim,
   Returns:
     a mtf.Tensor.
   """
-  fd_dim = mtf.Dimension("fd", filter_size[0])
-  fh_dim = mtf.Dimension("fh", filter_size[1])
-  fw_dim = mtf.Dimension("fw", filter_size[2])
-  input_dim = x.shape[-1]
   with tf.variable_scope(name, default_name="conv3d_transpose"):
-    if variable_dtype is None:
-      variable_dtype = mtf.VariableDType(activation_dtype=x.dtype)
-    conv_filter = mtf.get_variable(
-        x.mesh, "kernel", [fd_dim, fh_dim, fw_dim, output_dim, input_dim],
-        initializer=filter_initializer, dtype=variable_dtype)
+    conv_filter = _conv_kernel(
+        x, output_dim, filter_size, filter_initializer, variable_dtype,
+        transpose=True)
     # Pad stride in batch and channel dimensions.
     strides = [1] + list(strides) + [1]
 
@@ -483,35 +714,60 @@ def conv3d_transpose_with_blocks(
         variable_dtype, name)
 
   # Now only supports even-sized filters.
-  assert filter_size[0] % 2 == 0
-  assert filter_size[1] % 2 == 0
-  assert filter_size[2] % 2 == 0
-
-  # Padding 'VALID' is not supported yet.
-  if padding != "SAME":
-    raise NotImplementedError(
-        "conv3d_transpose_with_blocks requires padding=SAME")
+  d_halo, h_halo, w_halo = _blocks_halo_sizes(
+      "conv3d_transpose_with_blocks", tuple(filter_size), padding,
+      transpose=True)
 
   # Halo exchange for d_blocks and h_blocks.
-  # TODO(lehou): figure out the halo_size in general cases.
   d_dim, h_dim, w_dim = x.shape.dims[-4:-1]
-  for blocks_dim, block_size_dim, halo_size in [
-      (d_blocks_dim, d_dim, filter_size[0] // 2 - 1),
-      (h_blocks_dim, h_dim, filter_size[1] // 2 - 1)]:
-    if halo_size > 0:
-      if blocks_dim is not None:
-        x = mtf.halo_exchange(x, blocks_dim, block_size_dim, halo_size)
-      else:
-        x = mtf.pad(x, [halo_size, halo_size], block_size_dim.name)
+  x = _multi_halo_exchange(
+      x, [(d_blocks_dim, d_dim, d_halo), (h_blocks_dim, h_dim, h_halo)])
 
   # Pad w dimension with zeros.
-  x = mtf.pad(x, [filter_size[2] // 2 - 1, filter_size[2] // 2 - 1],
+  x = mtf.pad(x, [w_halo, w_halo],
               dim_name=w_dim.name, name="conv3d_trans_pad_w_dim")
   return conv3d_transpose(
       x, output_dim, filter_size, strides, "VALID", filter_initializer,
       variable_dtype, name)
 
 
+@functools.lru_cache(maxsize=None)
+def _shape_minus(dims, removed_dims):
+  """Returns mtf.Shape(dims) - removed_dims, memoized.
+
+  Args:
+    dims: a tuple of mtf.Dimension
+    removed_dims: a tuple of mtf.Dimension
+
+  Returns:
+    a mtf.Shape
+  """
+  return mtf.Shape([d for d in dims if d not in removed_dims])
+
+
+def _mean_and_variance(x, reduced_shape):
+  """Mean and variance of x, reduced to reduced_shape.
+
+  For float32 inputs this reads x once, using variance = E[x^2] - E[x]^2
+  clipped at zero against roundoff.  In lower precision that difference
+  cancels catastrophically, so other dtypes use the two-pass
+  E[(x - E[x])^2].
+
+  Args:
+    x: a mtf.Tensor
+    reduced_shape: a mtf.Shape
+
+  Returns:
+    a pair of mtf.Tensors with shape reduced_shape
+  """
+  if x.dtype != tf.float32:
+    mean = mtf.reduce_mean(x, output_shape=reduced_shape)
+    return mean, mtf.reduce_mean(
+        mtf.square(x - mean), output_shape=reduced_shape)
+  mean, square_mean = mtf.reduce_mean_and_square_mean(x, reduced_shape)
+  return mean, mtf.relu(square_mean - mtf.square(mean))
+
+
 def layer_norm(x, dim, epsilon=1e-6, name="layer_prepostprocess"):
   """Layer normalization over dimension dim.
 
@@ -525,23 +781,14 @@ def layer_norm(x, dim, epsilon=1e-6, name="layer_prepostprocess"):
     a mtf.Tensor with same shape as x.
   """
   with tf.variable_scope(name + "/layer_norm"):
-    scale = mtf.get_variable(
+    scale, bias = mtf.get_variables(
         x.mesh,
-        "layer_norm_scale",
-        mtf.Shape([dim]),
-        initializer=tf.ones_initializer(),
+        [("layer_norm_scale", mtf.Shape([dim]), tf.ones_initializer(), True),
+         ("layer_norm_bias", mtf.Shape([dim]), tf.zeros_initializer(), True)],
         activation_dtype=x.dtype)
-    bias = mtf.get_variable(
-        x.mesh,
-        "layer_norm_bias",
-        mtf.Shape([dim]),
-        initializer=tf.zeros_initializer(),
-        activation_dtype=x.dtype)
-    reduced_shape = x.shape - dim
-    mean = mtf.reduce_mean(x, output_shape=reduced_shape)
-    variance = mtf.reduce_mean(mtf.square(x - mean), output_shape=reduced_shape)
-    norm_x = (x - mean) * mtf.rsqrt(variance + epsilon)
-    return norm_x * scale + bias
+    reduced_shape = _shape_minus(tuple(x.shape.dims), (dim,))
+    mean, variance = _mean_and_variance(x, reduced_shape)
+    return _normalize(x, mean, variance, scale, bias, epsilon)
 
 
 def batch_norm(x, is_training, momentum, epsilon=1e-9,
@@ -571,60 +818,48 @@ def batch_norm(x, is_training, momentum, epsilon=1e-9,
       gamma_initializer = tf.ones_initializer()
 
     norm_dim = x.shape.dims[dims_idx_start:dims_idx_end]
-    reduced_shape = x.shape - norm_dim
+    reduced_shape = _shape_minus(tuple(x.shape.dims), tuple(norm_dim))
 
-    scale = mtf.get_variable(
+    scale, bias, moving_mean, moving_variance = mtf.get_variables(
         x.mesh,
-        "batch_norm_scale",
-        reduced_shape,
-        initializer=gamma_initializer,
+        [("batch_norm_scale", reduced_shape, gamma_initializer, True),
+         ("batch_norm_bias", reduced_shape, tf.zeros_initializer(), True),
+         ("bn_moving_mean", reduced_shape,
+          tf.random_normal_initializer(stddev=1.0), False),
+         ("bn_moving_variance", reduced_shape, tf.ones_initializer(), False)],
         activation_dtype=x.dtype)
-    bias = mtf.get_variable(
-        x.mesh,
-        "batch_norm_bias",
-        reduced_shape,
-        initializer=tf.zeros_initializer(),
-        activation_dtype=x.dtype)
-
-    moving_mean = mtf.get_variable(
-        x.mesh, "bn_moving_mean", reduced_shape,
-        initializer=tf.random_normal_initializer(stddev=1.0),
-        activation_dtype=x.dtype,
-        trainable=False)
-    moving_variance = mtf.get_variable(
-        x.mesh, "bn_moving_variance",
-        reduced_shape, initializer=tf.ones_initializer(),
-        activation_dtype=x.dtype,
-        trainable=False)
 
     # At training time, calculate mean and variance and normalize across batch
     # dim.
     if is_training:
-      mean = mtf.reduce_mean(x, output_shape=reduced_shape)
-      variance = mtf.reduce_mean(
-          mtf.square(x - mean), output_shape=reduced_shape)
+      mean, variance = _mean_and_variance(x, reduced_shape)
 
-      norm_x = (x - mean) * mtf.rsqrt(variance + epsilon)
+      norm_x = _normalize(x, mean, variance, scale, bias, epsilon)
 
-      # Update running mean and running variance.
+      # Update running mean and running variance, as
+      # moving -= (1 - momentum) * (moving - current), in a single Assign.
       # TODO(lehou): do not return update_ops; handle them inside MTF.
-      bn_stats_update_ops = []
-      bn_stats_update_ops.append(mtf.assign(
-          moving_mean, momentum * moving_mean + (1 - momentum) * mean,
-          name="{}/bn_mean_update".format(name)))
-      bn_stats_update_ops.append(mtf.assign(
-          moving_variance,
-          momentum * moving_variance + (1 - momentum) * variance,
-          name="{}/bn_var_update".format(name)))
+      def ema_delta(moving, current):
+        return mtf.cwise(
+            lambda m, c: (1 - momentum) * (m - c), [moving, current],
+            name="bn_ema_delta")
+      bn_stats_update_ops = [mtf.Assign(
+          [moving_mean.operation, moving_variance.operation],
+          [ema_delta(moving_mean, mean),
+           ema_delta(moving_variance, variance)],
+          assign_fn=mtf.assign_sub_slice,
+          name="{}/bn_stats_update".format(name))]
     else:
       # At eval and test time, use the running mean and variance.
-      norm_x = (x - moving_mean) * mtf.rsqrt(moving_variance + epsilon)
+      norm_x = _normalize(
+          x, moving_mean, moving_variance, scale, bias, epsilon)
       bn_stats_update_ops = []
 
-    return (norm_x * scale) + bias, bn_stats_update_ops
+    return norm_x, bn_stats_update_ops
 
 
-def softmax_cross_entropy_with_logits(logits, targets, vocab_dim, z_loss=0.0):
+def softmax_cross_entropy_with_logits(logits, targets, vocab_dim, z_loss=0.0,
+                                      targets_sum_to_one=False):
   """Per-example softmax loss.
 
   if z_loss is nonzero, we add a loss equal to z_loss*log(z)^2, where z is the
@@ -638,6 +873,9 @@ def softmax_cross_entropy_with_logits(logits, targets, vocab_dim, z_loss=0.0):
     targets: a mtf.Tensor with the same shape as logits
     vocab_dim: a mtf.Dimension
     z_loss: a float
+    targets_sum_to_one: a boolean - whether targets are known to sum to 1
+      along vocab_dim (e.g. one-hot or label-smoothed one-hot).  This saves
+      a reduction over vocab_dim.
 
   Returns:
     a mtf.Tensor whose shape is equal to logits.shape - vocab_dim
@@ -645,16 +883,8 @@ def softmax_cross_entropy_with_logits(logits, targets, vocab_dim, z_loss=0.0):
   Raises:
     ValueError: if the shapes do not match.
   """
-  if logits.shape != targets.shape:
-    raise ValueError(
-        "logits shape must equal targets shape"
-        "logits=%s targets=%s" % (logits.to_string, targets.to_string))
-  if vocab_dim not in logits.shape.dims:
-    raise ValueError("vocab_dim must be in logits.shape.dims")
-  log_z = mtf.reduce_logsumexp(logits, vocab_dim)
-  log_softmax = logits - log_z
-  loss = mtf.negative(
-      mtf.reduce_sum(log_softmax * targets, reduced_dim=vocab_dim))
+  loss, log_z = mtf.softmax_cross_entropy(
+      logits, targets, vocab_dim, targets_sum_to_one=targets_sum_to_one)
   if z_loss != 0:
     loss += z_loss * mtf.square(log_z)
   return loss
@@ -677,9 +907,14 @@ def sigmoid_cross_entropy_with_logits(logits, targets):
     raise ValueError(
         "logits shape must equal targets shape"
         "logits=%s targets=%s" % (logits.to_string, targets.to_string))
-  x = logits
-  z = targets
-  return mtf.relu(x) - x * z + mtf.log(1 + mtf.exp(-mtf.abs(x)))
+  def tf_fn(x, z):
+    return tf.nn.relu(x) - x * z + tf.math.log1p(tf.exp(-tf.abs(x)))
+  def grad_function(op, dy):
+    x, z = op.inputs
+    return [dy * (mtf.sigmoid(x) - z), -dy * x]
+  return mtf.cwise(_maybe_xla_compile(tf_fn), [logits, targets],
+                   output_dtype=logits.dtype, grad_function=grad_function,
+                   name="sigmoid_cross_entropy")
 
 
 def weights_nonzero(targets, dtype=tf.float32):
@@ -688,16 +923,46 @@ def weights_nonzero(targets, dtype=tf.float32):
   return mtf.cwise(my_fn, [targets], output_dtype=dtype, name="weights_nonzero")
 
 
+def weights_nonzero_mul(targets, values, dtype=tf.float32):
+  """values * weights_nonzero(targets), without materializing the weights.
+
+  Args:
+    targets: a mtf.Tensor
+    values: a mtf.Tensor with the same shape as targets
+    dtype: a tf.dtype, the output dtype
+
+  Returns:
+    a mtf.Tensor with the same shape as targets
+  """
+  def my_fn(t, v):
+    return tf.cast(tf.not_equal(t, 0), dtype) * tf.cast(v, dtype)
+  def grad_function(op, dy):
+    t, v = op.inputs
+    return [None, mtf.cast(weights_nonzero_mul(t, dy, dtype=dy.dtype), v.dtype)]
+  return mtf.cwise(my_fn, [targets, values], output_dtype=dtype,
+                   grad_function=grad_function, name="weights_nonzero_mul")
+
+
 def dense_relu_dense(x,
                      hidden_channels,
                      dropout=0.0,
                      dropout_broadcast_dims=None,
                      master_dtype=tf.float32,
-                     slice_dtype=tf.float32, name=None):
+                     slice_dtype=tf.float32,
+                     compute_dtype=None,
+                     fused=False,
+                     num_hidden_chunks=1,
+                     name=None):
   """Hidden layer with ReLU activation followed by linear projection.
 
   The output has the same number of channels as the input.
 
+  With fused=True and no dropout, this is a single mtf.fused_ffn with the same
+  variables, so the hidden activation is recomputed in the backward pass
+  instead of being stored.  Within each slice, the hidden layer is then
+  computed in num_hidden_chunks pieces, so with num_hidden_chunks > 1 only
+  one piece of it is live at a time.
+
   Args:
     x: a mtf.Tensor
     hidden_channels: a mtf.Dimension - channels in the hidden layer
@@ -705,6 +970,9 @@ def dense_relu_dense(x,
     dropout_broadcast_dims: an optional list of mtf.Dimension
     master_dtype: a tf.dtype
     slice_dtype: a tf.dtype
+    compute_dtype: an optional tf.dtype for the two matmuls - see dense()
+    fused: a boolean - whether to use mtf.fused_ffn.  Ignored with dropout.
+    num_hidden_chunks: an integer - see mtf.fused_ffn.  Only used if fused.
     name: an optional string
 
   Returns:
@@ -712,34 +980,94 @@ def dense_relu_dense(x,
   """
   with tf.variable_scope(name, default_name="dense_relu_dense"):
     io_channels = x.shape.dims[-1]
+    if fused and dropout == 0.0:
+      variable_dtype = mtf.VariableDType(master_dtype, slice_dtype, x.dtype)
+      with tf.variable_scope("wi"):
+        wi = dense_kernel(
+            x.mesh, [io_channels], [hidden_channels], variable_dtype)
+      with tf.variable_scope("wo"):
+        wo = dense_kernel(
+            x.mesh, [hidden_channels], [io_channels], variable_dtype)
+      output_dtype = x.dtype
+      if compute_dtype is not None:
+        x = mtf.cast(x, compute_dtype)
+      return mtf.cast(
+          mtf.fused_ffn(x, mtf.cast(wi, x.dtype), mtf.cast(wo, x.dtype),
+                        num_hidden_chunks=num_hidden_chunks),
+          output_dtype)
     h = dense(x, hidden_channels,
               use_bias=False, activation=mtf.relu,
-              master_dtype=master_dtype, slice_dtype=slice_dtype, name="wi")
+              master_dtype=master_dtype, slice_dtype=slice_dtype,
+              compute_dtype=compute_dtype, name="wi")
     if dropout != 0.0:
       h = mtf.dropout(h, 1.0 - dropout,
                       noise_shape=h.shape - dropout_broadcast_dims)
     return dense(h, io_channels, use_bias=False, activation=None,
                  master_dtype=master_dtype, slice_dtype=slice_dtype,
-                 name="wo")
+                 compute_dtype=compute_dtype, name="wo")
+
+
+# Halo exchange for one of the keys/values of local 1D attention, keyed by
+# (mask_right, whether the blocks dimension is given).  With mask_right, the
+# block to the right is never attended to, so it is neither exchanged nor
+# padded.
+_LOCAL_1D_HALO_FNS = {
+    (True, True): lambda x, blocks_dim, w_dim: mtf.left_halo_exchange(
+        x, blocks_dim, w_dim, w_dim.size),
+    (False, True): lambda x, blocks_dim, w_dim: mtf.halo_exchange(
+        x, blocks_dim, w_dim, w_dim.size),
+    (True, False): lambda x, blocks_dim, w_dim: mtf.pad(
+        x, [w_dim.size, 0], w_dim.name),
+    (False, False): lambda x, blocks_dim, w_dim: mtf.pad(
+        x, [w_dim.size, w_dim.size], w_dim.name),
+}
+
+
+def _stack_kv(k, v):
+  """Stack keys and values, so that they can share one communication."""
+  return mtf.stack([k, v], "stacked_kv", axis=0)
+
+
+def _unstack_kv(kv):
+  """Inverse of _stack_kv()."""
+  return tuple(mtf.unstack(kv, kv.shape.dims[0]))
+
+
+def _kv_einsum(x, w_qkv, shape):
+  """Compute keys and values, stacked as by _stack_kv(), with one einsum.
+
+  Computing the keys and values separately from the queries lets their halo
+  exchange be issued before the query projection, so that the communication
+  can overlap with the query computation.
+
+  Args:
+    x: a Tensor
+    w_qkv: a Tensor with shape [qkv, heads, io_channels, kv_channels]
+    shape: a mtf.Shape containing heads - the shape of each of k and v
+
+  Returns:
+    wq: a Tensor with shape [heads, io_channels, kv_channels]
+    kv: a Tensor with shape [stacked_kv] + shape
+  """
+  qkv_dim = w_qkv.shape.dims[0]
+  wq = mtf.reshape(mtf.slice(w_qkv, 0, 1, qkv_dim.name), w_qkv.shape - qkv_dim)
+  w_kv = mtf.rename_dimension(
+      mtf.slice(w_qkv, 1, 2, qkv_dim.name), qkv_dim.name, "stacked_kv")
+  kv = mtf.einsum(
+      [x, w_kv], mtf.Shape(w_kv.shape.dims[:1] + shape.dims))
+  return wq, kv
+
+
+def _local_1d_halo_exchange_kv(kv, num_w_blocks, w_dim, mask_right):
+  """local_1d_halo_exchange() on keys and values stacked by _stack_kv()."""
+  halo_fn = _LOCAL_1D_HALO_FNS[(bool(mask_right), num_w_blocks is not None)]
+  return halo_fn(kv, num_w_blocks, w_dim)
 
 
 def local_1d_halo_exchange(k, v, num_w_blocks, w_dim, mask_right):
   """Halo exchange for keys and values for Local 1D attention."""
-  if num_w_blocks is not None:
-    if mask_right:
-      k = mtf.left_halo_exchange(k, num_w_blocks, w_dim, w_dim.size)
-      v = mtf.left_halo_exchange(v, num_w_blocks, w_dim, w_dim.size)
-    else:
-      k = mtf.halo_exchange(k, num_w_blocks, w_dim, w_dim.size)
-      v = mtf.halo_exchange(v, num_w_blocks, w_dim, w_dim.size)
-  else:
-    if mask_right:
-      k = mtf.pad(k, [w_dim, None], w_dim.name)
-      v = mtf.pad(v, [w_dim, None], w_dim.name)
-    else:
-      k = mtf.pad(k, [w_dim, w_dim], w_dim.name)
-      v = mtf.pad(v, [w_dim, w_dim], w_dim.name)
-  return k, v
+  return _unstack_kv(_local_1d_halo_exchange_kv(
+      _stack_kv(k, v), num_w_blocks, w_dim, mask_right))
 
 
 def local_self_attention_spatial_blocks(
@@ -784,35 +1112,31 @@ def local_self_attention_spatial_blocks(
 
     w_dim, io_channels = query_antecedent.shape.dims[-2:]
     batch, num_w_blocks = query_antecedent.shape.dims[:2]
-    wq, wk, wv, wo = multihead_attention_vars(
+    w_qkv, wo = multihead_attention_vars(
         query_antecedent.mesh, heads, io_channels, kv_channels,
-        master_dtype, slice_dtype, query_antecedent.dtype)
+        master_dtype, slice_dtype, query_antecedent.dtype, stack_qkv=True)
 
-    # Rename dimensions for the memory height and width.
-    memory_antecedent = mtf.rename_dimension(
-        query_antecedent, w_dim.name, "memory_" + w_dim.name)
-    memory_w_dim = memory_antecedent.shape.dims[-2]
+    # Call einsum over the query to get keys k and values v.
+    q_shape = mtf.Shape([batch, heads, num_w_blocks, w_dim, kv_channels])
+    wq, kv = _kv_einsum(query_antecedent, w_qkv, q_shape)
 
-    # Call einsum over the query and memory to get query q, keys k and values v.
-    q = mtf.einsum(
-        [query_antecedent, wq],
-        mtf.Shape([batch, heads, num_w_blocks, w_dim, kv_channels]))
-    k = mtf.einsum(
-        [memory_antecedent, wk],
-        mtf.Shape([batch, heads, num_w_blocks, memory_w_dim, kv_channels]))
-    v = mtf.einsum(
-        [memory_antecedent, wv],
-        mtf.Shape([batch, heads, num_w_blocks, memory_w_dim, kv_channels]))
+    # Rename dimensions for the memory width.
+    kv = mtf.rename_dimension(kv, w_dim.name, "memory_" + w_dim.name)
+    memory_w_dim = kv.shape.dims[-2]
 
-    # Halo exchange for memory blocks.
-    k, v = local_1d_halo_exchange(k, v, num_w_blocks, memory_w_dim, mask_right)
+    # Halo exchange for memory blocks, followed by the query einsum, which
+    # does not depend on it.
+    k, v = _unstack_kv(_local_1d_halo_exchange_kv(
+        kv, num_w_blocks, memory_w_dim, mask_right))
+    q = mtf.einsum([query_antecedent, wq], q_shape)
 
     # Calculate the causal mask to avoid peeking into the future. We compute
     # this once and reuse it for all blocks since the block_size is known.
     mask = None
     if mask_right:
       mask = attention_bias_local_block(
-          query_antecedent.mesh, w_dim, memory_w_dim)
+          query_antecedent.mesh, w_dim, memory_w_dim,
+          dtype=query_antecedent.dtype)
 
     output = dot_product_attention(q, k, v, mask=mask)
 
@@ -820,6 +1144,54 @@ def local_self_attention_spatial_blocks(
         [output, wo], mtf.Shape([batch, num_w_blocks, w_dim, io_channels]))
 
 
+@functools.lru_cache(maxsize=None)
+def _largest_divisor_le(n, max_val):
+  """The greatest divisor of n which is less than or equal to max_val.
+
+  Divisors are enumerated in pairs (d, n // d) up to sqrt(n).
+
+  Args:
+    n: a positive integer
+    max_val: a positive integer
+
+  Returns:
+    an integer
+  """
+  best = 1
+  d = 1
+  while d * d <= n:
+    if n % d == 0:
+      for divisor in (d, n // d):
+        if best < divisor <= max_val:
+          best = divisor
+    d += 1
+  assert n % best == 0
+  return best
+
+
+@functools.lru_cache(maxsize=None)
+def _local_window_bias_values(block_length, window_size):
+  """Values of the bias for masked_local_attention_1d().
+
+  The memory for a block of queries consists of the window_size positions
+  before the block, followed by the block.  Query position q (which is at
+  memory position q + window_size) may not look forward, or back by
+  block_length or more positions.
+
+  Args:
+    block_length: an integer
+    window_size: an integer
+
+  Returns:
+    a nested tuple of floats with shape
+    [block_length, window_size + block_length]
+  """
+  return tuple(
+      tuple(-1e9 if m > q + window_size or m <= q + window_size - block_length
+            else 0.0 for m in range(window_size + block_length))
+      for q in range(block_length))
+
+
 def masked_local_attention_1d(x,
                               kv_channels,
                               heads,
@@ -829,12 +1201,22 @@ def masked_local_attention_1d(x,
                               length_per_split=None,
                               return_kv=None,
                               params=None,
+                              head_tile=None,
                               name=None):
   """Attention to the source position and a neighborhood to the left of it.
 
   Attention for a given query position p can only see memory positions
   in the range (p - window_size, p].
 
+  If head_tile is given, the attention is computed for head_tile heads at a
+  time, so that the keys and values of one tile stay in cache across both
+  attention matmuls.  The layout is not known when the graph is built, so
+  a heads dimension split across the mesh is only caught at lowering time,
+  where mtf.split raises a ValueError.  The tiling is not free either:
+  splitting q, k and v into tiles and concatenating the per-tile outputs
+  copies all four tensors, so only use head_tile when the per-head working
+  set would otherwise not fit in cache.
+
   Args:
     x: a mtf.Tensor with shape batch_dims + [length, io_channels]
     kv_channels: a mtf.Dimension (the size of the key and value vectors)
@@ -847,42 +1229,45 @@ def masked_local_attention_1d(x,
       split.
     return_kv: an optional list onto which to append the computed k and v.
     params: an optional quadruple of Tensors (see multihead_attention_params())
+    head_tile: an optional integer dividing heads.size.  The heads dimension
+      must not be split across the mesh.
     name: an optional string.
 
   Returns:
     a Tensor with the same shape as x
 
   Raises:
-    ValueError: if channels or depth don't match.
+    ValueError: if channels or depth don't match, or head_tile does not
+      divide heads.size.
   """
+  if head_tile is not None and heads.size % head_tile != 0:
+    raise ValueError("head_tile=%d must divide heads=%s" % (head_tile, heads))
   with tf.variable_scope(
       name, default_name="masked_local_attention_1d", values=[x]):
 
     batch_dims = x.shape.dims[:-2]
     length, io_channels = x.shape.dims[-2:]
     if params is None:
-      wq, wk, wv, wo = multihead_attention_vars(
+      w_qkv, wo = multihead_attention_vars(
           x.mesh, heads, io_channels, kv_channels,
-          master_dtype, slice_dtype, x.dtype)
+          master_dtype, slice_dtype, x.dtype, stack_qkv=True)
     else:
-      wq, wk, wv, wo = params
+      w_qkv, wo = _stack_qkv_params(params)
 
-    # Get query q, keys k and values v.
-    qkv_shape = mtf.Shape(batch_dims + [heads, length, kv_channels])
-    q = mtf.einsum([x, wq], qkv_shape)
-    k = mtf.einsum([x, wk], qkv_shape)
-    v = mtf.einsum([x, wv], qkv_shape)
+    # Get keys k and values v, stacked.  The queries are computed after the
+    # halo exchange is issued.
+    wq, kv = _kv_einsum(
+        x, w_qkv, mtf.Shape(batch_dims + [heads, length, kv_channels]))
     if return_kv is not None:
-      return_kv.extend([k, v])
+      return_kv.extend(_unstack_kv(kv))
 
     # Choose a suitable block size.
     # We choose the greatest divisor of length_per_split less than or equal
     # to max(window_size, 128)
     if length_per_split is None:
       length_per_split = length.size
-    block_length = max(window_size, 128)
-    while length_per_split % block_length != 0:
-      block_length -= 1
+    block_length = _largest_divisor_le(length_per_split,
+                                       max(window_size, 128))
 
     query_block_length = mtf.Dimension("query_block_length", block_length)
     memory_block_length = mtf.Dimension("memory_block_length", block_length)
@@ -890,27 +1275,39 @@ def masked_local_attention_1d(x,
     # so it will be split in the same way.
     num_blocks = mtf.Dimension(length.name, length.size // block_length)
     q_shape = batch_dims + [heads, num_blocks, query_block_length, kv_channels]
-    kv_shape = batch_dims + [
+    kv_shape = kv.shape.dims[:1] + batch_dims + [
         heads, num_blocks, memory_block_length, kv_channels]
-    q = mtf.reshape(q, q_shape)
-    k = mtf.reshape(k, kv_shape)
-    v = mtf.reshape(v, kv_shape)
+    kv = mtf.reshape(kv, kv_shape)
     # augment the keys and values for each block with keys and values for
     # the previous window_size timesteps.
-    k = mtf.left_halo_exchange(k, num_blocks, memory_block_length, window_size)
-    v = mtf.left_halo_exchange(v, num_blocks, memory_block_length, window_size)
+    k, v = _unstack_kv(mtf.left_halo_exchange(
+        kv, num_blocks, memory_block_length, window_size))
+    q = mtf.reshape(
+        mtf.einsum([x, wq],
+                   mtf.Shape(batch_dims + [heads, length, kv_channels])),
+        q_shape)
     padded_memory_block_length = mtf.Dimension(
         "memory_block_length", window_size + block_length)
-    mpos = mtf.range(x.mesh, padded_memory_block_length, tf.float32)
-    qpos = mtf.range(x.mesh, query_block_length, tf.float32) + window_size
-    # prevent looking forward
-    mask = mtf.cast(mtf.greater(mpos, qpos), x.dtype) * -1e9
-    # prevent looking >=block_length timesteps backward
-    mask += mtf.cast(mtf.less_equal(mpos, qpos - block_length), x.dtype) * -1e9
+    mask = mtf.import_fully_replicated(
+        x.mesh,
+        tf.constant(_local_window_bias_values(block_length, window_size),
+                    dtype=x.dtype),
+        mtf.Shape([query_block_length, padded_memory_block_length]),
+        name="local_window_bias")
     # Note: The first window_size-1 positions can see back into pre-time
     # where all the keys and values are zero.  We could mask this out, but we
     # don't.
-    o = dot_product_attention(q, k, v, mask=mask)
+    if head_tile is None or head_tile == heads.size:
+      o = dot_product_attention(q, k, v, mask=mask)
+    else:
+      num_tiles = heads.size // head_tile
+      o = mtf.concat(
+          [dot_product_attention(q_tile, k_tile, v_tile, mask=mask)
+           for q_tile, k_tile, v_tile in zip(
+               mtf.split(q, heads, num_tiles),
+               mtf.split(k, heads, num_tiles),
+               mtf.split(v, heads, num_tiles))],
+          heads.name)
     o = mtf.reshape(o, batch_dims + [heads, length, kv_channels])
     return mtf.einsum([o, wo], mtf.Shape(batch_dims + [length, io_channels]))
 
@@ -954,19 +1351,16 @@ def masked_local_attention_1d_incremental(x,
   heads, window_length, kv_channels = prev_k.shape.dims[-3:]
   with tf.variable_scope(name, default_name="masked_local_attention_1d"):
     if params is None:
-      wq, wk, wv, wo = multihead_attention_vars(
+      w_qkv, wo = multihead_attention_vars(
           x.mesh, heads, io_channels, kv_channels,
-          master_dtype, slice_dtype, x.dtype)
+          master_dtype, slice_dtype, x.dtype, stack_qkv=True)
     else:
-      wq, wk, wv, wo = params
-    q = mtf.einsum([x, wq], mtf.Shape(batch_dims + [heads, kv_channels]))
-    k = mtf.einsum([x, wk], mtf.Shape(batch_dims + [heads, kv_channels]))
-    v = mtf.einsum([x, wv], mtf.Shape(batch_dims + [heads, kv_channels]))
-    current_position = mtf.equal(
-        mtf.range(x.mesh, window_length, dtype=tf.int32),
-        mtf.mod(step_num, window_length.size))
-    k = mtf.where(current_position, k, prev_k, output_shape=prev_k.shape)
-    v = mtf.where(current_position, v, prev_v, output_shape=prev_v.shape)
+      w_qkv, wo = _stack_qkv_params(params)
+    q, k, v = _qkv_einsum(
+        x, w_qkv, mtf.Shape(batch_dims + [heads, kv_channels]))
+    current_position = mtf.mod(step_num, window_length.size)
+    k = mtf.scatter_update(prev_k, current_position, k, window_length)
+    v = mtf.scatter_update(prev_v, current_position, v, window_length)
     o = dot_product_attention(q, k, v, mask=None)
     y = mtf.einsum([o, wo], x.shape)
     return y, k, v
@@ -975,26 +1369,33 @@ def masked_local_attention_1d_incremental(x,
 def local_2d_halo_exchange(k, v, num_h_blocks, h_dim,
                            num_w_blocks, w_dim, mask_right):
   """Halo exchange for keys and values for Local 2D attention."""
+  # Keys and values are exchanged together, halving the number of
+  # communications.
+  return _unstack_kv(_local_2d_halo_exchange_kv(
+      _stack_kv(k, v), num_h_blocks, h_dim, num_w_blocks, w_dim, mask_right))
+
+
+def _local_2d_halo_exchange_kv(kv, num_h_blocks, h_dim,
+                               num_w_blocks, w_dim, mask_right):
+  """local_2d_halo_exchange() on keys and values stacked by _stack_kv()."""
   for blocks_dim, block_size_dim, halo_size in [
       (num_h_blocks, h_dim, h_dim.size),
       (num_w_blocks, w_dim, w_dim.size)]:
-    # shape of k is [num_h_blocks, num_w_blocks, h_dim, w_dim, kv_channels]
+    # shape of kv is
+    # [stacked_kv, num_h_blocks, num_w_blocks, h_dim, w_dim, kv_channels]
     if halo_size > 0:
       if blocks_dim is not None:
         if mask_right:
-          k = mtf.left_halo_exchange(k, blocks_dim, block_size_dim, halo_size)
-          v = mtf.left_halo_exchange(v, blocks_dim, block_size_dim, halo_size)
+          kv = mtf.left_halo_exchange(
+              kv, blocks_dim, block_size_dim, halo_size)
         else:
-          k = mtf.halo_exchange(k, blocks_dim, block_size_dim, halo_size)
-          v = mtf.halo_exchange(v, blocks_dim, block_size_dim, halo_size)
+          kv = mtf.halo_exchange(kv, blocks_dim, block_size_dim, halo_size)
       else:
         if mask_right:
-          k = mtf.pad(k, [halo_size, None], block_size_dim.name)
-          v = mtf.pad(v, [halo_size, None], block_size_dim.name)
+          kv = mtf.pad(kv, [halo_size, 0], block_size_dim.name)
         else:
-          k = mtf.pad(k, [halo_size, halo_size], block_size_dim.name)
-          v = mtf.pad(v, [halo_size, halo_size], block_size_dim.name)
-  return k, v
+          kv = mtf.pad(kv, [halo_size, halo_size], block_size_dim.name)
+  return kv
 
 
 def local_2d_self_attention_spatial_blocks(query_antecedent,
@@ -1039,40 +1440,36 @@ def local_2d_self_attention_spatial_blocks(query_antecedent,
 
     h_dim, w_dim, io_channels = query_antecedent.shape.dims[-3:]
     batch, num_h_blocks, num_w_blocks = query_antecedent.shape.dims[:3]
-    wq, wk, wv, wo = multihead_attention_vars(
+    w_qkv, wo = multihead_attention_vars(
         query_antecedent.mesh, heads, io_channels, kv_channels,
-        master_dtype, slice_dtype, query_antecedent.dtype)
+        master_dtype, slice_dtype, query_antecedent.dtype, stack_qkv=True)
+
+    # Call einsum over the query to get keys k and values v.
+    q_shape = mtf.Shape([batch, heads, num_h_blocks, num_w_blocks, h_dim,
+                         w_dim, kv_channels])
+    wq, kv = _kv_einsum(query_antecedent, w_qkv, q_shape)
 
     # Rename dimensions for the memory height and width.
-    memory_antecedent = mtf.rename_dimension(query_antecedent, h_dim.name,
-                                             "memory_" + h_dim.name)
-    memory_antecedent = mtf.rename_dimension(memory_antecedent, w_dim.name,
-                                             "memory_" + w_dim.name)
-    memory_h_dim, memory_w_dim = memory_antecedent.shape.dims[-3:-1]
-
-    # Call einsum over the query and memory to get query q, keys k and values v.
-    q = mtf.einsum([query_antecedent, wq],
-                   mtf.Shape([
-                       batch, heads, num_h_blocks, num_w_blocks, h_dim, w_dim,
-                       kv_channels
-                   ]))
-    k = mtf.einsum([memory_antecedent, wk],
-                   mtf.Shape([batch, heads, num_h_blocks, num_w_blocks,
-                              memory_h_dim, memory_w_dim, kv_channels]))
-    v = mtf.einsum([memory_antecedent, wv],
-                   mtf.Shape([batch, heads, num_h_blocks, num_w_blocks,
-                              memory_h_dim, memory_w_dim, kv_channels]))
-
-    # Halo exchange for memory blocks.
-    k, v = local_2d_halo_exchange(k, v, num_h_blocks, memory_h_dim,
-                                  num_w_blocks, memory_w_dim, mask_right)
+    kv_shape = kv.shape.rename_dimension(
+        h_dim.name, "memory_" + h_dim.name).rename_dimension(
+            w_dim.name, "memory_" + w_dim.name)
+    kv = mtf.reshape(kv, kv_shape)
+    memory_h_dim, memory_w_dim = kv_shape.dims[-3:-1]
+
+    # Halo exchange for memory blocks, followed by the query einsum, which
+    # does not depend on it.
+    k, v = _unstack_kv(_local_2d_halo_exchange_kv(
+        kv, num_h_blocks, memory_h_dim, num_w_blocks, memory_w_dim,
+        mask_right))
+    q = mtf.einsum([query_antecedent, wq], q_shape)
 
     # Calculate the causal mask to avoid peeking into the future. We compute
     # this once and reuse it for all blocks since the block_size is known.
     mask = None
     if mask_right:
       mask = attention_bias_local_2d_block(query_antecedent.mesh, h_dim, w_dim,
-                                           memory_h_dim, memory_w_dim)
+                                           memory_h_dim, memory_w_dim,
+                                           dtype=query_antecedent.dtype)
 
     output = dot_product_attention(q, k, v, mask=mask)
 
@@ -1089,22 +1486,155 @@ def rename_length_to_memory_length(
 
 def multihead_attention_vars(
     mesh, heads, io_channels, kv_channels,
-    master_dtype, slice_dtype, activation_dtype):
+    master_dtype, slice_dtype, activation_dtype, stack_qkv=False,
+    kv_heads=None):
   """Deprecated version of multihead_attention_params with combine=True."""
   return multihead_attention_params(
       mesh, heads, io_channels, kv_channels,
       mtf.VariableDType(master_dtype, slice_dtype, activation_dtype),
-      combine=True)
+      combine=True, stack_qkv=stack_qkv, kv_heads=kv_heads)
+
+
+def _slice_views(x, dim, begin=0):
+  """Like mtf.unstack(x, dim)[begin:], but with one slice per piece.
+
+  Unlike unstack, which computes all of the pieces in one operation, each
+  piece is only computed if it is used.
+
+  Args:
+    x: a Tensor
+    dim: a Dimension of x
+    begin: an integer - the index of the first piece to return
+
+  Returns:
+    a list of dim.size - begin Tensors, each with shape x.shape - dim
+  """
+  shape = x.shape - dim
+  return [mtf.reshape(mtf.slice(x, i, 1, dim.name), shape)
+          for i in range(begin, dim.size)]
+
+
+def _int8_variable(mesh, name, shape, scale_shape, activation_dtype):
+  """A weight stored as int8 with per-output-channel scales.
+
+  The int8 values and the scales are not trained - they are expected to be
+  restored from a checkpoint of an already-quantized model (see
+  quantize_attention_weights_int8()).  The weight is dequantized (cast and
+  scaled) by separate operations before it is used, so a full copy in the
+  activation dtype is written and read back on every step.  This saves
+  checkpoint and variable storage, not memory traffic.
+
+  Args:
+    mesh: a Mesh
+    name: a string
+    shape: a Shape
+    scale_shape: a Shape - the output channels of the weight
+    activation_dtype: a tf.DType
+
+  Returns:
+    a Tensor with the given shape and dtype activation_dtype
+  """
+  w = mtf.get_variable(
+      mesh, name, shape, initializer=tf.zeros_initializer(),
+      dtype=mtf.VariableDType(tf.int8, tf.int8, tf.int8), trainable=False)
+  scale = mtf.get_variable(
+      mesh, name + "_scale", scale_shape, initializer=tf.ones_initializer(),
+      dtype=mtf.VariableDType(tf.float32, tf.float32, activation_dtype),
+      trainable=False)
+  return mtf.cast(w, activation_dtype) * scale
+
+
+def _quantize_int8(w, reduced_axes):
+  """Symmetric int8 quantization of w with absmax scales.
+
+  Args:
+    w: a float tf.Tensor
+    reduced_axes: a list of integers - the axes of w which share a scale
+
+  Returns:
+    a pair (int8 tf.Tensor with the shape of w, float32 scale tf.Tensor
+      with the other axes of w)
+  """
+  w = tf.cast(w, tf.float32)
+  scale = tf.reduce_max(tf.abs(w), axis=reduced_axes, keepdims=True) / 127.0
+  # All-zero channels get a scale of one rather than dividing by zero.
+  scale = tf.where(scale > 0.0, scale, tf.ones_like(scale))
+  w_int8 = tf.cast(tf.clip_by_value(tf.round(w / scale), -127.0, 127.0),
+                   tf.int8)
+  return w_int8, tf.squeeze(scale, axis=reduced_axes)
+
+
+def quantize_attention_weights_int8(wq, wk, wv, wo):
+  """Convert float attention weights to int8 variable values.
+
+  Produces the values of the variables created by
+  multihead_attention_params(quantize_weights="int8") from the weights of a
+  float model built with combine=False.  Each weight is scaled per output
+  channel by its absolute maximum, so that the largest value maps to 127.
+
+  Args:
+    wq: a tf.Tensor with shape [heads, io_channels, kv_channels]
+    wk: a tf.Tensor with shape [kv_heads, io_channels, kv_channels]
+    wv: a tf.Tensor with shape [kv_heads, io_channels, kv_channels]
+    wo: a tf.Tensor with shape [heads, io_channels, kv_channels]
+
+  Returns:
+    a dictionary from variable name ("q", "q_scale", ..., "o_scale") to
+      tf.Tensor, relative to the variable scope of the attention parameters.
+  """
+  values = {}
+  for name, w, reduced_axes in [("q", wq, [1]), ("k", wk, [1]),
+                                ("v", wv, [1]), ("o", wo, [0, 2])]:
+    values[name], values[name + "_scale"] = _quantize_int8(w, reduced_axes)
+  return values
+
+
+def stacked_normal_initializer(stddevs, axis):
+  """Normal initializer with a different stddev for each slice along axis.
+
+  Args:
+    stddevs: a list of floats, one for each slice
+    axis: an integer - the axis of the variable along which it is stacked
+
+  Returns:
+    an initializer
+  """
+  def initializer(shape, dtype=None, partition_info=None, verify_shape=None):
+    del partition_info, verify_shape
+    stddevs_shape = [1] * len(shape)
+    stddevs_shape[axis] = len(stddevs)
+    return tf.random_normal(shape, dtype=dtype) * tf.reshape(
+        tf.cast(stddevs, dtype or tf.float32), stddevs_shape)
+  return initializer
 
 
 def multihead_attention_params(mesh, heads, io_channels, kv_channels,
-                               variable_dtype, combine=False):
+                               variable_dtype, combine=False, stack_qkv=False,
+                               kv_heads=None, quantize_weights=None):
   """Create Parameters for Multihead Attention.
 
   If the combine flag is set to True, then we create only one variable
   which stacks together all of the parameters.  Otherwise, we create four
   separate variables.
 
+  If the stack_qkv flag is set to True, the query, key and value weights are
+  returned stacked together in one Tensor, so that all three projections can
+  be computed by a single einsum (see _qkv_einsum()).
+
+  If kv_heads is given, the keys and values have kv_heads heads, which are
+  shared by groups of query heads (grouped-query attention).  kv_heads must
+  have a different name from heads, and its size must divide heads.size.
+  With combine=True, the query/output and key/value weights are then stored
+  in two variables.
+
+  If quantize_weights is "int8", the four weights are stored as separate int8
+  variables with float32 per-output-channel scales, and dequantized to the
+  activation dtype before use.  This reduces the size of the checkpoint and
+  of the stored variables, but not the memory traffic of the weights (see
+  _int8_variable()).  These variables are not trainable; this is meant for
+  inference from a quantized checkpoint, whose values can be computed from a
+  float model with quantize_attention_weights_int8().
+
   Args:
     mesh: a Mesh
     heads: a Dimension
@@ -1112,39 +1642,128 @@ def multihead_attention_params(mesh, heads, io_channels, kv_channels,
     kv_channels: a Dimension
     variable_dtype: a mtf.VariableDType
     combine: a boolean
+    stack_qkv: a boolean
+    kv_heads: an optional Dimension
+    quantize_weights: None or "int8"
 
   Returns:
-    wq: a Tensor with shape [heads, io_channels, kv_channels]
-    wk: a Tensor with shape [heads, io_channels, kv_channels]
-    wv: a Tensor with shape [heads, io_channels, kv_channels]
-    wo: a Tensor with shape [heads, io_channels, kv_channels]
+    if stack_qkv is False:
+      wq: a Tensor with shape [heads, io_channels, kv_channels]
+      wk: a Tensor with shape [kv_heads, io_channels, kv_channels]
+      wv: a Tensor with shape [kv_heads, io_channels, kv_channels]
+      wo: a Tensor with shape [heads, io_channels, kv_channels]
+    if stack_qkv is True:
+      w_qkv: a Tensor with shape [qkv, heads, io_channels, kv_channels]
+      wo: a Tensor with shape [heads, io_channels, kv_channels]
+
+  Raises:
+    ValueError: if kv_heads is given together with stack_qkv, or does not
+      divide heads, or if quantize_weights is unknown or given together with
+      combine.
   """
+  if quantize_weights not in (None, "int8"):
+    raise ValueError("unknown quantize_weights=%s" % quantize_weights)
+  if quantize_weights and combine:
+    raise ValueError("quantize_weights is not supported with combine=True")
+  if kv_heads == heads:
+    kv_heads = None
+  if kv_heads is not None:
+    if stack_qkv:
+      raise ValueError("stack_qkv requires kv_heads == heads")
+    if heads.size % kv_heads.size != 0:
+      raise ValueError("kv_heads=%s must divide heads=%s" % (kv_heads, heads))
   qkvo = mtf.Dimension("qkvo", 4)
   qk_stddev = (io_channels.size ** -0.5) * (kv_channels.size ** -0.25)
   v_stddev = io_channels.size ** -0.5
   # TODO(noam): should be: o_stddev = (kv_channels.size * heads.size) ** -0.5
   #   verify that this still works and change it.
   o_stddev = (io_channels.size * heads.size) ** -0.5
-  if combine:
-    def qkvo_initializer(shape,
-                         dtype=None,
-                         partition_info=None,
-                         verify_shape=None):
-      del partition_info, verify_shape
-      return tf.random_normal(shape, dtype=dtype) * tf.reshape(
-          tf.cast([qk_stddev, qk_stddev, v_stddev, o_stddev],
-                  dtype or tf.float32), [4, 1, 1, 1])
+  if quantize_weights == "int8":
+    activation_dtype = variable_dtype.activation_dtype
+    params = [
+        _int8_variable(  # pylint: disable=g-complex-comprehension
+            mesh, name, mtf.Shape([h, io_channels, kv_channels]),
+            mtf.Shape([h, kv_channels]), activation_dtype)
+        for name, h in zip(["q", "k", "v"],
+                           [heads, kv_heads or heads, kv_heads or heads])]
+    params.append(_int8_variable(
+        mesh, "o", mtf.Shape([heads, io_channels, kv_channels]),
+        mtf.Shape([io_channels]), activation_dtype))
+    if stack_qkv:
+      return _stack_qkv_params(params)
+    return params
+  elif combine and kv_heads is not None:
+    qo = mtf.Dimension("qo", 2)
+    kv = mtf.Dimension("kv_weights", 2)
+    wq, wo = _slice_views(mtf.get_variable(
+        mesh, "qo", mtf.Shape([qo, heads, io_channels, kv_channels]),
+        initializer=stacked_normal_initializer([qk_stddev, o_stddev], axis=0),
+        dtype=variable_dtype), qo)
+    wk, wv = _slice_views(mtf.get_variable(
+        mesh, "kv", mtf.Shape([kv, kv_heads, io_channels, kv_channels]),
+        initializer=stacked_normal_initializer([qk_stddev, v_stddev], axis=0),
+        dtype=variable_dtype), kv)
+    return [wq, wk, wv, wo]
+  elif combine:
     var = mtf.get_variable(
         mesh, "qkvo", mtf.Shape([qkvo, heads, io_channels, kv_channels]),
-        initializer=qkvo_initializer, dtype=variable_dtype)
-    return mtf.unstack(var, qkvo)
+        initializer=stacked_normal_initializer(
+            [qk_stddev, qk_stddev, v_stddev, o_stddev], axis=0),
+        dtype=variable_dtype)
+    if stack_qkv:
+      # The first three slices of the combined variable are already stacked.
+      return (mtf.slice(var, 0, 3, qkvo.name),
+              _slice_views(var, qkvo, begin=3)[0])
+    return _slice_views(var, qkvo)
   else:
-    return [mtf.get_variable(  # pylint: disable=g-complex-comprehension
-        mesh, name, mtf.Shape([heads, io_channels, kv_channels]),
+    params = [mtf.get_variable(  # pylint: disable=g-complex-comprehension
+        mesh, name, mtf.Shape([h, io_channels, kv_channels]),
         initializer=tf.random_normal_initializer(stddev=stddev),
-        dtype=variable_dtype) for name, stddev in zip(
+        dtype=variable_dtype) for name, h, stddev in zip(
             ["q", "k", "v", "o"],
+            [heads, kv_heads or heads, kv_heads or heads, heads],
             [qk_stddev, qk_stddev, v_stddev, o_stddev])]
+    if stack_qkv:
+      return _stack_qkv_params(params)
+    return params
+
+
+def _stack_qkv_params(params):
+  """Stack the query, key and value weights of a quadruple of parameters.
+
+  Args:
+    params: a quadruple of Tensors (see multihead_attention_params())
+
+  Returns:
+    w_qkv: a Tensor with shape [qkv, heads, io_channels, kv_channels]
+    wo: a Tensor with shape [heads, io_channels, kv_channels]
+  """
+  wq, wk, wv, wo = params
+  return mtf.stack([wq, wk, wv], "qkvo", axis=0), wo
+
+
+def _qkv_einsum(x, w_qkv, shape):
+  """Compute queries, keys and values with a single einsum.
+
+  The input activations are read once, rather than once per projection.
+
+  Args:
+    x: a Tensor
+    w_qkv: a Tensor with shape [qkv, heads, io_channels, kv_channels]
+    shape: a mtf.Shape containing heads - the shape of each of q, k and v
+
+  Returns:
+    q: a Tensor with shape shape
+    k: a Tensor with shape shape
+    v: a Tensor with shape shape
+  """
+  qkv_dim = w_qkv.shape.dims[0]
+  heads_index = shape.dims.index(w_qkv.shape.dims[1])
+  qkv = mtf.einsum(
+      [x, w_qkv],
+      mtf.Shape(shape.dims[:heads_index] + [qkv_dim] +
+                shape.dims[heads_index:]))
+  return mtf.unstack(qkv, qkv_dim)
 
 
 def dot_product_attention(q,
@@ -1153,9 +1772,20 @@ def dot_product_attention(q,
                           mask,
                           dropout=0.0,
                           dropout_broadcast_dims=None,
-                          extra_logit=None):
+                          extra_logit=None,
+                          use_flash_attention=False,
+                          num_kv_chunks=1,
+                          attention_compute_dtype=None):
   """Dot-product attention.
 
+  If use_flash_attention is set, and there is no dropout or extra_logit, the
+  attention is computed by mtf.flash_attention(), which does not store the
+  attention weights.  This requires that length_kv and depth_k are not split.
+
+  Otherwise, if attention_compute_dtype is given (e.g. tf.bfloat16), the two
+  matmuls are computed in that dtype, while the logits and the softmax are
+  computed in float32.  The result is cast back to the dtype of q.
+
   Args:
     q: Tensor with shape [...., length_q, depth_k]. Typically leading dimensions
       are [batch, heads].
@@ -1165,26 +1795,58 @@ def dot_product_attention(q,
       match with q.
     mask: mask Tensor (see attention_mask())
     dropout: a float.
-    dropout_broadcast_dims: an optional list of mtf.Dimension
+    dropout_broadcast_dims: an optional list of mtf.Dimension.  Including
+      length_kv shrinks the dropout noise to [..., length_q], and the dropout
+      is then applied to the outputs instead of the weights.
     extra_logit: an optional scalar or tensor
+    use_flash_attention: a boolean
+    num_kv_chunks: an integer - see mtf.flash_attention()
+    attention_compute_dtype: an optional tf.DType for the matmuls
 
   Returns:
     Tensor with shape [..., length_q, depth_v].
   """
+  if use_flash_attention and dropout == 0.0 and extra_logit is None:
+    return mtf.flash_attention(q, k, v, mask=mask, num_kv_chunks=num_kv_chunks)
+  output_dtype = q.dtype
+  if attention_compute_dtype is not None:
+    q = mtf.cast(q, attention_compute_dtype)
+    k = mtf.cast(k, attention_compute_dtype)
+    v = mtf.cast(v, attention_compute_dtype)
   length_kv = k.shape.dims[-2]
   logits_shape = mtf.Shape(q.shape.dims[:-1] + [length_kv])
   logits = mtf.einsum([q, k], logits_shape)
-  if mask is not None:
-    logits += mask
-  weights = mtf.softmax(logits, length_kv, extra_logit=extra_logit)
-  if dropout != 0.0:
+  if attention_compute_dtype is not None:
+    logits = mtf.cast(logits, tf.float32)
+    if mask is not None:
+      mask = mtf.cast(mask, tf.float32)
+    if isinstance(extra_logit, mtf.Tensor):
+      extra_logit = mtf.cast(extra_logit, tf.float32)
+  if mask is not None and extra_logit is None:
+    # The mask is added inside the softmax, so the masked logits are never
+    # written out.
+    weights = mtf.masked_softmax(logits, mask, length_kv)
+  else:
+    if mask is not None:
+      logits += mask
+    weights = mtf.softmax(logits, length_kv, extra_logit=extra_logit)
+  # If the dropout noise is shared over length_kv, then dropping out the
+  # weights is the same as dropping out the (smaller) outputs.
+  dropout_outputs = (
+      dropout != 0.0 and length_kv in (dropout_broadcast_dims or []))
+  if dropout != 0.0 and not dropout_outputs:
     weights = mtf.dropout(
         weights, 1.0 - dropout,
         noise_shape=weights.shape - dropout_broadcast_dims)
+  weights = mtf.cast(weights, v.dtype)
   depth_v = v.shape.dims[-1]
   outputs_shape = mtf.Shape(q.shape.dims[:-1] + [depth_v])
   outputs = mtf.einsum([weights, v], outputs_shape)
-  return outputs
+  if dropout_outputs:
+    outputs = mtf.dropout(
+        outputs, 1.0 - dropout,
+        noise_shape=weights.shape - dropout_broadcast_dims)
+  return mtf.cast(outputs, output_dtype)
 
 
 def multihead_attention(query_antecedent,
@@ -1208,7 +1870,8 @@ def multihead_attention(query_antecedent,
     query_antecedent: a mtf.Tensor with shape
       [<batch_dims>, query_length, io_channels]
     memory_antecedent: a mtf.Tensor with shape
-      [batch, memory_length, io_channels] (optional)
+      [batch, memory_length, io_channels] (optional).  None or
+      query_antecedent itself means self-attention.
     mask: mask Tensor (see attention_mask())
     kv_channels: a mtf.Dimension (the size of the key and value vectors)
     heads: a mtf.Dimension (the number of heads)
@@ -1229,40 +1892,73 @@ def multihead_attention(query_antecedent,
   with tf.variable_scope(name,
                          default_name="multihead_attention",
                          values=[query_antecedent, memory_antecedent]):
-    wq, wk, wv, wo = multihead_attention_vars(
+    w_qkv, wo = multihead_attention_vars(
         query_antecedent.mesh, heads, io_channels, kv_channels,
-        master_dtype, slice_dtype, query_antecedent.dtype)
-    if memory_antecedent is None:
-      memory_antecedent = rename_length_to_memory_length(
-          query_antecedent, query_length.name)
-    memory_batch_dims = memory_antecedent.shape.dims[:-2]
-    memory_length, memory_channels = memory_antecedent.shape.dims[-2:]
-    if memory_batch_dims != batch_dims:
-      raise ValueError("memory batch must equal query batch")
-    if memory_channels != io_channels:
-      raise ValueError("memory channels must equal query channels")
-    q = mtf.einsum(
-        [query_antecedent, wq],
-        mtf.Shape(batch_dims + [heads, query_length, kv_channels]))
-    k = mtf.einsum(
-        [memory_antecedent, wk],
-        mtf.Shape(batch_dims + [heads, memory_length, kv_channels]))
-    v = mtf.einsum(
-        [memory_antecedent, wv],
-        mtf.Shape(batch_dims + [heads, memory_length, kv_channels]))
+        master_dtype, slice_dtype, query_antecedent.dtype, stack_qkv=True)
+    if memory_antecedent is None or memory_antecedent is query_antecedent:
+      # Self-attention: compute q, k and v with one einsum, then give k and v
+      # the memory_length dimension.
+      q, k, v = _qkv_einsum(
+          query_antecedent, w_qkv,
+          mtf.Shape(batch_dims + [heads, query_length, kv_channels]))
+      k = rename_length_to_memory_length(k, query_length.name)
+      v = rename_length_to_memory_length(v, query_length.name)
+    else:
+      memory_batch_dims = memory_antecedent.shape.dims[:-2]
+      memory_length, memory_channels = memory_antecedent.shape.dims[-2:]
+      if memory_batch_dims != batch_dims:
+        raise ValueError("memory batch must equal query batch")
+      if memory_channels != io_channels:
+        raise ValueError("memory channels must equal query channels")
+      wq, wk, wv = _slice_views(w_qkv, w_qkv.shape.dims[0])
+      q = mtf.einsum(
+          [query_antecedent, wq],
+          mtf.Shape(batch_dims + [heads, query_length, kv_channels]))
+      k = mtf.einsum(
+          [memory_antecedent, wk],
+          mtf.Shape(batch_dims + [heads, memory_length, kv_channels]))
+      v = mtf.einsum(
+          [memory_antecedent, wv],
+          mtf.Shape(batch_dims + [heads, memory_length, kv_channels]))
     o = dot_product_attention(
         q, k, v, mask, dropout, dropout_broadcast_dims)
     return mtf.einsum(
         [o, wo], mtf.Shape(batch_dims + [query_length, io_channels]))
 
 
+def _decode_step_bias(mesh, memory_length, step_num, dtype):
+  """Bias hiding the memory positions after step_num.
+
+  The comparison, cast and scaling happen in a single slicewise op.
+
+  Args:
+    mesh: a Mesh
+    memory_length: a mtf.Dimension
+    step_num: mtf Scalar with dtype tf.int32
+    dtype: a tf.dtype
+
+  Returns:
+    a mtf.Tensor with shape [memory_length]
+  """
+  positions = mtf.range(mesh, memory_length, dtype=tf.int32)
+  return mtf.slicewise(
+      lambda p, s: tf.cast(tf.greater(p, s), dtype) * -1e9,
+      [positions, step_num],
+      output_shape=mtf.Shape([memory_length]),
+      output_dtype=dtype,
+      splittable_dims=[memory_length],
+      grad_function=0,
+      name="decode_step_bias")
+
+
 def multihead_self_attention_incremental(query_antecedent,
                                          prev_k,
                                          prev_v,
                                          step_num,
                                          master_dtype,
                                          slice_dtype,
-                                         name="multihead_attention"):
+                                         name="multihead_attention",
+                                         heads=None):
   """Incremental self-attention (one decode step).
 
   In order to use only one variable containing the four weight matrices
@@ -1270,52 +1966,69 @@ def multihead_self_attention_incremental(query_antecedent,
   same dimensionality (io_channels) and that the keys and values have the
   same dimensionality (kv_channels).
 
+  If heads is given and differs from the heads dimension of prev_k, then the
+  cache holds only the (fewer) key/value heads, each of which is shared by a
+  group of query heads (grouped-query attention).
+
   Args:
     query_antecedent: a mtf.Tensor with shape [batch..., io_channels]
-    prev_k: mtf.Tensor with shape [batch..., heads, memory_length, kv_channels]
-    prev_v: mtf.Tensor with shape [batch..., heads, memory_length, kv_channels]
+    prev_k: mtf.Tensor with shape
+      [batch..., kv_heads, memory_length, kv_channels]
+    prev_v: mtf.Tensor with shape
+      [batch..., kv_heads, memory_length, kv_channels]
     step_num: mtf Scalar with dtype tf.int32
     master_dtype: a tf.dtype
     slice_dtype: a tf.dtype
     name: an optional string.
+    heads: an optional mtf.Dimension (the number of query heads) - defaults
+      to kv_heads.
 
   Returns:
     y: A mtf.Tensor with shape [batch..., io_channels]
-    new_k: mtf.Tensor with shape [batch..., heads, memory_length, kv_channels]
-    new_v: mtf.Tensor with shape [batch..., heads, memory_length, kv_channels]
+    new_k: mtf.Tensor with shape
+      [batch..., kv_heads, memory_length, kv_channels]
+    new_v: mtf.Tensor with shape
+      [batch..., kv_heads, memory_length, kv_channels]
 
   Raises:
     ValueError: if the dimensions do not match.
   """
   batch_dims = query_antecedent.shape.dims[:-1]
   io_channels = query_antecedent.shape.dims[-1]
-  heads, memory_length, kv_channels = prev_k.shape.dims[-3:]
+  kv_heads, memory_length, kv_channels = prev_k.shape.dims[-3:]
+  heads = heads or kv_heads
   with tf.variable_scope(name, default_name="multihead_attention"):
-    wq, wk, wv, wo = multihead_attention_vars(
-        query_antecedent.mesh, heads, io_channels, kv_channels,
-        master_dtype, slice_dtype, query_antecedent.dtype)
-    memory_antecedent = query_antecedent
-    q = mtf.einsum(
-        [query_antecedent, wq],
-        mtf.Shape(batch_dims + [heads, kv_channels]))
-    k = mtf.einsum(
-        [memory_antecedent, wk],
-        mtf.Shape(batch_dims + [heads, kv_channels]))
-    v = mtf.einsum(
-        [memory_antecedent, wv],
-        mtf.Shape(batch_dims + [heads, kv_channels]))
-    k = prev_k + mtf.multiply(
-        k, mtf.one_hot(step_num, memory_length, dtype=prev_k.dtype),
-        output_shape=prev_k.shape)
-    v = prev_v + mtf.multiply(
-        v, mtf.one_hot(step_num, memory_length, dtype=prev_v.dtype),
-        output_shape=prev_v.shape)
-
-    mask = mtf.cast(
-        mtf.greater(mtf.range(
-            query_antecedent.mesh, memory_length, dtype=tf.int32), step_num),
-        q.dtype) * -1e9
+    if heads == kv_heads:
+      w_qkv, wo = multihead_attention_vars(
+          query_antecedent.mesh, heads, io_channels, kv_channels,
+          master_dtype, slice_dtype, query_antecedent.dtype, stack_qkv=True)
+      q, k, v = _qkv_einsum(
+          query_antecedent, w_qkv,
+          mtf.Shape(batch_dims + [heads, kv_channels]))
+    else:
+      wq, wk, wv, wo = multihead_attention_vars(
+          query_antecedent.mesh, heads, io_channels, kv_channels,
+          master_dtype, slice_dtype, query_antecedent.dtype,
+          kv_heads=kv_heads)
+      q = mtf.einsum([query_antecedent, wq],
+                     mtf.Shape(batch_dims + [heads, kv_channels]))
+      k = mtf.einsum([query_antecedent, wk],
+                     mtf.Shape(batch_dims + [kv_heads, kv_channels]))
+      v = mtf.einsum([query_antecedent, wv],
+                     mtf.Shape(batch_dims + [kv_heads, kv_channels]))
+      # Split the query heads into groups, one per key/value head, so that
+      # the logits einsum broadcasts k and v across each group.
+      q = mtf.reshape(q, batch_dims + [
+          kv_heads, mtf.Dimension("query_heads_per_kv_head",
+                                  heads.size // kv_heads.size), kv_channels])
+    k = mtf.scatter_update(prev_k, step_num, k, memory_length)
+    v = mtf.scatter_update(prev_v, step_num, v, memory_length)
+
+    mask = _decode_step_bias(
+        query_antecedent.mesh, memory_length, step_num, q.dtype)
     o = dot_product_attention(q, k, v, mask)
+    if heads != kv_heads:
+      o = mtf.reshape(o, batch_dims + [heads, kv_channels])
     y = mtf.einsum([o, wo], query_antecedent.shape)
     return y, k, v
 
@@ -1400,33 +2113,60 @@ def attention_mask_same_segment(
   return mtf.cast(mtf.not_equal(query_segment, memory_segment), dtype) * -1e9
 
 
+@functools.lru_cache(maxsize=None)
+def _local_block_bias_values(block_sizes):
+  """Values of a causal bias for local block attention.
+
+  Each query position attends to the block containing it and to the
+  preceding block in each dimension, so the memory is twice as long as the
+  block in each dimension.  A memory position is visible if it precedes or
+  equals the query position in raster order.
+
+  Args:
+    block_sizes: a tuple of one or two integers
+
+  Returns:
+    a nested tuple of floats with shape block_sizes + [2 * b for b in
+    block_sizes]
+  """
+  if len(block_sizes) == 1:
+    block_length, = block_sizes
+    return tuple(tuple(-1e9 if m - block_length > q else 0.0
+                       for m in range(2 * block_length))
+                 for q in range(block_length))
+  h, w = block_sizes
+  return tuple(tuple(tuple(tuple(-1e9 if (mh - h, mw - w) > (qh, qw) else 0.0
+                                 for mw in range(2 * w))
+                           for mh in range(2 * h))
+                     for qw in range(w))
+               for qh in range(h))
+
+
 def attention_bias_local_block(mesh, block_length, memory_length,
                                dtype=tf.int32):
   """Bias for attention for local blocks where attention to right is disallowed.
 
-  Create the bias matrix by using two separate masks, one for the memory part
-  which doesn't overlap with the query and second which interacts with the query
-  and should be disallowed to look to the right of the current query position.
+  The memory consists of the previous block, which is fully visible, followed
+  by the current block, in which attention to the right of the current query
+  position is disallowed.  The bias only depends on the block length, so it is
+  computed once and imported as a constant.
 
   Args:
     mesh: a MeshTensorflow object
     block_length: a mtf.Dimension
     memory_length: a mtf.Dimension
-    dtype: a tf.dtype
+    dtype: a tf.dtype - tf.float32 is used unless this is a floating type
 
   Returns:
     a mtf.Tensor with shape [block_length, memory_length]
   """
-  memory_length = mtf.Dimension(memory_length.name, block_length.size)
-  memory_mask = mtf.zeros(mesh, [block_length, memory_length], dtype=dtype)
-
-  mask = mtf.cast(mtf.less(mtf.range(mesh, block_length, dtype=dtype),
-                           mtf.range(mesh, memory_length, dtype=dtype)),
-                  dtype=dtype)
-  mask = mtf.cast(
-      mtf.concat([memory_mask, mask], memory_length.name),
-      dtype=tf.float32) * -1e9
-  return mask
+  if not dtype.is_floating:
+    dtype = tf.float32
+  memory_length = mtf.Dimension(memory_length.name, 2 * block_length.size)
+  return mtf.import_fully_replicated(
+      mesh, tf.constant(_local_block_bias_values((block_length.size,)),
+                        dtype=dtype),
+      mtf.Shape([block_length, memory_length]), name="local_block_bias")
 
 
 def attention_bias_local_2d_block(mesh,
@@ -1437,9 +2177,10 @@ def attention_bias_local_2d_block(mesh,
                                   dtype=tf.int32):
   """Bias for attention for local blocks where attention to right is disallowed.
 
-  Create the bias matrix by using two separate masks, one for the memory part
-  which doesn't overlap with the query and second which interacts with the query
-  and should be disallowed to look to the right of the current query position.
+  The memory consists of the previous and current blocks in each of the
+  height and width dimensions.  Memory positions after the current query
+  position in raster order are disallowed.  The bias only depends on the
+  block sizes, so it is computed once and imported as a constant.
 
   Args:
     mesh: a MeshTensorflow object
@@ -1447,23 +2188,20 @@ def attention_bias_local_2d_block(mesh,
     w_dim: a mtf.Dimension
     memory_h_dim: a mtf.Dimension
     memory_w_dim: a mtf.Dimension
-    dtype: a tf.dtype
+    dtype: a tf.dtype - tf.float32 is used unless this is a floating type
 
   Returns:
-    a mtf.Tensor with shape [block_length, memory_length]
+    a mtf.Tensor with shape [h_dim, w_dim, memory_h_dim, memory_w_dim]
   """
-  memory_height = mtf.Dimension(memory_h_dim.name, h_dim.size)
-  memory_width = mtf.Dimension(memory_w_dim.name, w_dim.size)
-  mask_top_visible = mtf.zeros(mesh, [h_dim, memory_height], dtype=dtype)
-  mask_left_visible = mtf.zeros(mesh, [w_dim, memory_width], dtype=dtype)
-  mask_query = mtf.greater(
-      mtf.range(mesh, memory_height, dtype=tf.int32),
-      mtf.range(mesh, memory_width, dtype=dtype))
-  width_mask = mtf.concat([mask_left_visible, mask_query], memory_width.name)
-  mask = mtf.cast(
-      mtf.concat([mask_top_visible, width_mask], memory_height.name),
-      dtype=tf.float32) * -1e9
-  return mask
+  if not dtype.is_floating:
+    dtype = tf.float32
+  memory_height = mtf.Dimension(memory_h_dim.name, 2 * h_dim.size)
+  memory_width = mtf.Dimension(memory_w_dim.name, 2 * w_dim.size)
+  return mtf.import_fully_replicated(
+      mesh, tf.constant(_local_block_bias_values((h_dim.size, w_dim.size)),
+                        dtype=dtype),
+      mtf.Shape([h_dim, w_dim, memory_height, memory_width]),
+      name="local_2d_block_bias")
 
 
 def multiplicative_jitter(x, epsilon=1e-2):
@@ -1481,8 +2219,7 @@ def multiplicative_jitter(x, epsilon=1e-2):
   """
   if epsilon == 0:
     return x
-  return x * mtf.random_uniform(
-      x.mesh, x.shape, minval=1.0 - epsilon, maxval=1.0+epsilon, dtype=x.dtype)
+  return mtf.random_scale(x, 1.0 - epsilon, 1.0 + epsilon)
 
 
 def multihead_self_attention_memory_compressed(x,
@@ -1540,11 +2277,8 @@ def multihead_self_attention_memory_compressed(x,
         [memory_antecedent, wv],
         mtf.Shape(batch_dims + [heads, memory_length, kv_channels]))
     if mask_right:
-      query_pos = mtf.range(x.mesh, length, dtype=tf.int32)
-      memory_pos = (
-          mtf.range(x.mesh, memory_length, dtype=tf.int32) * compression_factor
-          + (compression_factor - 1))
-      mask = mtf.cast(mtf.greater(memory_pos, query_pos), x.dtype) * -1e9
+      mask = compressed_causal_bias(
+          x.mesh, length, memory_length, compression_factor, x.dtype)
     else:
       mask = None
     o = dot_product_attention(
@@ -1553,9 +2287,46 @@ def multihead_self_attention_memory_compressed(x,
         [o, wo], mtf.Shape(batch_dims + [length, io_channels]))
 
 
+def compressed_causal_bias(mesh, length, memory_length, compression_factor,
+                           dtype):
+  """Causal bias for attention to memory compressed by compression_factor.
+
+  Memory position m summarizes positions [m * compression_factor,
+  (m + 1) * compression_factor), so query position q may only attend to it
+  if (m + 1) * compression_factor - 1 <= q.  The comparison, cast and scaling
+  happen in a single slicewise op.
+
+  Args:
+    mesh: a Mesh
+    length: a mtf.Dimension
+    memory_length: a mtf.Dimension
+    compression_factor: an integer
+    dtype: a tf.dtype
+
+  Returns:
+    a mtf.Tensor with shape [length, memory_length]
+  """
+  def slicewise_fn(query_pos, memory_pos):
+    last_pos = memory_pos * compression_factor + (compression_factor - 1)
+    return tf.cast(tf.greater(last_pos, tf.expand_dims(query_pos, 1)),
+                   dtype) * -1e9
+  return mtf.slicewise(
+      slicewise_fn,
+      [mtf.range(mesh, length, dtype=tf.int32),
+       mtf.range(mesh, memory_length, dtype=tf.int32)],
+      output_shape=mtf.Shape([length, memory_length]),
+      output_dtype=dtype,
+      splittable_dims=[length, memory_length],
+      grad_function=0,
+      name="compressed_causal_bias")
+
+
 def compress_mean(x, dim, compression_factor):
   """Compress by taking group means.
 
+  The mean is computed as one einsum against a constant averaging vector, so
+  the scaling happens inside the reduction.
+
   Args:
     x: a Tensor
     dim: a dimension in x.shape
@@ -1572,25 +2343,48 @@ def compress_mean(x, dim, compression_factor):
   new_shape = (
       dims[:pos] + [compressed_dim, compression_factor_dim] + dims[pos + 1:])
   x = mtf.reshape(x, new_shape)
-  x = mtf.reduce_mean(x, reduced_dim=compression_factor_dim)
-  return x
+  averaging_vector = mtf.constant(
+      x.mesh, 1.0 / compression_factor, shape=[compression_factor_dim],
+      dtype=x.dtype)
+  return mtf.einsum([x, averaging_vector],
+                    reduced_dims=[compression_factor_dim])
 
 
 def embedding_weights(
     mesh, vocab_dim, output_dim, variable_dtype, name="embedding",
-    ensemble_dim=None):
+    ensemble_dim=None, initializer=None):
+  """Embedding weights.
+
+  Args:
+    mesh: a Mesh
+    vocab_dim: a Dimension
+    output_dim: a Dimension
+    variable_dtype: a mtf.VariableDType
+    name: a string
+    ensemble_dim: an optional Dimension
+    initializer: an optional initializer.  Defaults to a unit normal, which
+      models with shared embedding and softmax weights rely on.  For example,
+      tf.truncated_normal_initializer(stddev=output_dim.size ** -0.5) gives
+      unit-norm embeddings with no wide tails.
+  Returns:
+    a Tensor with shape [<ensemble_dim>, vocab_dim, output_dim]
+  """
   shape = mtf.Shape(
       [ensemble_dim] if ensemble_dim else []) + [vocab_dim, output_dim]
+  if initializer is None:
+    initializer = tf.random_normal_initializer()
   ret = mtf.get_variable(
       mesh, name, shape,
-      dtype=variable_dtype, initializer=tf.random_normal_initializer())
+      dtype=variable_dtype, initializer=initializer)
   return ret
 
 
-def embedding(indices, vocab_dim, output_dim, variable_dtype, name="embedding"):
+def embedding(indices, vocab_dim, output_dim, variable_dtype, name="embedding",
+              initializer=None):
   """Embedding layer."""
   weights = embedding_weights(
-      indices.mesh, vocab_dim, output_dim, variable_dtype, name)
+      indices.mesh, vocab_dim, output_dim, variable_dtype, name,
+      initializer=initializer)
   return mtf.gather(weights, indices, vocab_dim)
 
 
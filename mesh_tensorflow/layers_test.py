@@ -99,6 +99,72 @@ class LayersTest(parameterized.TestCase, tf.test.TestCase):
 
     self.assertEqual(actual.shape, expected.shape)
 
+  @parameterized.parameters((False,), (True,))
+  def testLayerNormXlaFlag(self, use_xla):
+    # pylint: disable=protected-access
+    self.addCleanup(setattr, mtf.layers, "_USE_XLA", mtf.layers._USE_XLA)
+    mtf.layers._USE_XLA = use_xla
+    # pylint: enable=protected-access
+    inputs = tf.random_normal([2, 3])
+
+    graph = mtf.Graph()
+    mesh = mtf.Mesh(graph, "my_mesh")
+    batch_dim = mtf.Dimension("batch", 2)
+    channels_dim = mtf.Dimension("channels", 3)
+
+    mtf_inputs = mtf.import_tf_tensor(
+        mesh, inputs, shape=mtf.Shape([batch_dim, channels_dim]))
+    mtf_outputs = mtf.layers.layer_norm(mtf_inputs, dim=channels_dim)
+    mean = mtf.reduce_mean(mtf_inputs, reduced_dim=channels_dim)
+    variance = mtf.reduce_mean(
+        mtf.square(mtf_inputs - mean), reduced_dim=channels_dim)
+    expected_outputs = (mtf_inputs - mean) * mtf.rsqrt(variance + 1e-6)
+    mesh_impl = mtf.placement_mesh_impl.PlacementMeshImpl(
+        shape=[], layout={}, devices=[""])
+    lowering = mtf.Lowering(graph, {mesh: mesh_impl})
+    actual_outputs = lowering.export_to_tf_tensor(mtf_outputs)
+    expected_outputs = lowering.export_to_tf_tensor(expected_outputs)
+
+    # Only the flag puts ops into an XLA cluster.
+    compiled_ops = [op for op in actual_outputs.graph.get_operations()
+                    if "_XlaCompile" in op.node_def.attr]
+    self.assertEqual(bool(compiled_ops), use_xla)
+
+    tf_group = lowering.copy_masters_to_slices()
+    init = tf.global_variables_initializer()
+    self.evaluate(init)
+    self.evaluate(tf_group)
+    actual, expected = self.evaluate([actual_outputs, expected_outputs])
+
+    self.assertAllClose(actual, expected, rtol=1e-5, atol=1e-5)
+
+  @parameterized.parameters((False,), (True,))
+  def testDenseXlaFlag(self, use_xla):
+    # pylint: disable=protected-access
+    self.addCleanup(setattr, mtf.layers, "_USE_XLA", mtf.layers._USE_XLA)
+    mtf.layers._USE_XLA = use_xla
+    # pylint: enable=protected-access
+    graph = mtf.Graph()
+    mesh = mtf.Mesh(graph, "my_mesh")
+    batch_dim = mtf.Dimension("batch", 2)
+    channels_dim = mtf.Dimension("channels", 3)
+    depth_dim = mtf.Dimension("depth", 4)
+
+    mtf_inputs = mtf.import_tf_tensor(
+        mesh, tf.random_normal([2, 3]),
+        shape=mtf.Shape([batch_dim, channels_dim]))
+    mtf_outputs = mtf.layers.dense(
+        mtf_inputs, depth_dim, activation=mtf.relu, use_bias=True)
+    mesh_impl = mtf.placement_mesh_impl.PlacementMeshImpl(
+        shape=[], layout={}, devices=[""])
+    lowering = mtf.Lowering(graph, {mesh: mesh_impl})
+    actual_outputs = lowering.export_to_tf_tensor(mtf_outputs)
+
+    # The bias add and relu are put into an XLA cluster with the flag only.
+    compiled_ops = [op for op in actual_outputs.graph.get_operations()
+                    if "_XlaCompile" in op.node_def.attr]
+    self.assertEqual(bool(compiled_ops), use_xla)
+
   @test_utils.run_in_graph_and_eager_modes()
   def testBatchNorm(self):
     batch = 2
@@ -163,6 +229,50 @@ class LayersTest(parameterized.TestCase, tf.test.TestCase):
 
     self.assertAllEqual(actual, expected)
 
+  @test_utils.run_in_graph_and_eager_modes()
+  def testWeightsNonzeroMul(self):
+    inputs = tf.constant([[3, 1, 0], [1, 0, 0]])
+    values = tf.constant([[1., 2., 3.], [4., 5., 6.]])
+
+    graph = mtf.Graph()
+    mesh = mtf.Mesh(graph, "my_mesh")
+    batch_dim = mtf.Dimension("batch", inputs.shape.as_list()[0])
+    channels_dim = mtf.Dimension("channels", inputs.shape.as_list()[1])
+    shape = mtf.Shape([batch_dim, channels_dim])
+
+    mtf_inputs = mtf.import_tf_tensor(mesh, inputs, shape=shape)
+    mtf_values = mtf.import_tf_tensor(mesh, values, shape=shape)
+    mtf_outputs = mtf.layers.weights_nonzero_mul(mtf_inputs, mtf_values)
+    mesh_impl = mtf.placement_mesh_impl.PlacementMeshImpl(
+        shape=[], layout={}, devices=[""])
+    lowering = mtf.Lowering(graph, {mesh: mesh_impl})
+    actual_outputs = lowering.export_to_tf_tensor(mtf_outputs)
+
+    tf_group = lowering.copy_masters_to_slices()
+    self.evaluate(tf_group)
+    actual = self.evaluate(actual_outputs)
+
+    self.assertAllEqual(actual, [[1., 2., 0.], [4., 0., 0.]])
+
+  @test_utils.run_in_graph_and_eager_modes()
+  def testAttentionBiasLocalBlock(self):
+    graph = mtf.Graph()
+    mesh = mtf.Mesh(graph, "my_mesh")
+    block_length = mtf.Dimension("block_length", 2)
+    memory_length = mtf.Dimension("memory_length", 4)
+    mtf_outputs = mtf.layers.attention_bias_local_block(
+        mesh, block_length, memory_length)
+    mesh_impl = mtf.placement_mesh_impl.PlacementMeshImpl(
+        shape=[], layout={}, devices=[""])
+    lowering = mtf.Lowering(graph, {mesh: mesh_impl})
+    actual_outputs = lowering.export_to_tf_tensor(mtf_outputs)
+
+    tf_group = lowering.copy_masters_to_slices()
+    self.evaluate(tf_group)
+    actual = self.evaluate(actual_outputs)
+
+    self.assertAllEqual(actual, [[0., 0., 0., -1e9], [0., 0., 0., 0.]])
+
   @test_utils.run_in_graph_and_eager_modes()
   def testDenseReluDense(self):
     batch = 2
@@ -193,6 +303,48 @@ class LayersTest(parameterized.TestCase, tf.test.TestCase):
 
     self.assertEqual(actual.shape, inputs.shape)
 
+  @parameterized.parameters((1,), (2,), (4,))
+  def testDenseReluDenseMatchesTwoDense(self, num_hidden_chunks):
+    batch = 2
+    channels = 3
+    hidden = 8
+    inputs = tf.random_normal([batch, channels])
+
+    graph = mtf.Graph()
+    mesh = mtf.Mesh(graph, "my_mesh")
+    batch_dim = mtf.Dimension("batch", batch)
+    channels_dim = mtf.Dimension("channels", channels)
+    hidden_dim = mtf.Dimension("hidden", hidden)
+
+    mtf_inputs = mtf.import_tf_tensor(
+        mesh, inputs, shape=mtf.Shape([batch_dim, channels_dim]))
+    mtf_outputs = mtf.layers.dense_relu_dense(
+        mtf_inputs, hidden_channels=hidden_dim, fused=True,
+        num_hidden_chunks=num_hidden_chunks, name="ffn")
+    with tf.variable_scope("ffn", reuse=True):
+      h = mtf.layers.dense(mtf_inputs, hidden_dim, use_bias=False,
+                           activation=mtf.relu, name="wi")
+      expected_outputs = mtf.layers.dense(h, channels_dim, use_bias=False,
+                                          name="wo")
+    self.assertLen(graph.trainable_variables, 2)
+    [actual_grad] = mtf.gradients([mtf.reduce_sum(mtf_outputs)], [mtf_inputs])
+    [expected_grad] = mtf.gradients(
+        [mtf.reduce_sum(expected_outputs)], [mtf_inputs])
+    mesh_impl = mtf.placement_mesh_impl.PlacementMeshImpl(
+        shape=[], layout={}, devices=[""])
+    lowering = mtf.Lowering(graph, {mesh: mesh_impl})
+    tf_tensors = [lowering.export_to_tf_tensor(t) for t in
+                  [mtf_outputs, expected_outputs, actual_grad, expected_grad]]
+
+    tf_group = lowering.copy_masters_to_slices()
+    init = tf.global_variables_initializer()
+    self.evaluate(init)
+    self.evaluate(tf_group)
+    actual, expected, actual_grad, expected_grad = self.evaluate(tf_tensors)
+
+    self.assertAllClose(actual, expected)
+    self.assertAllClose(actual_grad, expected_grad)
+
   @parameterized.parameters(
       (2, 16, 3, 4, 2, 2),
       (1, 8, 5, 3, 1, 4),
@@ -231,6 +383,106 @@ class LayersTest(parameterized.TestCase, tf.test.TestCase):
 
     self.assertEqual(actual.shape, (batch, length_q, io_channels))
 
+  def testQuantizedAttentionRoundTrip(self):
+    batch = 2
+    length = 8
+    io_channels = 6
+    query = tf.random_normal([batch, length, io_channels])
+
+    graph = mtf.Graph()
+    mesh = mtf.Mesh(graph, "my_mesh")
+    batch_dim = mtf.Dimension("batch", batch)
+    length_dim = mtf.Dimension("length", length)
+    io_channels_dim = mtf.Dimension("io_channels", io_channels)
+    kv_channels_dim = mtf.Dimension("kv_channels", 4)
+    heads_dim = mtf.Dimension("heads", 2)
+    variable_dtype = mtf.VariableDType(tf.float32)
+
+    mtf_query = mtf.import_tf_tensor(
+        mesh, query, shape=mtf.Shape([batch_dim, length_dim, io_channels_dim]))
+    outputs = []
+    for quantize_weights in [None, "int8"]:
+      with tf.variable_scope(quantize_weights or "float"):
+        params = mtf.layers.multihead_attention_params(
+            mesh, heads_dim, io_channels_dim, kv_channels_dim, variable_dtype,
+            quantize_weights=quantize_weights)
+        outputs.append(mtf.layers.masked_local_attention_1d(
+            mtf_query, kv_channels_dim, heads_dim, window_size=4,
+            params=params))
+    mesh_impl = mtf.placement_mesh_impl.PlacementMeshImpl(
+        shape=[], layout={}, devices=[""])
+    lowering = mtf.Lowering(graph, {mesh: mesh_impl})
+    tf_outputs = [lowering.export_to_tf_tensor(t) for t in outputs]
+
+    quantized = mtf.layers.quantize_attention_weights_int8(
+        *[graph.name_to_variable["float/" + name].get_master()
+          for name in ["q", "k", "v", "o"]])
+    assign = tf.group(
+        [graph.name_to_variable["int8/" + name].assign_to_master(value)
+         for name, value in quantized.items()])
+    self.evaluate(tf.global_variables_initializer())
+    self.evaluate(assign)
+    self.evaluate(lowering.copy_masters_to_slices())
+    expected, actual = self.evaluate(tf_outputs)
+
+    self.assertAllClose(actual, expected, rtol=2e-2, atol=2e-2)
+
+  @parameterized.parameters(
+      (1, False, ""),
+      (2, False, ""),
+      (4, True, ""),
+      (8, True, ""),
+      (2, True, "heads:all"),
+      (2, True, "length_q:all"),
+  )
+  def testFlashAttentionMatchesDotProductAttention(
+      self, num_kv_chunks, use_mask, layout):
+    batch, heads, length_q, length_kv, depth_k, depth_v = 2, 2, 4, 8, 3, 5
+    graph = mtf.Graph()
+    mesh = mtf.Mesh(graph, "my_mesh")
+    batch_dim = mtf.Dimension("batch", batch)
+    heads_dim = mtf.Dimension("heads", heads)
+    length_q_dim = mtf.Dimension("length_q", length_q)
+    length_kv_dim = mtf.Dimension("length_kv", length_kv)
+    depth_k_dim = mtf.Dimension("depth_k", depth_k)
+    depth_v_dim = mtf.Dimension("depth_v", depth_v)
+
+    q = mtf.import_tf_tensor(
+        mesh, tf.random_normal([batch, heads, length_q, depth_k]),
+        shape=[batch_dim, heads_dim, length_q_dim, depth_k_dim])
+    k = mtf.import_tf_tensor(
+        mesh, tf.random_normal([batch, heads, length_kv, depth_k]),
+        shape=[batch_dim, heads_dim, length_kv_dim, depth_k_dim])
+    v = mtf.import_tf_tensor(
+        mesh, tf.random_normal([batch, heads, length_kv, depth_v]),
+        shape=[batch_dim, heads_dim, length_kv_dim, depth_v_dim])
+    mask = None
+    if use_mask:
+      # Query position i sees memory positions up to i + 4.
+      mask = mtf.import_tf_tensor(
+          mesh,
+          -1e9 * tf.cast(tf.greater(tf.range(length_kv)[tf.newaxis, :],
+                                    tf.range(length_q)[:, tf.newaxis] + 4),
+                         tf.float32),
+          shape=[length_q_dim, length_kv_dim])
+    do = mtf.import_tf_tensor(
+        mesh, tf.random_normal([batch, heads, length_q, depth_v]),
+        shape=[batch_dim, heads_dim, length_q_dim, depth_v_dim])
+    outputs = []
+    for use_flash_attention in [True, False]:
+      o = mtf.layers.dot_product_attention(
+          q, k, v, mask, use_flash_attention=use_flash_attention,
+          num_kv_chunks=num_kv_chunks)
+      outputs += [o] + mtf.gradients([o], [q, k, v], [do])
+    mesh_impl = mtf.placement_mesh_impl.PlacementMeshImpl(
+        shape="all:2", layout=layout, devices=["", ""])
+    lowering = mtf.Lowering(graph, {mesh: mesh_impl})
+    outputs = self.evaluate(
+        [lowering.export_to_tf_tensor(t) for t in outputs])
+
+    for actual, expected in zip(outputs[:4], outputs[4:]):
+      self.assertAllClose(actual, expected, rtol=1e-5, atol=1e-5)
+
   @parameterized.parameters(
       (2, 4, 5, 7, 3, 1),
   )
@@ -319,6 +571,48 @@ class LayersTest(parameterized.TestCase, tf.test.TestCase):
 
     self.assertEqual(actual.shape, query.shape)
 
+  @parameterized.parameters(
+      (True,),
+      (False,),
+  )
+  def testMultiheadSelfAttentionMemoryCompressed(self, mask_right):
+    batch = 2
+    length = 8
+    channels = 3
+    compression_factor = 2
+    query = tf.random_normal([batch, length, channels])
+
+    graph = mtf.Graph()
+    mesh = mtf.Mesh(graph, "my_mesh")
+    batch_dim = mtf.Dimension("batch", batch)
+    length_dim = mtf.Dimension("length", length)
+    channels_dim = mtf.Dimension("channels", channels)
+    kv_channels_dim = mtf.Dimension("kv_channels", 4)
+    heads_dim = mtf.Dimension("heads", 2)
+
+    mtf_query = mtf.import_tf_tensor(
+        mesh, query,
+        shape=mtf.Shape([batch_dim, length_dim, channels_dim]))
+    mtf_outputs = mtf.layers.multihead_self_attention_memory_compressed(
+        mtf_query,
+        mask_right=mask_right,
+        compression_factor=compression_factor,
+        kv_channels=kv_channels_dim,
+        heads=heads_dim)
+    mesh_impl = mtf.placement_mesh_impl.PlacementMeshImpl(
+        shape=[], layout={}, devices=[""])
+    lowering = mtf.Lowering(graph, {mesh: mesh_impl})
+    actual_outputs = lowering.export_to_tf_tensor(mtf_outputs)
+
+    tf_group = lowering.copy_masters_to_slices()
+    init = tf.global_variables_initializer()
+    self.evaluate(init)
+    self.evaluate(tf_group)
+    actual = self.evaluate(actual_outputs)
+
+    self.assertEqual(actual.shape, query.shape)
+    self.assertTrue(np.all(np.isfinite(actual)))
+
   @parameterized.parameters(
       ("MAX_2D",), ("AVG_2D",), ("MAX_3D",), ("AVG_3D",),
   )
@@ -417,6 +711,74 @@ class LayersTest(parameterized.TestCase, tf.test.TestCase):
                          dtype=np.float32) / stride_d / stride_h / stride_w
       self.assertAllClose(actual, expected)
 
+  @parameterized.parameters(
+      ((3, 3), 6, "all:2", "h_blocks:all"),
+      ((5, 5), 6, "all:2", "h_blocks:all"),
+      ((3, 3), 2, "all:2", "h_blocks:all"),
+      ((3, 3), 6, "rows:2,cols:2", "h_blocks:rows,w_blocks:cols"),
+  )
+  def testConv2dWithBlocksMatchesConv2d(self, filter_size, block_size,
+                                        mesh_shape, layout):
+    batch, channels, out_channels = 2, 3, 4
+    num_blocks = 2
+    height = width = num_blocks * block_size
+    image = tf.random_normal([batch, height, width, channels])
+
+    graph = mtf.Graph()
+    mesh = mtf.Mesh(graph, "my_mesh")
+    batch_dim = mtf.Dimension("batch", batch)
+    h_blocks_dim = mtf.Dimension("h_blocks", num_blocks)
+    w_blocks_dim = mtf.Dimension("w_blocks", num_blocks)
+    h_dim = mtf.Dimension("h", block_size)
+    w_dim = mtf.Dimension("w", block_size)
+    height_dim = mtf.Dimension("height", height)
+    width_dim = mtf.Dimension("width", width)
+    channels_dim = mtf.Dimension("channels", channels)
+    out_channels_dim = mtf.Dimension("out_channels", out_channels)
+
+    def to_blocks(t, depth):
+      t = tf.reshape(
+          t, [batch, num_blocks, block_size, num_blocks, block_size, depth])
+      return tf.transpose(t, [0, 1, 3, 2, 4, 5])
+    def from_blocks(t, depth):
+      return tf.reshape(tf.transpose(t, [0, 1, 3, 2, 4, 5]),
+                        [batch, height, width, depth])
+
+    mtf_blocks = mtf.import_tf_tensor(
+        mesh, to_blocks(image, channels),
+        shape=[batch_dim, h_blocks_dim, w_blocks_dim, h_dim, w_dim,
+               channels_dim])
+    mtf_image = mtf.import_tf_tensor(
+        mesh, image, shape=[batch_dim, height_dim, width_dim, channels_dim])
+    mtf_blocks_outputs = mtf.layers.conv2d_with_blocks(
+        mtf_blocks, out_channels_dim, filter_size=filter_size,
+        h_blocks_dim=h_blocks_dim, w_blocks_dim=w_blocks_dim, name="conv")
+    # Same variable name, so the same kernel as conv2d_with_blocks.
+    mtf_outputs = mtf.layers.conv2d(
+        mtf_image, out_channels_dim, filter_size=filter_size, name="conv")
+    [kernel] = [v.outputs[0] for v in graph.trainable_variables]
+    dy = tf.random_normal([batch, height, width, out_channels])
+    mtf_dy_blocks = mtf.import_tf_tensor(
+        mesh, to_blocks(dy, out_channels), shape=mtf_blocks_outputs.shape)
+    mtf_dy = mtf.import_tf_tensor(mesh, dy, shape=mtf_outputs.shape)
+    blocks_grads = mtf.gradients(
+        [mtf_blocks_outputs], [mtf_blocks, kernel], [mtf_dy_blocks])
+    grads = mtf.gradients([mtf_outputs], [mtf_image, kernel], [mtf_dy])
+    mesh_impl = mtf.placement_mesh_impl.PlacementMeshImpl(
+        shape=mesh_shape, layout=layout,
+        devices=[""] * mtf.convert_to_shape(mesh_shape).size)
+    lowering = mtf.Lowering(graph, {mesh: mesh_impl})
+    tf_tensors = [lowering.export_to_tf_tensor(t) for t in
+                  [mtf_blocks_outputs] + blocks_grads + [mtf_outputs] + grads]
+    tf_tensors[0] = from_blocks(tf_tensors[0], out_channels)
+    tf_tensors[1] = from_blocks(tf_tensors[1], channels)
+
+    self.evaluate(tf.global_variables_initializer())
+    self.evaluate(lowering.copy_masters_to_slices())
+    outputs = self.evaluate(tf_tensors)
+    for actual, expected in zip(outputs[:3], outputs[3:]):
+      self.assertAllClose(actual, expected, rtol=1e-5, atol=1e-5)
+
 if __name__ == "__main__":
   tf.disable_v2_behavior()
   tf.enable_eager_execution()
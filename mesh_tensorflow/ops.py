@@ -26,8 +26,6 @@ import os
 import re
 
 from mesh_tensorflow import utils
-import six
-from six.moves import xrange  # pylint: disable=redefined-builtin
 
 import tensorflow.compat.v1 as tf
 
@@ -368,7 +366,7 @@ class TensorLayout(object):
     ta2ma = self._tensor_axis_to_mesh_axis
     return tuple(
         [ta2ma.index(mesh_axis) if mesh_axis in ta2ma else None
-         for mesh_axis in xrange(mesh_ndims)])
+         for mesh_axis in range(mesh_ndims)])
 
 
 class Graph(object):
@@ -508,7 +506,7 @@ class Graph(object):
           num_to_stack = min(
               num_to_stack, max_combined_slice_size // slice_size)
         num_to_stack = max(1, num_to_stack)
-        to_stack = [similar_vars.popleft() for _ in xrange(num_to_stack)]
+        to_stack = [similar_vars.popleft() for _ in range(num_to_stack)]
         if num_to_stack > 1:
           stacked_var = StackedVariable(to_stack)
           stack_dim = stacked_var.shape.dims[0]
@@ -577,7 +575,7 @@ class Graph(object):
     self._operations = [
         op for op in self._operations if op not in assignments_set]
     ret = []
-    for fn, ops in six.iteritems(group_by_fn):
+    for fn, ops in group_by_fn.items():
       variables = []
       values = []
       for a in ops:
@@ -686,17 +684,17 @@ class Lowering(object):
 
   def copy_masters_to_slices(self):
     if os.environ.get("MTF_SEQUENCE_MODE", "") == "1":
-      mesh_impls = [impl for impl in six.itervalues(self.mesh_to_impl)]
+      mesh_impls = [impl for impl in self.mesh_to_impl.values()]
       assert len(mesh_impls) == 1
       mesh_impl = mesh_impls[0]
       return mesh_impl.copy_master_to_slice_ops[-1]
     else:
       return tf.group(
-          [v.copy_master_to_slices for v in six.itervalues(self.variables)])
+          [v.copy_master_to_slices for v in self.variables.values()])
 
   def copy_slices_to_masters(self):
     return tf.group(
-        [v.copy_slices_to_master for v in six.itervalues(self.variables)])
+        [v.copy_slices_to_master for v in self.variables.values()])
 
   def add_counter(self, key, value):
     assert isinstance(value, int)
@@ -1058,7 +1056,7 @@ class MeshImpl(object):
     """
     n = self.shape[mesh_axis].size
     source_pcoord = []
-    for i in xrange(n):
+    for i in range(n):
       c = i - offset
       if c != c % n:
         if wrap:
@@ -1149,7 +1147,7 @@ class MeshImpl(object):
         return tf.slice(tf_tensor, slice_begin, slice_shape)
 
     return parallel([tf_tensor.device] * self.size, my_fn,
-                    list(xrange(self.size)))
+                    list(range(self.size)))
 
   def combine_slices(self, slices, tensor_shape, device=None):
     """Turns a set of slices into a single tensor.
@@ -1176,11 +1174,11 @@ class MeshImpl(object):
         if device:
           devices = [device] * slice_size
         else:
-          devices = [ret[i].device for i in xrange(slice_size)]
+          devices = [ret[i].device for i in range(slice_size)]
         concat_inputs = []
-        for i in xrange(slice_size):
+        for i in range(slice_size):
           concat_inputs.append(
-              [ret[i + slice_size * j] for j in xrange(mesh_dim.size)])
+              [ret[i + slice_size * j] for j in range(mesh_dim.size)])
         ret = parallel(
             devices, tf.concat, concat_inputs,
             axis=[tensor_axis] * len(devices))
@@ -1659,6 +1657,50 @@ def cwise(tf_fn, xs, output_dtype=None, grad_function=None, name=None):
       grad_function=grad_function, name=name or "cwise")
 
 
+def cwise_with_broadcasting(tf_fn, xs, output_shape=None, output_dtype=None,
+                            grad_function=None, name=None):
+  """Component-wise operation with broadcasting.
+
+  Like cwise(), but the inputs may have different shapes.  Each input slice is
+  expanded to broadcast against the output shape before tf_fn is called, so
+  a chain of elementwise computations is emitted as a single operation.
+
+  The default gradient (through tf.gradients) does not know about reductions
+  over split broadcast dimensions, so a grad_function is required whenever
+  some input does not have the output shape.
+
+  Args:
+    tf_fn: a component-wise function taking n tf.Tensor inputs and producing
+      a tf.Tensor output
+    xs: n Tensors
+    output_shape: an optional Shape - defaults to the broadcast of the inputs
+    output_dtype: an optional dtype
+    grad_function: an optional python function (see SlicewiseOperation)
+    name: an optional string
+
+  Returns:
+    a Tensor
+
+  Raises:
+    ValueError: if inputs need broadcasting and grad_function is None.
+  """
+  input_shapes = [x.shape for x in xs]
+  output_shape = convert_to_shape(output_shape)
+  if output_shape is None:
+    output_shape = functools.reduce(_infer_binary_broadcast_shape, input_shapes)
+  if grad_function is None and any(s != output_shape for s in input_shapes):
+    raise ValueError(
+        "cwise_with_broadcasting needs a grad_function when broadcasting."
+        " input_shapes=%s output_shape=%s" % (input_shapes, output_shape))
+  def slice_fn(*slices):
+    return tf_fn(*[_expand_dims(x, shape, output_shape)
+                   for x, shape in zip(slices, input_shapes)])
+  return slicewise(
+      slice_fn, xs, output_shape=output_shape, output_dtype=output_dtype,
+      splittable_dims=output_shape.dims, grad_function=grad_function,
+      name=name or "cwise_with_broadcasting")
+
+
 def square(x, name="square"):
   return cwise(
       tf.square, [x], name=name,
@@ -1755,6 +1797,18 @@ def mtf_abs(x):
 
 
 def cast(x, dtype, name="cast"):
+  """Casts x to dtype.
+
+  If x already has the given dtype, x itself is returned and no operation is
+  added to the graph, so callers need not check the dtype themselves.
+
+  Args:
+    x: a Tensor
+    dtype: a tf.DType
+    name: an optional string
+  Returns:
+    a Tensor with the same shape as x
+  """
   if dtype == x.dtype:
     return x
   return cwise(
@@ -2098,7 +2152,7 @@ def _reduce_helper(input_shape,
     ret = xslice
     if reduce_dims_indices:
       ret = reduction_fn(reduction_fn_string)(xslice, reduce_dims_indices)
-    if perm != list(xrange(len(perm))):
+    if perm != list(range(len(perm))):
       ret = tf.transpose(ret, perm)
     return ret
   reduced_mesh_axes = []
@@ -2148,6 +2202,54 @@ class ReduceOperation(Operation):
     lowering.set_tensor_lowering(self.outputs[0], y)
 
 
+class MeanAndSquareMeanOperation(Operation):
+  """Computes reduce_mean(x) and reduce_mean(square(x)) in one pass over x.
+
+  The sums are accumulated in float32 and cast back to x.dtype.  If the
+  reduced dimensions are split, both sums share one allreduce.
+  """
+
+  def __init__(self, x, output_shape, name=None):
+    super(MeanAndSquareMeanOperation, self).__init__(
+        [x], name=name or "mean_and_square_mean")
+    self._outputs = [Tensor(self, output_shape, x.dtype),
+                     Tensor(self, output_shape, x.dtype)]
+    self._scale = output_shape.size / x.shape.size
+
+  def gradient(self, grad_ys):
+    dmean, dsquare_mean = grad_ys
+    x = self.inputs[0]
+    dx = None
+    if dmean is not None:
+      dx = broadcast(dmean * self._scale, x.shape)
+    if dsquare_mean is not None:
+      dx2 = x * (dsquare_mean * (2.0 * self._scale))
+      dx = dx2 if dx is None else dx + dx2
+    return [dx]
+
+  def lower(self, lowering):
+    mesh_impl = lowering.mesh_impl(self)
+    x = self.inputs[0]
+    reduce_slice_fn, reduced_mesh_axes = _reduce_helper(
+        x.shape, self.outputs[0].shape, mesh_impl.tensor_layout(x))
+    def sums_fn(x_slice):
+      x_slice = tf.cast(x_slice, tf.float32)
+      return tf.stack(
+          [reduce_slice_fn(x_slice), reduce_slice_fn(tf.square(x_slice))],
+          axis=-1)
+    sums = mesh_impl.slicewise(sums_fn, lowering.tensors[x])
+    if reduced_mesh_axes:
+      sums = mesh_impl.allreduce(sums, reduced_mesh_axes, "SUM")
+      lowering.add_counter("allreduce/%s/reduce_op" % reduced_mesh_axes,
+                           2 * lowering.laid_out_size(self.outputs[0]))
+    def means_fn(sums_slice):
+      return tuple(tf.cast(t, x.dtype) for t in
+                   tf.unstack(sums_slice * self._scale, axis=-1))
+    mean, square_mean = mesh_impl.slicewise(means_fn, sums)
+    lowering.set_tensor_lowering(self.outputs[0], mean)
+    lowering.set_tensor_lowering(self.outputs[1], square_mean)
+
+
 def _pool_helper(ksize,
                  strides,
                  pool_fn_string="MAX_2D"):
@@ -2530,7 +2632,7 @@ class UnstackOperation(Operation):
     self._axis = x.shape.dims.index(dim)
     output_shape = x.shape - dim
     self._outputs = [
-        Tensor(self, output_shape, x.dtype, index=i) for i in xrange(dim.size)]
+        Tensor(self, output_shape, x.dtype, index=i) for i in range(dim.size)]
 
     self._splittable_dims, self._unsplittable_dims = (
         self._initialize_splittable_and_unsplittable_dims(
@@ -2620,16 +2722,69 @@ def _einsum_helper(input_shapes, output_shape, mesh_impl):
     # this helps to avoid some inefficient GPU implementations.
     einsum_slice_fn = einsum_slice_fn_naive
   else:
-    # call tf.einsum
-    equation = _einsum_equation(input_shapes, output_shape)
+    # call tf.einsum, contracting pairs of inputs in a greedy order if there
+    # are more than two of them.
+    steps = []
+    shapes = list(input_shapes)
+    for i, j, result_shape in _greedy_einsum_path(
+        tuple(tuple(s.dims) for s in input_shapes), tuple(output_shape.dims)):
+      steps.append(
+          (i, j, _einsum_equation([shapes[i], shapes[j]], result_shape)))
+      shapes = [s for k, s in enumerate(shapes) if k not in (i, j)]
+      shapes.append(result_shape)
+    equation = _einsum_equation(shapes, output_shape)
     def einsum_slice_fn(*slices):
       if slices[0].dtype.is_floating:
+        slices = list(slices)
+        for i, j, step_equation in steps:
+          y = mesh_impl.einsum(step_equation, slices[i], slices[j])
+          slices = [x for k, x in enumerate(slices) if k not in (i, j)]
+          slices.append(y)
         return mesh_impl.einsum(equation, *slices)
       else:
         return einsum_slice_fn_naive(*slices)
   return einsum_slice_fn, reduced_mesh_axes
 
 
+@functools.lru_cache(maxsize=None)
+def _greedy_einsum_path(input_dims, output_dims):
+  """Order in which to contract the inputs of a multi-input einsum.
+
+  Following the "greedy" strategy of opt_einsum, we repeatedly contract the
+  pair of operands with the smallest result, until two operands are left.
+  The result of a pairwise contraction keeps only those dimensions which
+  appear in the other operands or in the output.
+
+  The arguments are tuples, so that the result can be memoized.
+
+  Args:
+    input_dims: a tuple with a tuple of Dimensions for each input
+    output_dims: a tuple of Dimensions
+  Returns:
+    a tuple of triples (i, j, result_shape).  Each step contracts operands i
+    and j of the current operand list, removes them and appends the result.
+  """
+  shapes = [Shape(dims) for dims in input_dims]
+  output_shape = Shape(output_dims)
+  path = []
+  while len(shapes) > 2:
+    best = None
+    for i, j in itertools.combinations(range(len(shapes)), 2):
+      kept_dims = set(output_shape.dims)
+      for k, s in enumerate(shapes):
+        if k not in (i, j):
+          kept_dims.update(s.dims)
+      result_shape = Shape(
+          [d for d in _shape_union([shapes[i], shapes[j]]).dims
+           if d in kept_dims])
+      if best is None or result_shape.size < best[2].size:
+        best = (i, j, result_shape)
+    path.append(best)
+    shapes = [s for k, s in enumerate(shapes) if k not in best[:2]]
+    shapes.append(best[2])
+  return tuple(path)
+
+
 class EinsumOperation(Operation):
   """Einstein summation (matmul, etc).
 
@@ -2654,9 +2809,9 @@ class EinsumOperation(Operation):
     dy = grad_ys[0]
     xs = self.inputs
     ret = []
-    for i in xrange(len(self.inputs)):
+    for i in range(len(self.inputs)):
       ret.append(
-          einsum([dy] + [xs[j] for j in xrange(len(xs)) if j != i], xs[i].shape)
+          einsum([dy] + [xs[j] for j in range(len(xs)) if j != i], xs[i].shape)
       )
     return ret
 
@@ -2687,6 +2842,181 @@ class EinsumOperation(Operation):
     lowering.add_counter("einsum_unique", computation_shape.size)
 
 
+class EinsumBiasActivationOperation(Operation):
+  """activation(einsum([x, w]) + bias) as a single operation.
+
+  The bias add and activation are applied in the same slicewise computation
+  as the matmul, so that the einsum result is not written out and read back.
+  If the einsum reduces over a split dimension, it is lowered like a plain
+  einsum, with a LazyAllreduceSum, and the bias and activation are applied
+  only once the allreduce is needed.
+
+  activation_string is one of None or "relu".  If xla_epilogue is True, the
+  bias add and activation are built inside an XLA jit scope.
+  """
+
+  def __init__(self, x, w, bias, output_shape, activation_string=None,
+               xla_epilogue=False, name=None):
+    inputs = [x, w] if bias is None else [x, w, bias]
+    super(EinsumBiasActivationOperation, self).__init__(
+        inputs, name=name or "einsum_bias_activation")
+    for t in inputs:
+      if t.dtype != x.dtype:
+        raise ValueError("Input dtypes must be equal got %s"
+                         % ([t.dtype for t in inputs],))
+    verify_no_new_dims([x.shape, w.shape], output_shape)
+    if bias is not None:
+      verify_no_new_dims([output_shape], bias.shape)
+    if activation_string not in (None, "relu"):
+      raise ValueError("Unsupported activation %s" % activation_string)
+    self._has_bias = bias is not None
+    self._activation_string = activation_string
+    self._xla_epilogue = xla_epilogue
+    self._outputs = [Tensor(self, output_shape, x.dtype)]
+
+  def gradient(self, grad_ys):
+    dy = grad_ys[0]
+    x, w = self.inputs[:2]
+    if self._activation_string == "relu":
+      dy *= cast(greater(self.outputs[0], 0), dy.dtype)
+    ret = [einsum([dy, w], x.shape), einsum([dy, x], w.shape)]
+    if self._has_bias:
+      ret.append(reduce_sum(dy, output_shape=self.inputs[2].shape))
+    return ret
+
+  def lower(self, lowering):
+    mesh_impl = lowering.mesh_impl(self)
+    x, w = self.inputs[:2]
+    output_shape = self.outputs[0].shape
+    einsum_slice_fn, reduced_mesh_axes = _einsum_helper(
+        [x.shape, w.shape], output_shape, mesh_impl)
+    def bias_activation_fn(y, *bias):
+      if bias:
+        y += _expand_dims(bias[0], self.inputs[2].shape, output_shape)
+      if self._activation_string == "relu":
+        y = tf.nn.relu(y)
+      return y
+    def epilogue_slice_fn(y, *bias):
+      if not self._xla_epilogue:
+        return bias_activation_fn(y, *bias)
+      with tf.xla.experimental.jit_scope():
+        return bias_activation_fn(y, *bias)
+    laid_out_bias = [lowering.tensors[b] for b in self.inputs[2:]]
+    if reduced_mesh_axes:
+      def add_counter_fn():
+        lowering.add_counter(
+            "allreduce/%s/einsum_op" % reduced_mesh_axes,
+            mesh_impl.laid_out_size(output_shape))
+      y = LazyAllreduceSum(
+          mesh_impl,
+          mesh_impl.slicewise(
+              einsum_slice_fn, lowering.tensors[x], lowering.tensors[w]),
+          reduced_mesh_axes, add_counter_fn=add_counter_fn)
+      if self._has_bias or self._activation_string:
+        y = mesh_impl.slicewise(
+            epilogue_slice_fn, y.to_laid_out_tensor(), *laid_out_bias)
+    else:
+      def slice_fn(x_slice, w_slice, *bias):
+        return epilogue_slice_fn(einsum_slice_fn(x_slice, w_slice), *bias)
+      y = mesh_impl.slicewise(
+          slice_fn, lowering.tensors[x], lowering.tensors[w], *laid_out_bias)
+    lowering.set_tensor_lowering(self.outputs[0], y)
+    computation_shape = _shape_union([x.shape, w.shape])
+    lowering.add_counter("einsum", mesh_impl.laid_out_size(computation_shape))
+    lowering.add_counter("einsum_unique", computation_shape.size)
+
+
+class FusedFFNOperation(Operation):
+  """einsum([relu(einsum([x, wi], hidden_shape)), wo], output_shape).
+
+  The hidden activation is never an mtf.Tensor.  Within each slice, the hidden
+  dimension is processed in num_hidden_chunks pieces, each of which goes
+  through the first matmul, the relu and the second matmul before the next one
+  is started, so only one piece of the hidden activation is live at a time.
+  The gradient recomputes the hidden activation instead of storing it.
+  """
+
+  def __init__(self, x, wi, wo, hidden_shape, output_shape,
+               num_hidden_chunks=1, name=None):
+    super(FusedFFNOperation, self).__init__(
+        [x, wi, wo], name=name or "fused_ffn")
+    if not x.dtype == wi.dtype == wo.dtype:
+      raise ValueError("Input dtypes must be equal got %s"
+                       % ([x.dtype, wi.dtype, wo.dtype],))
+    verify_no_new_dims([x.shape, wi.shape], hidden_shape)
+    verify_no_new_dims([hidden_shape, wo.shape], output_shape)
+    self._hidden_shape = hidden_shape
+    self._num_hidden_chunks = num_hidden_chunks
+    self._outputs = [Tensor(self, output_shape, x.dtype)]
+
+  def gradient(self, grad_ys):
+    dy = grad_ys[0]
+    x, wi, wo = self.inputs
+    h = relu(einsum([x, wi], self._hidden_shape))
+    dh = einsum([dy, wo], self._hidden_shape) * cast(greater(h, 0), dy.dtype)
+    return [einsum([dh, wi], x.shape),
+            einsum([dh, x], wi.shape),
+            einsum([h, dy], wo.shape)]
+
+  def lower(self, lowering):
+    mesh_impl = lowering.mesh_impl(self)
+    x, wi, wo = self.inputs
+    output_shape = self.outputs[0].shape
+    hidden_shape = self._hidden_shape
+    wi_slice_fn, wi_reduced_mesh_axes = _einsum_helper(
+        [x.shape, wi.shape], hidden_shape, mesh_impl)
+    wo_slice_fn, wo_reduced_mesh_axes = _einsum_helper(
+        [hidden_shape, wo.shape], output_shape, mesh_impl)
+    if wi_reduced_mesh_axes:
+      # The first matmul needs an allreduce before the activation.
+      h = mesh_impl.slicewise(
+          wi_slice_fn, lowering.tensors[x], lowering.tensors[wi])
+      h = mesh_impl.allreduce(h, wi_reduced_mesh_axes, "SUM")
+      h = mesh_impl.slicewise(tf.nn.relu, h)
+      y = mesh_impl.slicewise(wo_slice_fn, h, lowering.tensors[wo])
+    else:
+      # Split the hidden dimension into chunks, if there is exactly one hidden
+      # dimension and its slices divide evenly.
+      num_chunks = 1
+      hidden_dims = [d for d in hidden_shape.dims if d not in x.shape.dims]
+      if len(hidden_dims) == 1:
+        hidden_dim = hidden_dims[0]
+        wi_axis = wi.shape.dims.index(hidden_dim)
+        wo_axis = wo.shape.dims.index(hidden_dim)
+        slice_size = mesh_impl.slice_shape(wi.shape)[wi_axis]
+        if slice_size % self._num_hidden_chunks == 0:
+          num_chunks = self._num_hidden_chunks
+      def slice_fn(x_slice, wi_slice, wo_slice):
+        if num_chunks == 1:
+          return wo_slice_fn(
+              tf.nn.relu(wi_slice_fn(x_slice, wi_slice)), wo_slice)
+        y = None
+        for wi_chunk, wo_chunk in zip(
+            tf.split(wi_slice, num_chunks, axis=wi_axis),
+            tf.split(wo_slice, num_chunks, axis=wo_axis)):
+          y_chunk = wo_slice_fn(
+              tf.nn.relu(wi_slice_fn(x_slice, wi_chunk)), wo_chunk)
+          y = y_chunk if y is None else y + y_chunk
+        return y
+      y = mesh_impl.slicewise(slice_fn, lowering.tensors[x],
+                              lowering.tensors[wi], lowering.tensors[wo])
+    if wo_reduced_mesh_axes:
+      y = mesh_impl.allreduce(y, wo_reduced_mesh_axes, "SUM")
+    for reduced_mesh_axes, shape in [
+        (wi_reduced_mesh_axes, hidden_shape),
+        (wo_reduced_mesh_axes, output_shape)]:
+      if reduced_mesh_axes:
+        lowering.add_counter(
+            "allreduce/%s/einsum_op" % reduced_mesh_axes,
+            mesh_impl.laid_out_size(shape))
+    lowering.set_tensor_lowering(self.outputs[0], y)
+    for computation_shape in [_shape_union([x.shape, wi.shape]),
+                              _shape_union([hidden_shape, wo.shape])]:
+      lowering.add_counter(
+          "einsum", mesh_impl.laid_out_size(computation_shape))
+      lowering.add_counter("einsum_unique", computation_shape.size)
+
+
 class Conv2dOperation(Operation):
   """like tf.nn.conv2d.
 
@@ -2965,12 +3295,21 @@ class Conv3dOperation(Operation):
   Currently we assume that the data format is always "NDHWC".
   # TODO(lehou): support more options such as dilation.
   Always dilation rate of 1
-  padding: "SAME" or "VALID"
+  padding: "SAME" or "VALID", or a list of three of those giving the padding
+    of the d, h and w dimensions separately.  Mixed padding requires all
+    strides to be 1; the "SAME" dimensions are then padded inside the slicewise
+    computation, where XLA folds the padding into the convolution.
   """
 
   def __init__(self, conv_input, conv_filter, strides, padding, name=None):
     super(Conv3dOperation, self).__init__(
         [conv_input, conv_filter], name=name or "conv3d")
+    if not isinstance(padding, str):
+      padding = list(padding)
+      if len(set(padding)) == 1:
+        padding = padding[0]
+      elif strides is not None and any(st != 1 for st in strides):
+        raise ValueError("per-dimension padding requires strides of 1")
     self._padding = padding
     self._batch_dims = conv_input.shape.dims[:-4]
     self._in_d_dim, self._in_h_dim, self._in_w_dim, self._in_dim = (
@@ -2980,13 +3319,12 @@ class Conv3dOperation(Operation):
     if f_in_dim != self._in_dim:
       raise ValueError("Dimensions do not match input=%s filter=%s"
                        % (conv_input, conv_filter))
-    out_d = self._in_d_dim.size
-    out_h = self._in_h_dim.size
-    out_w = self._in_w_dim.size
-    if padding == "VALID":
-      out_d -= (self._fd_dim.size - 1)
-      out_h -= (self._fh_dim.size - 1)
-      out_w -= (self._fw_dim.size - 1)
+    out_d, out_h, out_w = [
+        in_dim.size - (f_dim.size - 1 if p == "VALID" else 0)
+        for in_dim, f_dim, p in zip(
+            [self._in_d_dim, self._in_h_dim, self._in_w_dim],
+            [self._fd_dim, self._fh_dim, self._fw_dim],
+            self._per_dim_padding)]
 
     self._strides = strides
     if strides is not None:
@@ -3007,20 +3345,48 @@ class Conv3dOperation(Operation):
         self._initialize_splittable_and_unsplittable_dims(
             "splittable", [dim.name for dim in unsplittable_dims]))
 
+  @property
+  def _per_dim_padding(self):
+    if isinstance(self._padding, str):
+      return [self._padding] * 3
+    return self._padding
+
+  def _same_paddings(self):
+    """Yields (dim_index, pad_before, pad_after) for mixed "SAME" dims."""
+    for i, (f_dim, p) in enumerate(zip(
+        [self._fd_dim, self._fh_dim, self._fw_dim], self._per_dim_padding)):
+      if p == "SAME":
+        yield i, (f_dim.size - 1) // 2, f_dim.size // 2
+
   def gradient(self, grad_ys):
     dy = grad_ys[0]
     conv_input, conv_filter = self.inputs
+    if isinstance(self._padding, str):
+      return [
+          conv3d_backprop_input(self._inputs[0].shape,
+                                conv_filter,
+                                dy,
+                                self._strides,
+                                self._padding),
+          conv3d_backprop_filter(conv_input,
+                                 self._inputs[1].shape,
+                                 dy,
+                                 self._strides,
+                                 self._padding)]
+    # Mixed padding: differentiate the equivalent explicitly padded VALID
+    # convolution.
+    spatial_dims = conv_input.shape.dims[-4:-1]
+    padded_input = conv_input
+    for i, before, after in self._same_paddings():
+      padded_input = pad(padded_input, [before, after], spatial_dims[i].name)
+    dx = conv3d_backprop_input(padded_input.shape, conv_filter, dy,
+                               self._strides, "VALID")
+    for i, before, _ in self._same_paddings():
+      dx = mtf_slice(dx, before, spatial_dims[i].size, spatial_dims[i].name)
     return [
-        conv3d_backprop_input(self._inputs[0].shape,
-                              conv_filter,
-                              dy,
-                              self._strides,
-                              self._padding),
-        conv3d_backprop_filter(conv_input,
-                               self._inputs[1].shape,
-                               dy,
-                               self._strides,
-                               self._padding)]
+        dx,
+        conv3d_backprop_filter(padded_input, conv_filter.shape, dy,
+                               self._strides, "VALID")]
 
   def lower(self, lowering):
     mesh_impl = lowering.mesh_impl(self)
@@ -3037,10 +3403,19 @@ class Conv3dOperation(Operation):
       raise ValueError("can't slice along dimension fh")
     if mesh_impl.tensor_dimension_to_mesh_axis(self._fw_dim) is not None:
       raise ValueError("can't slice along dimension fw")
+    if isinstance(self._padding, str):
+      tf_padding = self._padding
+      tf_paddings = None
+    else:
+      tf_padding = "VALID"
+      tf_paddings = [[0, 0]] * 5
+      for i, before, after in self._same_paddings():
+        tf_paddings[i + 1] = [before, after]
     def tf_fn(tf_input, tf_filter):
-      output = tf.nn.conv3d(
-          _tf_flatten_batch_dims(tf_input, 4),
-          tf_filter, self._strides, self._padding)
+      flat_input = _tf_flatten_batch_dims(tf_input, 4)
+      if tf_paddings is not None:
+        flat_input = tf.pad(flat_input, tf_paddings)
+      output = tf.nn.conv3d(flat_input, tf_filter, self._strides, tf_padding)
       return _tf_restore_batch_dims(output, 4, tf_input)
     y = mesh_impl.slicewise(
         tf_fn, lowering.tensors[conv_input], lowering.tensors[conv_filter])
@@ -3614,6 +3989,73 @@ class PadOperation(Operation):
     lowering.set_tensor_lowering(self.outputs[0], y)
 
 
+class ScatterUpdateOperation(Operation):
+  """Overwrite one position of a Tensor along one dimension.
+
+  output = x, except that the slice at position index along dim is replaced
+  by update.  The position is written with tf.tensor_scatter_nd_update, so
+  only the updated slice is computed (and on backends that reuse the input
+  buffer, only that slice is written).  dim may not be split.
+
+  index may have dimensions (e.g. batch), which must precede dim in x, in
+  which case each of its entries gives the position for its part of x.
+  """
+
+  def __init__(self, x, index, update, dim, name=None):
+    super(ScatterUpdateOperation, self).__init__(
+        [x, index, update], name=name or "scatter_update")
+    leading_dims = x.shape.dims[:x.shape.dims.index(dim)]
+    if (not index.dtype.is_integer or
+        any(d not in leading_dims for d in index.shape.dims)):
+      raise ValueError("index must be an integer Tensor with dimensions "
+                       "preceding %s in x got %s" % (dim, index))
+    if update.shape != x.shape - dim:
+      raise ValueError("update shape must equal x.shape - dim got %s %s"
+                       % (update.shape, x.shape))
+    if update.dtype != x.dtype:
+      raise ValueError("Input dtypes must be equal got %s"
+                       % ([x.dtype, update.dtype],))
+    self._dim = dim
+    self._axis = x.shape.dims.index(dim)
+    self._outputs = [Tensor(self, x.shape, x.dtype)]
+    self._splittable_dims, self._unsplittable_dims = (
+        self._initialize_splittable_and_unsplittable_dims(
+            "splittable", [dim.name]))
+
+  def gradient(self, grad_ys):
+    dy = grad_ys[0]
+    _, index, update = self.inputs
+    return [scatter_update(dy, index, zeros_like(update), self._dim),
+            None,
+            gather(dy, index, self._dim, output_shape=update.shape)]
+
+  def lower(self, lowering):
+    mesh_impl = lowering.mesh_impl(self)
+    if mesh_impl.tensor_dimension_to_mesh_axis(self._dim) is not None:
+      raise ValueError("can't scatter_update along split axis")
+    x, index, update = self.inputs
+    axis = self._axis
+    leading_mtf_shape = Shape(x.shape.dims[:axis])
+    def slicewise_fn(x_slice, index_slice, update_slice):
+      # The indices enumerate all positions of the leading axes, followed by
+      # the updated position, so update_slice supplies the updates directly.
+      leading_shape = x_slice.shape.as_list()[:axis]
+      grids = []
+      if leading_shape:
+        grids = tf.meshgrid(
+            *[tf.range(n, dtype=index_slice.dtype) for n in leading_shape],
+            indexing="ij")
+      positions = tf.broadcast_to(
+          _expand_dims(index_slice, index.shape, leading_mtf_shape),
+          leading_shape)
+      indices = tf.stack(grids + [positions], axis=-1)
+      return tf.tensor_scatter_nd_update(x_slice, indices, update_slice)
+    y = mesh_impl.slicewise(
+        slicewise_fn, lowering.tensors[x], lowering.tensors[index],
+        lowering.tensors[update])
+    lowering.set_tensor_lowering(self.outputs[0], y)
+
+
 class OneHotOperation(Operation):
   """Like tf.one_hot.
   """
@@ -3958,6 +4400,18 @@ class ReadVariable(Operation):
             tf.cast, sv.laid_out_tensor, self._var.activation_dtype))
 
 
+def _to_variable_dtype(dtype, master_dtype, slice_dtype, activation_dtype):
+  """Resolves the dtype arguments of get_variable() to a VariableDType."""
+  if dtype is None:
+    return VariableDType(master_dtype, slice_dtype, activation_dtype)
+  elif isinstance(dtype, tf.DType):
+    return VariableDType(
+        master_dtype or dtype, slice_dtype or dtype, activation_dtype or dtype)
+  elif not isinstance(dtype, VariableDType):
+    raise ValueError("dtype should be a tf.dtype or a mtf.VariableDType")
+  return dtype
+
+
 def get_variable(mesh, name, shape, dtype=tf.float32,
                  master_dtype=None, slice_dtype=None, activation_dtype=None,
                  initializer=None, trainable=True,
@@ -3979,13 +4433,7 @@ def get_variable(mesh, name, shape, dtype=tf.float32,
   Returns:
     a Tensor with the given shape and dtype equal to dtype.activation_dtype
   """
-  if dtype is None:
-    dtype = VariableDType(master_dtype, slice_dtype, activation_dtype)
-  elif isinstance(dtype, tf.DType):
-    dtype = VariableDType(
-        master_dtype or dtype, slice_dtype or dtype, activation_dtype or dtype)
-  elif not isinstance(dtype, VariableDType):
-    raise ValueError("dtype should be a tf.dtype or a mtf.VariableDType")
+  dtype = _to_variable_dtype(dtype, master_dtype, slice_dtype, activation_dtype)
   scope_name = tf.get_variable_scope().name
   if scope_name:
     full_name = scope_name + "/" + name
@@ -4004,6 +4452,33 @@ def get_variable(mesh, name, shape, dtype=tf.float32,
   return var.outputs[0]
 
 
+def get_variables(mesh, specs, dtype=tf.float32,
+                  master_dtype=None, slice_dtype=None, activation_dtype=None,
+                  **kwargs):
+  """Create or retrieve several variables sharing a dtype.
+
+  Like calling get_variable() once per spec, but the dtype arguments are
+  resolved only once.
+
+  Args:
+    mesh: a Mesh
+    specs: a list of tuples (name, shape, initializer, trainable)
+    dtype: a VariableDType or a tf.DType
+    master_dtype: an optional tf.DType (deprecated - use dtype arg)
+    slice_dtype: an optional tf.DType (deprecated - use dtype arg)
+    activation_dtype: an optional tf.DType (deprecated - use dtype arg)
+    **kwargs: additional keyword arguments to tf.get_variable
+
+  Returns:
+    a tuple of Tensors, one per spec
+  """
+  dtype = _to_variable_dtype(dtype, master_dtype, slice_dtype, activation_dtype)
+  return tuple(
+      get_variable(mesh, name, shape, dtype=dtype, initializer=initializer,
+                   trainable=trainable, **kwargs)
+      for name, shape, initializer, trainable in specs)
+
+
 def read_variable(var):
   return ReadVariable(var).outputs[0]
 
@@ -4485,7 +4960,7 @@ def einsum(xs, output_shape=None, reduced_dims=None, name=None):
                          % (reduced_dims,))
   if output_shape is None:
     if reduced_dims is None:
-      reduced_dims = [d for d, c in six.iteritems(input_dim_count) if c > 1]
+      reduced_dims = [d for d, c in input_dim_count.items() if c > 1]
     output_shape = Shape([d for d in input_dims if d not in reduced_dims])
   elif reduced_dims is not None:
     computed_reduced_dims = [
@@ -4498,6 +4973,64 @@ def einsum(xs, output_shape=None, reduced_dims=None, name=None):
   return EinsumOperation(xs, output_shape, name=name).outputs[0]
 
 
+def einsum_bias_activation(x, w, bias, output_shape, activation=None,
+                           xla_epilogue=False, name=None):
+  """activation(einsum([x, w], output_shape) + bias), fused into one op.
+
+  Args:
+    x: a Tensor
+    w: a Tensor
+    bias: an optional Tensor whose shape is a subset of output_shape
+    output_shape: a Shape
+    activation: one of None, "relu" or mtf.relu
+    xla_epilogue: a boolean - whether to build the bias add and activation
+      inside an XLA jit scope
+    name: an optional string
+  Returns:
+    a Tensor
+  """
+  if activation is relu:
+    activation = "relu"
+  if bias is None and activation is None:
+    return einsum([x, w], output_shape=output_shape, name=name)
+  return EinsumBiasActivationOperation(
+      x, w, bias, convert_to_shape(output_shape), activation,
+      xla_epilogue=xla_epilogue, name=name).outputs[0]
+
+
+def fused_ffn(x, wi, wo, hidden_shape=None, output_shape=None,
+              num_hidden_chunks=1, name=None):
+  """Two-layer feed-forward block with a relu, as a single operation.
+
+  Computes einsum([relu(einsum([x, wi], hidden_shape)), wo], output_shape)
+  without materializing the hidden activation - see FusedFFNOperation.
+
+  Args:
+    x: a Tensor
+    wi: a Tensor
+    wo: a Tensor
+    hidden_shape: an optional Shape.  Defaults to the dimensions of x which are
+      not in wi, followed by the dimensions of wi which are not in x.
+    output_shape: an optional Shape.  Defaults to x.shape.
+    num_hidden_chunks: an integer - the number of pieces that each slice of the
+      hidden dimension is processed in.
+    name: an optional string
+  Returns:
+    a Tensor
+  """
+  if hidden_shape is None:
+    hidden_shape = Shape(
+        [d for d in x.shape.dims if d not in wi.shape.dims] +
+        [d for d in wi.shape.dims if d not in x.shape.dims])
+  hidden_shape = convert_to_shape(hidden_shape)
+  if output_shape is None:
+    output_shape = x.shape
+  output_shape = convert_to_shape(output_shape)
+  return FusedFFNOperation(
+      x, wi, wo, hidden_shape, output_shape,
+      num_hidden_chunks=num_hidden_chunks, name=name).outputs[0]
+
+
 def matmul(a, b, output_shape=None, reduced_dims=None, name=None):
   """Alias for einsum([a, b])."""
   return einsum(
@@ -4586,6 +5119,21 @@ def reduce_mean(x,
         x, output_shape=output_shape) * (output_shape.size / x.shape.size)
 
 
+def reduce_mean_and_square_mean(x, output_shape, name=None):
+  """reduce_mean(x) and reduce_mean(square(x)), reading x only once.
+
+  Args:
+    x: a Tensor
+    output_shape: a Shape. Must be a subsequence of x.shape.
+    name: an optional string
+
+  Returns:
+    a pair of Tensors with shape output_shape
+  """
+  return tuple(MeanAndSquareMeanOperation(
+      x, convert_to_shape(output_shape), name=name).outputs)
+
+
 def reduce_max(x,
                disable_positional_args=None,
                output_shape=None,
@@ -4937,6 +5485,30 @@ def pad(x, paddings, dim_name, name=None):
       x, paddings, dim_name, name=name).outputs[0]
 
 
+def scatter_update(x, index, update, dim, name=None):
+  """Replace the slice of x at position index along dim with update.
+
+  Equivalent to
+    where(equal(range(dim), index), update, x)
+  but only the updated slice is written.
+
+  Args:
+    x: a Tensor
+    index: an integer Tensor - a scalar, or with dimensions that precede dim
+      in x, to write a different position in each part of x
+    update: a Tensor whose shape is a subset of x.shape - dim
+    dim: a Dimension in x.shape - may not be split
+    name: an optional string
+  Returns:
+    a Tensor with the same shape as x
+  """
+  dim = convert_to_dimension(dim)
+  update_shape = x.shape - dim
+  if update.shape != update_shape:
+    update = broadcast(update, update_shape)
+  return ScatterUpdateOperation(x, index, update, dim, name=name).outputs[0]
+
+
 def one_hot(indices, output_dim, on_value=1.0,
             off_value=0.0, dtype=tf.float32, name=None):
   """One hot operation.
@@ -5204,7 +5776,7 @@ def processor_groups(mesh_shape, group_dims):
   """
   group_numbers = [
       pnum_to_group(mesh_shape, group_dims, pnum)
-      for pnum in xrange(mesh_shape.size)]
+      for pnum in range(mesh_shape.size)]
   ret = []
   for pnum, g in enumerate(group_numbers):
     while len(ret) <= g:
@@ -5268,6 +5840,350 @@ def softmax(x, reduced_dim, extra_logit=None, name=None):
     return exp(log_softmax(x, reduced_dim, extra_logit=extra_logit))
 
 
+class MaskedSoftmaxOperation(Operation):
+  """softmax(logits + mask, reduced_dim) as a single operation.
+
+  The mask is broadcast and added inside the same slicewise computation as
+  the softmax, so the masked logits are never written out.  If reduced_dim is
+  split, the maximum and the sum of exponentials are combined with one MAX
+  and one SUM allreduce.
+  """
+
+  def __init__(self, logits, mask, reduced_dim, name=None):
+    super(MaskedSoftmaxOperation, self).__init__(
+        [logits, mask], name=name or "masked_softmax")
+    if mask.dtype != logits.dtype:
+      raise ValueError("Input dtypes must be equal got %s"
+                       % ([logits.dtype, mask.dtype],))
+    if reduced_dim not in logits.shape.dims:
+      raise ValueError("reduced_dim must be in logits.shape.dims")
+    verify_no_new_dims([logits.shape], mask.shape)
+    self._reduced_dim = reduced_dim
+    self._outputs = [Tensor(self, logits.shape, logits.dtype)]
+
+  def gradient(self, grad_ys):
+    dy = grad_ys[0]
+    mask = self.inputs[1]
+    y = self.outputs[0]
+    dlogits = y * (
+        dy - reduce_sum(dy * y, output_shape=y.shape - self._reduced_dim))
+    dmask = dlogits
+    if mask.shape != dlogits.shape:
+      dmask = reduce_sum(dlogits, output_shape=mask.shape)
+    return [dlogits, dmask]
+
+  def lower(self, lowering):
+    mesh_impl = lowering.mesh_impl(self)
+    logits, mask = self.inputs
+    axis = logits.shape.dims.index(self._reduced_dim)
+    mesh_axis = mesh_impl.tensor_dimension_to_mesh_axis(self._reduced_dim)
+    def masked_logits_fn(logits_slice, mask_slice):
+      return logits_slice + _expand_dims(mask_slice, mask.shape, logits.shape)
+    laid_out_logits = lowering.tensors[logits]
+    laid_out_mask = lowering.tensors[mask]
+    if mesh_axis is None:
+      def slice_fn(logits_slice, mask_slice):
+        return tf.nn.softmax(masked_logits_fn(logits_slice, mask_slice), axis)
+      y = mesh_impl.slicewise(slice_fn, laid_out_logits, laid_out_mask)
+    else:
+      def max_fn(logits_slice, mask_slice):
+        return tf.reduce_max(
+            masked_logits_fn(logits_slice, mask_slice), axis, keepdims=True)
+      max_logit = mesh_impl.slicewise(max_fn, laid_out_logits, laid_out_mask)
+      max_logit = mesh_impl.allreduce(max_logit, [mesh_axis], "MAX")
+      def exp_fn(logits_slice, mask_slice, max_logit):
+        return tf.exp(masked_logits_fn(logits_slice, mask_slice) - max_logit)
+      exp_logits = mesh_impl.slicewise(
+          exp_fn, laid_out_logits, laid_out_mask, max_logit)
+      sum_exp = mesh_impl.slicewise(
+          functools.partial(tf.reduce_sum, axis=axis, keepdims=True),
+          exp_logits)
+      sum_exp = mesh_impl.allreduce(sum_exp, [mesh_axis], "SUM")
+      lowering.add_counter(
+          "allreduce/%s/masked_softmax" % [mesh_axis],
+          2 * mesh_impl.laid_out_size(logits.shape - self._reduced_dim))
+      y = mesh_impl.slicewise(tf.divide, exp_logits, sum_exp)
+    lowering.set_tensor_lowering(self.outputs[0], y)
+
+
+def masked_softmax(logits, mask, reduced_dim, name=None):
+  """softmax(logits + mask, reduced_dim), fused into a single operation.
+
+  Args:
+    logits: a Tensor whose shape contains reduced_dim
+    mask: a Tensor whose shape is a subset of logits.shape
+    reduced_dim: a Dimension
+    name: an optional string
+
+  Returns:
+    a Tensor with the same shape as logits
+  """
+  return MaskedSoftmaxOperation(
+      logits, cast(mask, logits.dtype), convert_to_dimension(reduced_dim),
+      name=name).outputs[0]
+
+
+class SoftmaxCrossEntropyOperation(Operation):
+  """Softmax cross-entropy loss and log-partition function in one pass.
+
+  Outputs are
+    loss = -reduce_sum(log_softmax(logits) * targets, vocab_dim)
+    log_z = reduce_logsumexp(logits, vocab_dim)
+  The log_softmax tensor is never materialized.  If vocab_dim is split, the
+  per-slice statistics are combined with one MAX and one SUM allreduce.
+
+  If targets_sum_to_one, the targets are assumed to sum to 1 along vocab_dim
+  (e.g. one-hot or label-smoothed), so that loss = log_z - logits . targets.
+  The gradient with respect to the targets is then taken of that expression,
+  i.e. it is -logits * dloss.
+  """
+
+  def __init__(self, logits, targets, vocab_dim, targets_sum_to_one=False,
+               name=None):
+    super(SoftmaxCrossEntropyOperation, self).__init__(
+        [logits, targets], name=name or "softmax_cross_entropy")
+    if logits.shape != targets.shape:
+      raise ValueError(
+          "logits shape must equal targets shape"
+          "logits=%s targets=%s" % (logits.to_string, targets.to_string))
+    if vocab_dim not in logits.shape.dims:
+      raise ValueError("vocab_dim must be in logits.shape.dims")
+    self._vocab_dim = vocab_dim
+    self._targets_sum_to_one = targets_sum_to_one
+    reduced_shape = logits.shape - vocab_dim
+    self._outputs = [Tensor(self, reduced_shape, logits.dtype),
+                     Tensor(self, reduced_shape, logits.dtype)]
+
+  def gradient(self, grad_ys):
+    dloss, dlog_z = grad_ys
+    logits, targets = self.inputs
+    loss, log_z = self.outputs
+    log_softmax = logits - log_z
+    softmax = exp(log_softmax)
+    dsoftmax_coeff = None
+    if dloss is not None:
+      if self._targets_sum_to_one:
+        dsoftmax_coeff = dloss
+      else:
+        dsoftmax_coeff = dloss * reduce_sum(targets, output_shape=loss.shape)
+    if dlog_z is not None:
+      dsoftmax_coeff = (
+          dlog_z if dsoftmax_coeff is None else dsoftmax_coeff + dlog_z)
+    dlogits = softmax * dsoftmax_coeff
+    dtargets = None
+    if dloss is not None:
+      dlogits -= targets * dloss
+      if self._targets_sum_to_one:
+        dtargets = -logits * dloss
+      else:
+        dtargets = -log_softmax * dloss
+    return [dlogits, dtargets]
+
+  def lower(self, lowering):
+    mesh_impl = lowering.mesh_impl(self)
+    logits, targets = self.inputs
+    axis = logits.shape.dims.index(self._vocab_dim)
+    mesh_axis = mesh_impl.tensor_dimension_to_mesh_axis(self._vocab_dim)
+    def max_fn(logits_slice):
+      return tf.reduce_max(logits_slice, axis)
+    def stats_fn(logits_slice, targets_slice, max_logit):
+      # sum(exp(logits - max_logit)), sum(logits * targets) and, unless the
+      # targets sum to one, sum(targets), stacked in the last axis.
+      stats = [
+          tf.reduce_sum(
+              tf.exp(logits_slice - tf.expand_dims(max_logit, axis)), axis),
+          tf.reduce_sum(logits_slice * targets_slice, axis)]
+      if not self._targets_sum_to_one:
+        stats.append(tf.reduce_sum(targets_slice, axis))
+      return tf.stack(stats, axis=-1)
+    def loss_fn(stats, max_logit):
+      stats = tf.unstack(stats, axis=-1)
+      log_z = tf.log(stats[0]) + max_logit
+      if self._targets_sum_to_one:
+        return log_z - stats[1], log_z
+      return log_z * stats[2] - stats[1], log_z
+    laid_out_logits = lowering.tensors[logits]
+    laid_out_targets = lowering.tensors[targets]
+    if mesh_axis is None:
+      def slice_fn(logits_slice, targets_slice):
+        max_logit = max_fn(logits_slice)
+        return loss_fn(
+            stats_fn(logits_slice, targets_slice, max_logit), max_logit)
+      loss, log_z = mesh_impl.slicewise(
+          slice_fn, laid_out_logits, laid_out_targets)
+    else:
+      max_logit = mesh_impl.slicewise(max_fn, laid_out_logits)
+      max_logit = mesh_impl.allreduce(max_logit, [mesh_axis], "MAX")
+      # The three sums share one allreduce.
+      stats = mesh_impl.slicewise(
+          stats_fn, laid_out_logits, laid_out_targets, max_logit)
+      stats = mesh_impl.allreduce(stats, [mesh_axis], "SUM")
+      lowering.add_counter(
+          "allreduce/%s/softmax_cross_entropy" % [mesh_axis],
+          (3 if self._targets_sum_to_one else 4) *
+          mesh_impl.laid_out_size(self.outputs[0].shape))
+      loss, log_z = mesh_impl.slicewise(loss_fn, stats, max_logit)
+    lowering.set_tensor_lowering(self.outputs[0], loss)
+    lowering.set_tensor_lowering(self.outputs[1], log_z)
+
+
+def softmax_cross_entropy(logits, targets, vocab_dim,
+                          targets_sum_to_one=False, name=None):
+  """Softmax cross-entropy loss, fused into a single operation.
+
+  Args:
+    logits: a Tensor whose shape contains vocab_dim
+    targets: a Tensor with the same shape as logits
+    vocab_dim: a Dimension
+    targets_sum_to_one: a boolean - whether the targets are known to sum to 1
+      along vocab_dim, which saves a reduction.
+    name: an optional string
+
+  Returns:
+    loss: a Tensor whose shape is equal to logits.shape - vocab_dim
+    log_z: a Tensor with the same shape as loss - the log partition function
+  """
+  return tuple(SoftmaxCrossEntropyOperation(
+      logits, targets, convert_to_dimension(vocab_dim),
+      targets_sum_to_one=targets_sum_to_one, name=name).outputs)
+
+
+class FlashAttentionOperation(Operation):
+  """einsum([softmax(einsum([q, k]) + mask, length_kv), v]) in one operation.
+
+  The [..., length_q, length_kv] attention weights are never an mtf.Tensor.
+  Within each slice, length_kv is processed in num_kv_chunks pieces with an
+  online softmax: a running maximum logit and a running sum of exponentials
+  are kept, and the partial outputs are rescaled whenever the maximum grows.
+  Only one piece of the logits is live at a time.  The gradient recomputes
+  the attention weights instead of storing them.
+
+  length_kv and depth_k may not be split across the mesh.
+  """
+
+  def __init__(self, q, k, v, mask=None, num_kv_chunks=1, name=None):
+    inputs = [q, k, v] if mask is None else [q, k, v, mask]
+    super(FlashAttentionOperation, self).__init__(
+        inputs, name=name or "flash_attention")
+    for t in inputs:
+      if t.dtype != q.dtype:
+        raise ValueError("Input dtypes must be equal got %s"
+                         % ([x.dtype for x in inputs],))
+    self._length_kv, self._depth_k = k.shape.dims[-2:]
+    if q.shape.dims[-1] != self._depth_k:
+      raise ValueError("q and k must have the same depth q=%s k=%s"
+                       % (q.shape, k.shape))
+    if v.shape.dims[-2] != self._length_kv:
+      raise ValueError("k and v must have the same length k=%s v=%s"
+                       % (k.shape, v.shape))
+    self._logits_shape = Shape(q.shape.dims[:-1] + [self._length_kv])
+    if mask is not None:
+      verify_no_new_dims([self._logits_shape], mask.shape)
+    self._num_kv_chunks = num_kv_chunks
+    self._outputs = [
+        Tensor(self, Shape(q.shape.dims[:-1] + v.shape.dims[-1:]), q.dtype)]
+    self._splittable_dims, self._unsplittable_dims = (
+        self._initialize_splittable_and_unsplittable_dims(
+            "splittable", [self._length_kv.name, self._depth_k.name]))
+
+  def gradient(self, grad_ys):
+    do = grad_ys[0]
+    q, k, v = self.inputs[:3]
+    mask = self.inputs[3] if len(self.inputs) > 3 else None
+    o = self.outputs[0]
+    logits = einsum([q, k], self._logits_shape)
+    if mask is not None:
+      logits += mask
+    weights = softmax(logits, self._length_kv)
+    dweights = einsum([do, v], self._logits_shape)
+    dlogits = weights * (
+        dweights - reduce_sum(do * o, output_shape=o.shape - o.shape.dims[-1]))
+    ret = [einsum([dlogits, k], q.shape),
+           einsum([dlogits, q], k.shape),
+           einsum([weights, do], v.shape)]
+    if mask is not None:
+      ret.append(reduce_sum(dlogits, output_shape=mask.shape))
+    return ret
+
+  def lower(self, lowering):
+    mesh_impl = lowering.mesh_impl(self)
+    q, k, v = self.inputs[:3]
+    mask = self.inputs[3] if len(self.inputs) > 3 else None
+    for d in [self._length_kv, self._depth_k]:
+      if mesh_impl.tensor_dimension_to_mesh_axis(d) is not None:
+        raise ValueError("flash_attention does not support splitting %s" % d)
+    logits_shape = self._logits_shape
+    output_shape = self.outputs[0].shape
+    logits_equation = _einsum_equation([q.shape, k.shape], logits_shape)
+    outputs_equation = _einsum_equation([logits_shape, v.shape], output_shape)
+    num_chunks = self._num_kv_chunks
+    if self._length_kv.size % num_chunks != 0:
+      num_chunks = 1
+    mask_axis = None
+    if mask is not None and self._length_kv in mask.shape.dims:
+      mask_axis = mask.shape.dims.index(self._length_kv)
+    def slice_fn(q_slice, k_slice, v_slice, mask_slice=None):
+      k_chunks = tf.split(k_slice, num_chunks, axis=k.shape.ndims - 2)
+      v_chunks = tf.split(v_slice, num_chunks, axis=v.shape.ndims - 2)
+      if mask_axis is not None:
+        mask_chunks = tf.split(mask_slice, num_chunks, axis=mask_axis)
+      else:
+        mask_chunks = [mask_slice] * num_chunks
+      max_logit = None
+      for k_chunk, v_chunk, mask_chunk in zip(k_chunks, v_chunks, mask_chunks):
+        # length_kv is the last axis of the logits, and depth_v is the last
+        # axis of the outputs, so the statistics broadcast against both.
+        logits = mesh_impl.einsum(logits_equation, q_slice, k_chunk)
+        if mask_chunk is not None:
+          logits += _expand_dims(mask_chunk, mask.shape, logits_shape)
+        chunk_max = tf.reduce_max(logits, -1, keepdims=True)
+        new_max = (chunk_max if max_logit is None
+                   else tf.maximum(max_logit, chunk_max))
+        exp_logits = tf.exp(logits - new_max)
+        chunk_sum = tf.reduce_sum(exp_logits, -1, keepdims=True)
+        chunk_outputs = mesh_impl.einsum(
+            outputs_equation, exp_logits, v_chunk)
+        if max_logit is None:
+          sum_exp, outputs = chunk_sum, chunk_outputs
+        else:
+          correction = tf.exp(max_logit - new_max)
+          sum_exp = sum_exp * correction + chunk_sum
+          outputs = outputs * correction + chunk_outputs
+        max_logit = new_max
+      return outputs / sum_exp
+    y = mesh_impl.slicewise(
+        slice_fn, *[lowering.tensors[x] for x in self.inputs])
+    lowering.set_tensor_lowering(self.outputs[0], y)
+    for computation_shape in [_shape_union([q.shape, k.shape]),
+                              _shape_union([logits_shape, v.shape])]:
+      lowering.add_counter(
+          "einsum", mesh_impl.laid_out_size(computation_shape))
+      lowering.add_counter("einsum_unique", computation_shape.size)
+
+
+def flash_attention(q, k, v, mask=None, num_kv_chunks=1, name=None):
+  """Dot-product attention without materializing the attention weights.
+
+  Equivalent to
+    einsum([softmax(einsum([q, k]) + mask, length_kv), v])
+  - see FlashAttentionOperation.
+
+  Args:
+    q: a Tensor with shape [..., length_q, depth_k]
+    k: a Tensor with shape [..., length_kv, depth_k]
+    v: a Tensor with shape [..., length_kv, depth_v]
+    mask: an optional Tensor broadcastable to [..., length_q, length_kv]
+    num_kv_chunks: an integer - the number of pieces in which to process
+      length_kv.
+    name: an optional string
+
+  Returns:
+    a Tensor with shape [..., length_q, depth_v]
+  """
+  return FlashAttentionOperation(
+      q, k, v, mask=mask, num_kv_chunks=num_kv_chunks, name=name).outputs[0]
+
+
 class RangeOperation(Operation):
   """tf.range."""
 
@@ -5327,11 +6243,11 @@ def pretty_print_counters(counters):
   """
   totals = collections.defaultdict(int)
   for (name, val) in counters:
-    prefixes = [name[:i] for i in xrange(len(name)) if name[i] == "/"] + [name]
+    prefixes = [name[:i] for i in range(len(name)) if name[i] == "/"] + [name]
     for p in prefixes:
       totals[p] += val
   parts = []
-  for name, val in sorted(six.iteritems(totals)):
+  for name, val in sorted(totals.items()):
     parts.append(" " * name.count("/") + "%s: %.3g" % (name, val))
   return "\n".join(parts)
 
@@ -5381,7 +6297,7 @@ def parallel(devices, fn, *args, **kwargs):
   """
   if not isinstance(devices, list):
     raise ValueError("devices must be a list")
-  for x in list(args) + list(six.itervalues(kwargs)):
+  for x in list(args) + list(kwargs.values()):
     if not isinstance(x, list) or len(x) != len(devices):
       raise ValueError(
           "Argument not a list with same length as devices "
@@ -5391,7 +6307,7 @@ def parallel(devices, fn, *args, **kwargs):
     with tf.device(device):
       with tf.variable_scope("parallel_%d" % i):
         my_args = [x[i] for x in args]
-        my_kwargs = {k: v[i] for k, v in six.iteritems(kwargs)}
+        my_kwargs = {k: v[i] for k, v in kwargs.items()}
         ret.append(fn(*my_args, **my_kwargs))
   return ret
 
@@ -5541,6 +6457,54 @@ def random_uniform(mesh, shape, **kwargs):
   return RandomOperation(mesh, shape, tf.random.uniform, **kwargs).outputs[0]
 
 
+class RandomScaleOperation(Operation):
+  """Multiply by tf.random.uniform noise, as a single operation.
+
+  The noise is the second output, so that the gradient can reuse it.
+  """
+
+  def __init__(self, x, minval, maxval, name=None):
+    super(RandomScaleOperation, self).__init__(
+        [x], name=name or "random_scale")
+    self._minval = minval
+    self._maxval = maxval
+    self._outputs = [Tensor(self, x.shape, x.dtype),
+                     Tensor(self, x.shape, x.dtype)]
+    self._splittable_dims, self._unsplittable_dims = (
+        self._initialize_all_dimensions_as_splittable())
+
+  def gradient(self, grad_ys):
+    dy = grad_ys[0]
+    return [dy * self.outputs[1]]
+
+  def lower(self, lowering):
+    mesh_impl = lowering.mesh_impl(self)
+    x = self.inputs[0]
+    scale = mesh_impl.random(
+        x.shape, tf.random.uniform,
+        {"minval": self._minval, "maxval": self._maxval, "dtype": x.dtype})
+    y = mesh_impl.slicewise(tf.multiply, lowering.tensors[x], scale)
+    lowering.set_tensor_lowering(self.outputs[0], y)
+    lowering.set_tensor_lowering(self.outputs[1], scale)
+
+
+def random_scale(x, minval, maxval, name=None):
+  """x times uniform noise between minval and maxval.
+
+  Equivalent to x * random_uniform(x.mesh, x.shape, ...), but as one op.
+
+  Args:
+    x: a Tensor
+    minval: a float
+    maxval: a float
+    name: an optional string
+
+  Returns:
+    a Tensor with the same shape and dtype as x
+  """
+  return RandomScaleOperation(x, minval, maxval, name=name).outputs[0]
+
+
 def dropout(x, keep_prob, noise_shape=None, name=None):
   """Dropout layer.
 
@@ -5559,9 +6523,13 @@ def dropout(x, keep_prob, noise_shape=None, name=None):
   with tf.variable_scope(name, default_name="dropout"):
     if keep_prob == 1.0:
       return x
-    noise = cast(less(random_uniform(
-        x.mesh, noise_shape, dtype=x.dtype), keep_prob), x.dtype)
-    noise /= keep_prob
+    # Threshold and rescale the uniform noise in a single op.
+    noise = slicewise(
+        lambda u: tf.cast(tf.less(u, keep_prob), u.dtype) / keep_prob,
+        [random_uniform(x.mesh, noise_shape, dtype=x.dtype)],
+        splittable_dims=noise_shape.dims,
+        grad_function=0,
+        name="dropout_noise")
     return x * noise
 
 
@@ -5914,7 +6882,7 @@ def halo_exchange(x, blocks_dim, block_size_dim, halo_size, wrap=False):
   num_complete_blocks = halo_size // block_size
   parts = [x]
 
-  for i in xrange(1, num_complete_blocks + 1):
+  for i in range(1, num_complete_blocks + 1):
     parts = ([shift(x, i, blocks_dim, wrap)] + parts +
              [shift(x, -i, blocks_dim, wrap)])
   if partial_size > 0:
@@ -5953,7 +6921,7 @@ def left_halo_exchange(x, blocks_dim, block_size_dim, halo_size, wrap=False):
   num_complete_blocks = halo_size // block_size
   parts = [x]
 
-  for i in xrange(1, num_complete_blocks + 1):
+  for i in range(1, num_complete_blocks + 1):
     parts = ([shift(x, i, blocks_dim, wrap)] + parts)
   if partial_size > 0:
     right_margin = mtf_slice(
@@ -6048,7 +7016,7 @@ def serialize_training_step(features, model_fn, batch_dim, num_splits):
       a list of mtf Tensors
     """
     my_features = {}
-    for k, v in six.iteritems(features):
+    for k, v in features.items():
       my_features[k] = select(v, microbatch_num)
     outputs = model_fn(my_features)
     grads = gradients(
@@ -191,6 +191,20 @@ class MeshTensorFlowTest(parameterized.TestCase, tf.test.TestCase):
     self.assertEqual(mesh_impl.tensor_layout(mtf.Shape([batch, length, d_ff])),
                      mtf.TensorLayout([0, None, 1]))
 
+  def testEinsumAsBatchMatmul(self):
+    # The stacked q/k/v projection: [batch, length, io] times
+    # [qkv, heads, io, kv] is a single [batch*length, io] x
+    # [io, qkv*heads*kv] matmul.
+    x = tf.random_normal([2, 5, 4])
+    w = tf.random_normal([3, 2, 4, 6])
+    equation = "bli,qhik->bqhlk"
+    y = mtf.placement_mesh_impl.einsum_as_batch_matmul(equation, x, w)
+    self.assertEqual(y.shape.as_list(), [2, 3, 2, 5, 6])
+    actual, expected = self.evaluate([y, tf.einsum(equation, x, w)])
+    self.assertAllClose(actual, expected)
+    self.assertIsNone(mtf.placement_mesh_impl.einsum_as_batch_matmul(
+        "ab,bc->a", tf.zeros([2, 3]), tf.zeros([3, 4])))
+
 
 class OperationSplittabilityTest(tf.test.TestCase):
 
@@ -261,6 +275,20 @@ class OperationSplittabilityTest(tf.test.TestCase):
     self.assertEqual(generic_grad_operation.unsplittable_dims,
                      frozenset())
 
+  def testCwiseWithBroadcasting(self):
+    x2 = mtf.zeros(self.mesh, mtf.Shape([self.b_dim]))
+    def grad_function(op, dy):
+      return [dy, mtf.reduce_sum(dy, output_shape=op.inputs[1].shape)]
+    y = mtf.cwise_with_broadcasting(
+        tf.add, [self.x, x2], grad_function=grad_function)
+    self.assertEqual(y.shape, self.ab_shape)
+    self.assertEqual(y.operation.splittable_dims, frozenset(["a", "b"]))
+    self.assertEqual(y.operation.unsplittable_dims, frozenset())
+
+    # Broadcasting requires an explicit gradient.
+    self.assertRaises(
+        ValueError, mtf.cwise_with_broadcasting, tf.add, [self.x, x2])
+
   def testScalarMultiplyOperationandScalarAddOperation(self):
     scalar = 2.0
     scalar_multiply_operation = mtf.ScalarMultiplyOperation(self.x, scalar)
@@ -300,6 +328,14 @@ class OperationSplittabilityTest(tf.test.TestCase):
     self.assertEqual(reduce_operation.splittable_dims, frozenset(["a", "b"]))
     self.assertEqual(reduce_operation.unsplittable_dims, frozenset())
 
+  def testMeanAndSquareMeanOperation(self):
+    mean, square_mean = mtf.reduce_mean_and_square_mean(
+        self.x, mtf.Shape([self.a_dim]))
+    self.assertEqual(mean.shape, mtf.Shape([self.a_dim]))
+    self.assertEqual(square_mean.shape, mtf.Shape([self.a_dim]))
+    self.assertEqual(mean.operation.splittable_dims, frozenset(["a", "b"]))
+    self.assertEqual(mean.operation.unsplittable_dims, frozenset())
+
   def testPoolOperation(self):
     reduce_operation = mtf.PoolOperation(self.image, [2, 2], [2, 2], "AVG_2D")
     self.assertEqual(reduce_operation.splittable_dims,
@@ -341,6 +377,39 @@ class OperationSplittabilityTest(tf.test.TestCase):
                      frozenset(["a", "b", "c"]))
     self.assertEqual(einsum_operation.unsplittable_dims, frozenset())
 
+  def testFusedFFNOperation(self):
+    h_dim = mtf.Dimension("h", 3)
+    wi = mtf.zeros(self.mesh, mtf.Shape([self.b_dim, h_dim]))
+    wo = mtf.zeros(self.mesh, mtf.Shape([h_dim, self.b_dim]))
+    y = mtf.fused_ffn(self.x, wi, wo)
+    self.assertEqual(y.shape, self.x.shape)
+    self.assertEqual(y.operation.splittable_dims,
+                     frozenset(["a", "b", "h"]))
+    self.assertEqual(y.operation.unsplittable_dims, frozenset())
+
+  def testFlashAttentionOperation(self):
+    length_q = mtf.Dimension("length_q", 4)
+    length_kv = mtf.Dimension("length_kv", 6)
+    depth = mtf.Dimension("depth", 3)
+    q = mtf.zeros(self.mesh, mtf.Shape([self.a_dim, length_q, depth]))
+    k = mtf.zeros(self.mesh, mtf.Shape([self.a_dim, length_kv, depth]))
+    v = mtf.zeros(self.mesh, mtf.Shape([self.a_dim, length_kv, self.b_dim]))
+    mask = mtf.zeros(self.mesh, mtf.Shape([length_q, length_kv]))
+    y = mtf.flash_attention(q, k, v, mask=mask, num_kv_chunks=2)
+    self.assertEqual(y.shape, mtf.Shape([self.a_dim, length_q, self.b_dim]))
+    self.assertEqual(y.operation.splittable_dims,
+                     frozenset(["a", "b", "length_q"]))
+    self.assertEqual(y.operation.unsplittable_dims,
+                     frozenset(["length_kv", "depth"]))
+
+  def testScatterUpdateOperation(self):
+    index = mtf.constant(self.mesh, 2, dtype=tf.int32)
+    update = mtf.zeros(self.mesh, mtf.Shape([self.a_dim]))
+    y = mtf.scatter_update(self.x, index, update, self.b_dim)
+    self.assertEqual(y.shape, self.x.shape)
+    self.assertEqual(y.operation.splittable_dims, frozenset(["a"]))
+    self.assertEqual(y.operation.unsplittable_dims, frozenset(["b"]))
+
   def testConv2dOperations(self):
     conv_input = mtf.zeros(
         self.mesh,
@@ -591,6 +660,292 @@ class TopKTest(tf.test.TestCase):
                         self.evaluate(expected_d_inputs))
 
 
+
+class EinsumTest(parameterized.TestCase, tf.test.TestCase):
+
+  @parameterized.parameters(
+      ("ij,jk,kl->il", ""),
+      ("ij,jk,kl->il", "j:all"),
+      ("bij,jk,bkl->bl", "b:all"),
+      ("ij,jk,kl,lm->im", ""),
+      ("ij,jk,kl,lm->im", "k:all"),
+      ("ij,bjk,kl,lm->bim", ""),
+  )
+  def testMultiOperandEinsum(self, equation, layout):
+    # No operand has all of the dimensions, so the operands are contracted
+    # pairwise in the order chosen by _greedy_einsum_path.
+    sizes = {"b": 2, "i": 3, "j": 4, "k": 6, "l": 5, "m": 3}
+    graph = mtf.Graph()
+    mesh = mtf.Mesh(graph, "my_mesh")
+    input_letters, output_letters = equation.split("->")
+    inputs = []
+    mtf_inputs = []
+    for letters in input_letters.split(","):
+      inputs.append(tf.random_normal([sizes[c] for c in letters]))
+      mtf_inputs.append(mtf.import_tf_tensor(
+          mesh, inputs[-1],
+          shape=[mtf.Dimension(c, sizes[c]) for c in letters]))
+    mtf_output = mtf.einsum(
+        mtf_inputs,
+        output_shape=[mtf.Dimension(c, sizes[c]) for c in output_letters])
+    mesh_impl = mtf.placement_mesh_impl.PlacementMeshImpl(
+        shape="all:2", layout=layout, devices=["", ""])
+    lowering = mtf.Lowering(graph, {mesh: mesh_impl})
+    actual_output = lowering.export_to_tf_tensor(mtf_output)
+    actual, expected = self.evaluate(
+        [actual_output, tf.einsum(equation, *inputs)])
+    self.assertAllClose(actual, expected, rtol=1e-5, atol=1e-5)
+
+
+class EinsumBiasActivationTest(parameterized.TestCase, tf.test.TestCase):
+
+  @parameterized.parameters(
+      ("", None),
+      ("", "relu"),
+      ("b:all", None),
+      ("b:all", "relu"),
+      ("c:all", "relu"),
+  )
+  def testMatchesUnfused(self, layout, activation):
+    graph = mtf.Graph()
+    mesh = mtf.Mesh(graph, "my_mesh")
+    a_dim = mtf.Dimension("a", 3)
+    b_dim = mtf.Dimension("b", 4)
+    c_dim = mtf.Dimension("c", 6)
+    x = mtf.import_tf_tensor(mesh, tf.random_normal([3, 4]),
+                             shape=[a_dim, b_dim])
+    w = mtf.import_tf_tensor(mesh, tf.random_normal([4, 6]),
+                             shape=[b_dim, c_dim])
+    bias = mtf.import_tf_tensor(mesh, tf.random_normal([6]), shape=[c_dim])
+    dy = mtf.import_tf_tensor(mesh, tf.random_normal([3, 6]),
+                              shape=[a_dim, c_dim])
+    y = mtf.einsum_bias_activation(
+        x, w, bias, mtf.Shape([a_dim, c_dim]), activation)
+    expected_y = mtf.einsum([x, w], mtf.Shape([a_dim, c_dim])) + bias
+    if activation == "relu":
+      expected_y = mtf.relu(expected_y)
+    grads = mtf.gradients([y], [x, w, bias], [dy])
+    expected_grads = mtf.gradients([expected_y], [x, w, bias], [dy])
+    mesh_impl = mtf.placement_mesh_impl.PlacementMeshImpl(
+        shape="all:2", layout=layout, devices=["", ""])
+    lowering = mtf.Lowering(graph, {mesh: mesh_impl})
+    tensors = [y] + grads + [expected_y] + expected_grads
+    outputs = self.evaluate(
+        [lowering.export_to_tf_tensor(t) for t in tensors])
+    for actual, expected in zip(outputs[:4], outputs[4:]):
+      self.assertAllClose(actual, expected, rtol=1e-5, atol=1e-5)
+
+
+class MaskedSoftmaxTest(parameterized.TestCase, tf.test.TestCase):
+
+  @parameterized.parameters(
+      ("", False),
+      ("", True),
+      ("b:all", False),
+      ("b:all", True),
+      ("a:all", True),
+  )
+  def testMatchesUnfused(self, layout, broadcast_mask):
+    graph = mtf.Graph()
+    mesh = mtf.Mesh(graph, "my_mesh")
+    a_dim = mtf.Dimension("a", 4)
+    b_dim = mtf.Dimension("b", 6)
+    logits = mtf.import_tf_tensor(
+        mesh, tf.random_normal([4, 6]) * 3.0, shape=[a_dim, b_dim])
+    if broadcast_mask:
+      mask = mtf.import_tf_tensor(
+          mesh, tf.constant([0.0, -1e9, 0.0, 0.0, -1e9, -1.0]),
+          shape=[b_dim])
+    else:
+      mask = mtf.import_tf_tensor(
+          mesh, tf.random_normal([4, 6]), shape=[a_dim, b_dim])
+    dy = mtf.import_tf_tensor(mesh, tf.random_normal([4, 6]),
+                              shape=[a_dim, b_dim])
+    y = mtf.masked_softmax(logits, mask, b_dim)
+    expected_y = mtf.softmax(logits + mask, b_dim)
+    grads = mtf.gradients([y], [logits, mask], [dy])
+    expected_grads = mtf.gradients([expected_y], [logits, mask], [dy])
+    mesh_impl = mtf.placement_mesh_impl.PlacementMeshImpl(
+        shape="all:2", layout=layout, devices=["", ""])
+    lowering = mtf.Lowering(graph, {mesh: mesh_impl})
+    outputs = self.evaluate(
+        [lowering.export_to_tf_tensor(t) for t in
+         [y] + grads + [expected_y] + expected_grads])
+    for actual, expected in zip(outputs[:3], outputs[3:]):
+      self.assertAllClose(actual, expected, rtol=1e-5, atol=1e-5)
+
+
+class RandomScaleTest(parameterized.TestCase, tf.test.TestCase):
+
+  @parameterized.parameters(("",), ("a:all",))
+  def testValuesAndGradient(self, layout):
+    graph = mtf.Graph()
+    mesh = mtf.Mesh(graph, "my_mesh")
+    a_dim = mtf.Dimension("a", 4)
+    b_dim = mtf.Dimension("b", 64)
+    x = mtf.import_tf_tensor(
+        mesh, 1.0 + tf.random_uniform([4, 64]), shape=[a_dim, b_dim])
+    dy = mtf.import_tf_tensor(mesh, tf.random_normal([4, 64]),
+                              shape=[a_dim, b_dim])
+    y = mtf.random_scale(x, 0.5, 1.5)
+    [dx] = mtf.gradients([y], [x], [dy])
+    mesh_impl = mtf.placement_mesh_impl.PlacementMeshImpl(
+        shape="all:2", layout=layout, devices=["", ""])
+    lowering = mtf.Lowering(graph, {mesh: mesh_impl})
+    x, y, dy, dx = self.evaluate(
+        [lowering.export_to_tf_tensor(t) for t in [x, y, dy, dx]])
+    # The gradient is dy times the same noise that scaled x.
+    scale = y / x
+    self.assertAllInRange(scale, 0.5, 1.5)
+    self.assertGreater(scale.std(), 0.0)
+    self.assertAllClose(dx, dy * scale, rtol=1e-5, atol=1e-5)
+
+
+class SoftmaxCrossEntropyTest(parameterized.TestCase, tf.test.TestCase):
+
+  @parameterized.parameters(
+      ("", False),
+      ("vocab:all", False),
+      ("", True),
+      ("vocab:all", True),
+      ("batch:all", True),
+  )
+  def testMatchesUnfused(self, layout, targets_sum_to_one):
+    graph = mtf.Graph()
+    mesh = mtf.Mesh(graph, "my_mesh")
+    batch_dim = mtf.Dimension("batch", 4)
+    vocab_dim = mtf.Dimension("vocab", 6)
+    logits = mtf.import_tf_tensor(
+        mesh, tf.random_normal([4, 6]) * 3.0, shape=[batch_dim, vocab_dim])
+    if targets_sum_to_one:
+      targets = mtf.one_hot(
+          mtf.import_tf_tensor(mesh, tf.constant([0, 5, 2, 2]),
+                               shape=[batch_dim]),
+          vocab_dim, dtype=tf.float32)
+    else:
+      targets = mtf.import_tf_tensor(
+          mesh, tf.random_uniform([4, 6]), shape=[batch_dim, vocab_dim])
+    dloss = mtf.import_tf_tensor(mesh, tf.random_normal([4]),
+                                 shape=[batch_dim])
+    dlog_z = mtf.import_tf_tensor(mesh, tf.random_normal([4]),
+                                  shape=[batch_dim])
+    loss, log_z = mtf.softmax_cross_entropy(
+        logits, targets, vocab_dim, targets_sum_to_one=targets_sum_to_one)
+    expected_loss = -mtf.reduce_sum(
+        mtf.log_softmax(logits, vocab_dim) * targets, reduced_dim=vocab_dim)
+    expected_log_z = mtf.reduce_logsumexp(logits, vocab_dim)
+    # Only the loss depends on the targets.
+    [dtargets] = mtf.gradients([loss], [targets], [dloss])
+    [expected_dtargets] = mtf.gradients([expected_loss], [targets], [dloss])
+    [dlogits] = mtf.gradients([loss, log_z], [logits], [dloss, dlog_z])
+    [expected_dlogits] = mtf.gradients(
+        [expected_loss, expected_log_z], [logits], [dloss, dlog_z])
+    mesh_impl = mtf.placement_mesh_impl.PlacementMeshImpl(
+        shape="all:2", layout=layout, devices=["", ""])
+    lowering = mtf.Lowering(graph, {mesh: mesh_impl})
+    actual = [loss, log_z, dlogits]
+    expected = [expected_loss, expected_log_z, expected_dlogits]
+    actual.append(dtargets)
+    if targets_sum_to_one:
+      # The loss is log_z - logits . targets, differentiated as written.
+      expected.append(-logits * dloss)
+    else:
+      expected.append(expected_dtargets)
+    outputs = self.evaluate(
+        [lowering.export_to_tf_tensor(t) for t in actual + expected])
+    for a, e in zip(outputs[:len(actual)], outputs[len(actual):]):
+      self.assertAllClose(a, e, rtol=1e-5, atol=1e-5)
+
+
+class ScatterUpdateTest(parameterized.TestCase, tf.test.TestCase):
+
+  @parameterized.parameters(
+      ("", False),
+      ("", True),
+      ("batch:all", True),
+      ("d:all", True),
+  )
+  def testScatterUpdate(self, layout, batch_index):
+    graph = mtf.Graph()
+    mesh = mtf.Mesh(graph, "my_mesh")
+    batch_dim = mtf.Dimension("batch", 4)
+    length_dim = mtf.Dimension("length", 5)
+    d_dim = mtf.Dimension("d", 2)
+    inputs = tf.random_normal([4, 5, 2])
+    updates = tf.random_normal([4, 2])
+    if batch_index:
+      indices = tf.constant([2, 0, 4, 2])
+      index = mtf.import_tf_tensor(mesh, indices, shape=[batch_dim])
+    else:
+      indices = tf.constant([3, 3, 3, 3])
+      index = mtf.constant(mesh, 3, dtype=tf.int32)
+    x = mtf.import_tf_tensor(mesh, inputs,
+                             shape=[batch_dim, length_dim, d_dim])
+    update = mtf.import_tf_tensor(mesh, updates, shape=[batch_dim, d_dim])
+    dy = tf.random_normal([4, 5, 2])
+    y = mtf.scatter_update(x, index, update, length_dim)
+    dx, dupdate = mtf.gradients(
+        [y], [x, update], [mtf.import_tf_tensor(mesh, dy, shape=y.shape)])
+    mesh_impl = mtf.placement_mesh_impl.PlacementMeshImpl(
+        shape="all:2", layout=layout, devices=["", ""])
+    lowering = mtf.Lowering(graph, {mesh: mesh_impl})
+    actual = [lowering.export_to_tf_tensor(t) for t in [y, dx, dupdate]]
+
+    # Whether each position of x is overwritten.
+    written = tf.expand_dims(tf.one_hot(indices, 5, dtype=tf.bool), -1)
+    written = tf.broadcast_to(written, [4, 5, 2])
+    expected = [
+        tf.where(written, tf.broadcast_to(updates[:, None, :], [4, 5, 2]),
+                 inputs),
+        tf.where(written, tf.zeros_like(dy), dy),
+        tf.reduce_sum(tf.where(written, dy, tf.zeros_like(dy)), axis=1)]
+    outputs = self.evaluate(actual + expected)
+    for a, e in zip(outputs[:3], outputs[3:]):
+      self.assertAllClose(a, e)
+
+
+class MeanAndSquareMeanTest(parameterized.TestCase, tf.test.TestCase):
+
+  @parameterized.parameters(
+      (tf.float32, "", 1e-5),
+      (tf.float32, "b:all", 1e-5),
+      (tf.bfloat16, "", 1e-2),
+  )
+  def testMatchesTwoPassVariance(self, dtype, layout, rtol):
+    graph = mtf.Graph()
+    mesh = mtf.Mesh(graph, "my_mesh")
+    a_dim = mtf.Dimension("a", 3)
+    b_dim = mtf.Dimension("b", 64)
+    inputs = tf.random_normal([3, 64], mean=4.0)
+    mtf_inputs = mtf.import_tf_tensor(
+        mesh, tf.cast(inputs, dtype), shape=mtf.Shape([a_dim, b_dim]))
+    mean, square_mean = mtf.reduce_mean_and_square_mean(
+        mtf_inputs, mtf.Shape([a_dim]))
+    mesh_impl = mtf.placement_mesh_impl.PlacementMeshImpl(
+        shape="all:2", layout=layout, devices=["", ""])
+    lowering = mtf.Lowering(graph, {mesh: mesh_impl})
+    actual_mean = tf.cast(lowering.export_to_tf_tensor(mean), tf.float32)
+    actual_square_mean = tf.cast(
+        lowering.export_to_tf_tensor(square_mean), tf.float32)
+
+    # Compare against float32 statistics of the same (possibly rounded)
+    # inputs.
+    inputs = tf.cast(tf.cast(inputs, dtype), tf.float32)
+    expected_mean = tf.reduce_mean(inputs, axis=1)
+    expected_variance = tf.reduce_mean(
+        tf.square(inputs - tf.expand_dims(expected_mean, 1)), axis=1)
+    (actual_mean, actual_square_mean, expected_mean,
+     expected_variance) = self.evaluate(
+         [actual_mean, actual_square_mean, expected_mean, expected_variance])
+    self.assertAllClose(actual_mean, expected_mean, rtol=rtol)
+    if dtype == tf.float32:
+      self.assertAllClose(actual_square_mean - actual_mean ** 2,
+                          expected_variance, rtol=1e-4, atol=1e-4)
+    else:
+      self.assertAllClose(actual_square_mean,
+                          expected_variance + expected_mean ** 2, rtol=rtol)
+
+
 if __name__ == "__main__":
   tf.disable_v2_behavior()
   tf.enable_eager_execution()
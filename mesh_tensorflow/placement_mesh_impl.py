@@ -23,7 +23,6 @@ import os
 import random
 
 from mesh_tensorflow import ops_with_redefined_builtins as mtf
-from six.moves import xrange  # pylint: disable=redefined-builtin
 
 import tensorflow.compat.v1 as tf
 
@@ -87,7 +86,7 @@ class PlacementMeshImpl(mtf.MeshImpl):
       else:
         slices = []
         slices_with_master_dtype = []
-        for pnum in xrange(mesh_impl.size):
+        for pnum in range(mesh_impl.size):
           with tf.device(mesh_impl.devices[pnum]):
             slices.append(tf.get_variable(
                 base_name + "_slice_%d" % pnum,
@@ -182,6 +181,25 @@ class PlacementMeshImpl(mtf.MeshImpl):
     else:
       return self.LaidOutTensor(ret)
 
+  def einsum(self, equation, *slices):
+    """Einsum, lowering two-operand contractions to a batched matmul.
+
+    tf.einsum does not always hit the cuBLAS GEMM kernels on GPU, so
+    contractions of two operands are rewritten as tf.matmul on transposed and
+    reshaped slices where possible.
+
+    Args:
+      equation: a string
+      *slices: a list of tf.Tensor
+    Returns:
+      a tf.Tensor
+    """
+    if len(slices) == 2:
+      ret = einsum_as_batch_matmul(equation, *slices)
+      if ret is not None:
+        return ret
+    return tf.einsum(equation, *slices)
+
   def Print(self, x, data, message, **kwargs):  # pylint: disable=invalid-name
     """call tf.Print.
 
@@ -387,11 +405,11 @@ def allreduce_ring_single_shard(xs, devices, reduction_fn_string="SUM"):
     left_center = n // 2
     right_center = left_center
   left_sum = xs[0]
-  for i in xrange(1, left_center + 1):
+  for i in range(1, left_center + 1):
     with tf.device(devices[i]):
       left_sum = binary_reduction(left_sum, xs[i])
   right_sum = xs[n-1]
-  for i in reversed(xrange(left_center + 1, n - 1)):
+  for i in reversed(range(left_center + 1, n - 1)):
     with tf.device(devices[i]):
       right_sum = binary_reduction(xs[i], right_sum)
   with tf.device(devices[left_center]):
@@ -399,10 +417,10 @@ def allreduce_ring_single_shard(xs, devices, reduction_fn_string="SUM"):
   if n % 2 == 0:
     with tf.device(devices[right_center]):
       result[right_center] = binary_reduction(left_sum, right_sum)
-  for i in reversed(xrange(left_center)):
+  for i in reversed(range(left_center)):
     with tf.device(devices[i]):
       result[i] = tf.identity(result[i + 1])
-  for i in xrange(right_center + 1, n):
+  for i in range(right_center + 1, n):
     with tf.device(devices[i]):
       result[i] = tf.identity(result[i - 1])
   return result
@@ -448,7 +466,7 @@ def allreduce_ring(xs, devices, reduction_fn_string="SUM"):
   x_split_t = mtf.transpose_list_of_lists(x_split)
 
   y_split_t = []
-  for shard in xrange(n):
+  for shard in range(n):
     shard_xs = _circular_shift(x_split_t[shard], shard)
     shard_devices = _circular_shift(devices, shard)
     shard_ys = allreduce_ring_single_shard(
@@ -476,10 +494,10 @@ def allconcat_ring(xs, devices, concat_axis):
   if n == 1:
     return xs
   # [target, source]
-  parts = [[xs[target] if target == source else None for source in xrange(n)]
-           for target in xrange(n)]
-  for distance in xrange(1, n // 2 + 1):
-    for target in xrange(n):
+  parts = [[xs[target] if target == source else None for source in range(n)]
+           for target in range(n)]
+  for distance in range(1, n // 2 + 1):
+    for target in range(n):
       source = (target + distance) % n
       if parts[target][source] is None:
         with tf.device(devices[target]):
@@ -533,7 +551,7 @@ def alltoall_ring(xs, devices, split_axis, concat_axis):
     return xs
   # set up
   # [target, source]
-  parts = [[None] * n for i in xrange(n)]
+  parts = [[None] * n for i in range(n)]
   def my_split(x, size_splits):
     total_size = tf.shape(x)[split_axis]
     part_size = total_size // sum(size_splits)
@@ -542,7 +560,7 @@ def alltoall_ring(xs, devices, split_axis, concat_axis):
   backward_message_size = (n - 1) - forward_message_size
   forward_messages = [None] * n
   backward_messages = [None] * n
-  for i in xrange(n):
+  for i in range(n):
     with tf.device(devices[i]):
       if i >= backward_message_size:
         a, b, c, d = my_split(
@@ -557,10 +575,10 @@ def alltoall_ring(xs, devices, split_axis, concat_axis):
         backward_messages[i] = tf.concat([d, a], axis=split_axis)
         parts[i][i] = b
         forward_messages[i] = c
-  for step in xrange(1, max(forward_message_size, backward_message_size) + 1):
+  for step in range(1, max(forward_message_size, backward_message_size) + 1):
     new_forward_messages = [None] * n
     new_backward_messages = [None] * n
-    for i in xrange(n):
+    for i in range(n):
       with tf.device(devices[i]):
         if forward_message_size > 0:
           parts[i][(i - step) % n], new_forward_messages[i] = my_split(
@@ -573,3 +591,53 @@ def alltoall_ring(xs, devices, split_axis, concat_axis):
     forward_messages = new_forward_messages
     backward_messages = new_backward_messages
   return mtf.parallel(devices, tf.concat, parts, axis=[concat_axis] * n)
+
+
+def einsum_as_batch_matmul(equation, a, b):
+  """Compute a two-operand einsum with tf.matmul.
+
+  Dimensions present in both inputs and the output are batch dimensions,
+  dimensions present in both inputs but not the output are contracted and
+  the remaining dimensions of each input are kept.  Transposes are skipped
+  where the inputs and the output are already in matmul order.
+
+  Args:
+    equation: a string, e.g. "abc,acd->abd"
+    a: a tf.Tensor with fully-defined shape
+    b: a tf.Tensor with fully-defined shape
+  Returns:
+    a tf.Tensor, or None if the equation is not a batched matmul.
+  """
+  inputs, output = equation.split("->")
+  a_letters, b_letters = inputs.split(",")
+  if (not a.shape.is_fully_defined() or not b.shape.is_fully_defined() or
+      any(len(set(x)) != len(x) for x in (a_letters, b_letters, output)) or
+      set(output) - set(a_letters + b_letters) or
+      (set(a_letters) ^ set(b_letters)) - set(output)):
+    return None
+  letter_to_size = dict(zip(a_letters, a.shape.as_list()))
+  letter_to_size.update(zip(b_letters, b.shape.as_list()))
+  batch = [c for c in output if c in a_letters and c in b_letters]
+  m = [c for c in a_letters if c not in b_letters]
+  n = [c for c in b_letters if c not in a_letters]
+  k = [c for c in a_letters if c in b_letters and c not in output]
+  batch_sizes = [letter_to_size[c] for c in batch]
+  def _to_matrix(x, letters, rows, cols):
+    """Transpose and reshape x to [batch..., rows, cols] or its transpose."""
+    transposed = letters == "".join(batch + cols + rows)
+    if transposed:
+      rows, cols = cols, rows
+    order = batch + rows + cols
+    if letters != "".join(order):
+      x = tf.transpose(x, [letters.index(c) for c in order])
+    inner = [mtf.list_product([letter_to_size[c] for c in d])
+             for d in (rows, cols)]
+    return tf.reshape(x, batch_sizes + inner), transposed
+  a_mat, transpose_a = _to_matrix(a, a_letters, m, k)
+  b_mat, transpose_b = _to_matrix(b, b_letters, k, n)
+  y = tf.matmul(a_mat, b_mat, transpose_a=transpose_a, transpose_b=transpose_b)
+  y_letters = batch + m + n
+  y = tf.reshape(y, [letter_to_size[c] for c in y_letters])
+  if "".join(y_letters) != output:
+    y = tf.transpose(y, [y_letters.index(c) for c in output])
+  return y
@@ -25,7 +25,6 @@ import os
 from mesh_tensorflow import ops_with_redefined_builtins as mtf
 from mesh_tensorflow import tpu_variables
 from mesh_tensorflow import utils
-from six.moves import xrange  # pylint: disable=redefined-builtin
 
 import tensorflow.compat.v1 as tf
 
@@ -155,13 +154,13 @@ class SimdMeshImpl(mtf.MeshImpl):
       init_device_stack = tf.get_default_graph()._device_function_stack
 
       if not mesh_impl.graph_device_function_stacks:
-        for pnum in xrange(mesh_impl.size):
+        for pnum in range(mesh_impl.size):
           tpu_device = mesh_impl.device_assignment.tpu_device(replica=pnum)
           with tf.device(tpu_device):
             mesh_impl.graph_device_function_stacks.append(
                 tf.get_default_graph()._device_function_stack.copy())
 
-      for physical_pnum in xrange(mesh_impl.size):
+      for physical_pnum in range(mesh_impl.size):
         slice_var_name = base_name + "_slice_%d" % physical_pnum
         # Use tf.Variable instead of tf.get_variable since latter adds lots of
         # useless operations to the TF graph.
@@ -231,7 +230,7 @@ class SimdMeshImpl(mtf.MeshImpl):
         assign_ops = [tf.assign(t, master_variable) for t in slices]
       else:
         slice_dict = {}
-        for logical_pnum in xrange(len(slices)):
+        for logical_pnum in range(len(slices)):
           slice_begin = mesh_impl.slice_begin(master_shape, logical_pnum)
           slice_begin_tuple = tuple(slice_begin)
           # Reuse the same slice if slice_begin doesn't change.
@@ -290,7 +289,7 @@ class SimdMeshImpl(mtf.MeshImpl):
     """Create group assignment for XLA cross replica ops (physical pnums)."""
 
     partitioning = {}
-    for logical_pnum in xrange(self.size):
+    for logical_pnum in range(self.size):
       group = mtf.pnum_to_group(self.shape, mesh_axes, logical_pnum)
       if group not in partitioning:
         partitioning[group] = []
@@ -363,7 +362,7 @@ class SimdMeshImpl(mtf.MeshImpl):
     t *= tf.reshape(
         tf.one_hot(coord.one_slice, num_parts, dtype=t.dtype),
         [num_parts if i == concat_axis else 1
-         for i in xrange(len(old_shape) + 1)])
+         for i in range(len(old_shape) + 1)])
     if not stack:
       new_shape = old_shape[:]
       new_shape[concat_axis] *= num_parts
@@ -426,7 +425,7 @@ class SimdMeshImpl(mtf.MeshImpl):
     t = x.one_slice
     source_target_pairs = []
 
-    for pnum in xrange(self.size):
+    for pnum in range(self.size):
       coord = mtf.pnum_to_processor_coordinates(self.shape, pnum)
       k = coord[mesh_axis]
       if source_pcoord[k] is not None:
@@ -456,7 +455,7 @@ class SimdMeshImpl(mtf.MeshImpl):
     else:
       slice_shape = self.slice_shape(tensor_shape)
       slice_begins = [
-          self.slice_begin(tensor_shape, pnum) for pnum in xrange(self.size)
+          self.slice_begin(tensor_shape, pnum) for pnum in range(self.size)
       ]
       slice_begins_tensor = tf.stack(slice_begins)
       # slice on source device
@@ -516,7 +515,7 @@ class SimdMeshImpl(mtf.MeshImpl):
     # identical slices, then allreducing by group.
     layout = self.tensor_layout(shape)
     # we need to sync across these axes.
-    mesh_axes = [i for i in xrange(self.ndims)
+    mesh_axes = [i for i in range(self.ndims)
                  if i not in layout.tensor_axis_to_mesh_axis]
     multiplier = 1.0
     for axis in mesh_axes:
@@ -91,12 +91,21 @@ class AttentionParams(object):
                variable_dtype,
                shared_kv=False,
                combine_dims=True,
-               ensemble_dim=None):
+               ensemble_dim=None,
+               fuse_qkv=False):
     """Create attention parameters.
 
     combine_dims is a hack for faster execution.  The heads and key/value
     dimensions are combined in the variables and the computation.  The hack
-    would not be necessary if XLA optimized einsum properly.
+    would not be necessary if XLA optimized einsum properly.  Without heads
+    (e.g. num_heads=1) there is nothing to combine, and the variables are the
+    same either way, so the reshapes are skipped.
+
+    If fuse_qkv is set, the query, key and value weights (or the query and
+    shared key/value weights) are stored in a single variable, stacked along
+    a "qkv" dimension, so that compute_qkv() can compute them with one einsum.
+    This requires the query and memory inputs and heads to match, and
+    key_dim == value_dim.
 
     Args:
       mesh: a Mesh
@@ -111,9 +120,15 @@ class AttentionParams(object):
       shared_kv: a boolean
       combine_dims: a boolean
       ensemble_dim: an optional Dimension
+      fuse_qkv: a boolean
     """
     if shared_kv and key_dim != value_dim:
       raise ValueError("shared_kv requires key_dim == value_dim")
+    if fuse_qkv and (query_input_dim != memory_input_dim or
+                     (query_heads_dims or []) != (memory_heads_dims or []) or
+                     key_dim != value_dim):
+      raise ValueError("fuse_qkv requires matching query and memory inputs, "
+                       "matching heads and key_dim == value_dim")
     self.query_input_dim = query_input_dim
     self.memory_input_dim = memory_input_dim
     self.output_dim = output_dim
@@ -123,6 +138,7 @@ class AttentionParams(object):
     self.memory_heads_dims = memory_heads_dims or []
     self.shared_kv = shared_kv
     self.combine_dims = combine_dims
+    self.fuse_qkv = fuse_qkv
     if combine_dims:
       q_shape = [query_input_dim, _combined_dim(self.q_dims)]
       k_shape = [memory_input_dim, _combined_dim(self.k_dims)]
@@ -139,21 +155,41 @@ class AttentionParams(object):
         stddev=memory_input_dim.size ** -0.5)
     o_init = tf.random_normal_initializer(
         stddev=mtf.Shape(self.query_heads_dims + [value_dim]).size ** -0.5)
+    if fuse_qkv:
+      self.qkv_dim = mtf.Dimension("qkv", 2 if shared_kv else 3)
+      qkv_shape = q_shape[:1] + [self.qkv_dim] + q_shape[1:]
+      qkv_init = mtf.layers.stacked_normal_initializer(
+          [(query_input_dim.size * key_dim.size) ** -0.5] +
+          [memory_input_dim.size ** -0.5] * (self.qkv_dim.size - 1),
+          axis=2 if ensemble_dim else 1)
     if ensemble_dim:
       q_shape = [ensemble_dim] + q_shape
       k_shape = [ensemble_dim] + k_shape
       v_shape = [ensemble_dim] + v_shape
       o_shape = [ensemble_dim] + o_shape
-    self.wq = mtf.get_variable(
-        mesh, "q", q_shape, initializer=q_init, dtype=variable_dtype)
-    if shared_kv:
-      self.wkv = mtf.get_variable(
-          mesh, "kv", k_shape, initializer=kv_init, dtype=variable_dtype)
+    if fuse_qkv:
+      if ensemble_dim:
+        qkv_shape = [ensemble_dim] + qkv_shape
+      self.wqkv = mtf.get_variable(
+          mesh, "qkv", qkv_shape, initializer=qkv_init, dtype=variable_dtype)
+      # Per-projection views, for compute_q(), compute_k() etc.
+      pieces = mtf.unstack(self.wqkv, self.qkv_dim)
+      self.wq = pieces[0]
+      if shared_kv:
+        self.wkv = pieces[1]
+      else:
+        self.wk, self.wv = pieces[1:]
     else:
-      self.wk = mtf.get_variable(
-          mesh, "k", k_shape, initializer=kv_init, dtype=variable_dtype)
-      self.wv = mtf.get_variable(
-          mesh, "v", v_shape, initializer=kv_init, dtype=variable_dtype)
+      self.wq = mtf.get_variable(
+          mesh, "q", q_shape, initializer=q_init, dtype=variable_dtype)
+      if shared_kv:
+        self.wkv = mtf.get_variable(
+            mesh, "kv", k_shape, initializer=kv_init, dtype=variable_dtype)
+      else:
+        self.wk = mtf.get_variable(
+            mesh, "k", k_shape, initializer=kv_init, dtype=variable_dtype)
+        self.wv = mtf.get_variable(
+            mesh, "v", v_shape, initializer=kv_init, dtype=variable_dtype)
     self.wo = mtf.get_variable(
         mesh, "o", o_shape, initializer=o_init, dtype=variable_dtype)
 
@@ -169,10 +205,30 @@ class AttentionParams(object):
     """
     ret = mtf.einsum(
         [query_antecedent, self.wq], reduced_dims=[self.query_input_dim])
-    if self.combine_dims:
+    if self.combine_dims and len(self.q_dims) > 1:
       ret = mtf.replace_dimensions(ret, ret.shape.dims[-1], self.q_dims)
     return ret
 
+  def compute_qkv(self, antecedent):
+    """Compute queries, keys and values with a single einsum.
+
+    Can only be called with fuse_qkv.
+
+    Args:
+      antecedent: a Tensor with dimensions
+        {query_input_dim} + other_dims
+    Returns:
+      a list [q, k, v] (or [q, kv] with shared_kv) of Tensors with dimensions
+        query_heads_dims + {key_dim} + other_dims
+    """
+    if not self.fuse_qkv:
+      raise ValueError("compute_qkv can only be called with fuse_qkv")
+    ret = mtf.einsum(
+        [antecedent, self.wqkv], reduced_dims=[self.query_input_dim])
+    if self.combine_dims and len(self.q_dims) > 1:
+      ret = mtf.replace_dimensions(ret, ret.shape.dims[-1], self.q_dims)
+    return mtf.unstack(ret, self.qkv_dim)
+
   def compute_kv(self, memory_antecedent):
     """Compute key/value Tensor kv.
 
@@ -187,7 +243,7 @@ class AttentionParams(object):
       raise ValueError("compute_kv can only be called with shared_kv")
     ret = mtf.einsum(
         [memory_antecedent, self.wkv], reduced_dims=[self.memory_input_dim])
-    if self.combine_dims:
+    if self.combine_dims and len(self.k_dims) > 1:
       ret = mtf.replace_dimensions(ret, ret.shape.dims[-1], self.k_dims)
     return ret
 
@@ -205,7 +261,7 @@ class AttentionParams(object):
       raise ValueError("compute_k cannot be called with shared_kv")
     ret = mtf.einsum(
         [memory_antecedent, self.wk], reduced_dims=[self.memory_input_dim])
-    if self.combine_dims:
+    if self.combine_dims and len(self.k_dims) > 1:
       ret = mtf.replace_dimensions(ret, ret.shape.dims[-1], self.k_dims)
     return ret
 
@@ -223,7 +279,7 @@ class AttentionParams(object):
       raise ValueError("compute_v cannot be called with shared_kv")
     ret = mtf.einsum(
         [memory_antecedent, self.wv], reduced_dims=[self.memory_input_dim])
-    if self.combine_dims:
+    if self.combine_dims and len(self.v_dims) > 1:
       ret = mtf.replace_dimensions(ret, ret.shape.dims[-1], self.v_dims)
     return ret
 
@@ -238,7 +294,7 @@ class AttentionParams(object):
       a Tensor with shape:
          {output_dim} + other_dims
     """
-    if self.combine_dims:
+    if self.combine_dims and len(self.o_dims) > 1:
       o = mtf.transpose(o, o.shape - self.o_dims + self.o_dims)
       o = mtf.replace_dimensions(o, self.o_dims, self.wo.shape.dims[-2])
       reduced_dims = [self.wo.shape.dims[-2]]
@@ -264,6 +320,131 @@ class AttentionParams(object):
     return self.query_heads_dims + [self.value_dim]
 
 
+class LatentAttentionParams(object):
+  """Parameters for attention through a low-rank key/value latent.
+
+  The memory is projected down to a single latent vector per position, of
+  size latent_dim, which is shared by all heads.  The key up-projection is
+  applied to the queries (compute_q_latent()) and the value up-projection to
+  the attention output (compute_o()), so the latents are attended to
+  directly and are all that needs to be cached for incremental decoding.
+  """
+
+  def __init__(self,
+               mesh,
+               input_dim,
+               output_dim,
+               key_dim,
+               value_dim,
+               heads_dims,
+               latent_dim,
+               variable_dtype,
+               ensemble_dim=None):
+    """Create latent attention parameters.
+
+    Args:
+      mesh: a Mesh
+      input_dim: a Dimension (the channels of queries and memory)
+      output_dim: a Dimension
+      key_dim: a Dimension
+      value_dim: a Dimension
+      heads_dims: a list of Dimension
+      latent_dim: a Dimension
+      variable_dtype: a mtf.VariableDType
+      ensemble_dim: an optional Dimension
+    """
+    self.query_input_dim = input_dim
+    self.memory_input_dim = input_dim
+    self.output_dim = output_dim
+    self.key_dim = key_dim
+    self.value_dim = value_dim
+    self.heads_dims = heads_dims or []
+    self.latent_dim = latent_dim
+    prefix = [ensemble_dim] if ensemble_dim else []
+    def _variable(name, shape, stddev):
+      return mtf.get_variable(
+          mesh, name, prefix + shape,
+          initializer=tf.random_normal_initializer(stddev=stddev),
+          dtype=variable_dtype)
+    self.wq = _variable(
+        "q", [input_dim] + self.heads_dims + [key_dim],
+        (input_dim.size * key_dim.size) ** -0.5)
+    self.w_latent = _variable(
+        "kv_latent", [input_dim, latent_dim], input_dim.size ** -0.5)
+    self.wk_up = _variable(
+        "k_up", [latent_dim] + self.heads_dims + [key_dim],
+        latent_dim.size ** -0.5)
+    self.wv_up = _variable(
+        "v_up", [latent_dim] + self.heads_dims + [value_dim],
+        latent_dim.size ** -0.5)
+    self.wo = _variable(
+        "o", self.heads_dims + [value_dim, output_dim],
+        mtf.Shape(self.heads_dims + [value_dim]).size ** -0.5)
+
+  def compute_q(self, query_antecedent):
+    """Compute query Tensor q.
+
+    Args:
+      query_antecedent: a Tensor with dimensions
+         {query_input_dim} + other_dims
+    Returns:
+      a Tensor with dimensions
+         heads_dims + {key_dim} + other_dims
+    """
+    return mtf.einsum(
+        [query_antecedent, self.wq], reduced_dims=[self.query_input_dim])
+
+  def compute_latent(self, memory_antecedent):
+    """Compute the key/value latent.
+
+    Args:
+      memory_antecedent: a Tensor with dimensions
+        {memory_input_dim} + other_dims
+    Returns:
+      a Tensor with dimensions
+        {latent_dim} + other_dims
+    """
+    return mtf.einsum(
+        [memory_antecedent, self.w_latent],
+        reduced_dims=[self.memory_input_dim])
+
+  def compute_q_latent(self, q):
+    """Apply the key up-projection to the queries.
+
+    Args:
+      q: a Tensor with dimensions heads_dims + {key_dim} + other_dims
+    Returns:
+      a Tensor with dimensions heads_dims + {latent_dim} + other_dims
+    """
+    return mtf.einsum([q, self.wk_up], reduced_dims=[self.key_dim])
+
+  def compute_o(self, o_latent):
+    """Apply the value up-projection to the attention output.
+
+    Args:
+      o_latent: a Tensor with dimensions
+        heads_dims + {latent_dim} + other_dims
+    Returns:
+      a Tensor with dimensions heads_dims + {value_dim} + other_dims
+    """
+    return mtf.einsum([o_latent, self.wv_up], reduced_dims=[self.latent_dim])
+
+  def compute_output(self, o, output_shape=None):
+    """Compute output of multihead attention.
+
+    Args:
+      o: a Tensor with dimensions
+         heads_dims + {value_dim} + other_dims
+      output_shape: an optional Shape
+    Returns:
+      a Tensor with shape:
+         {output_dim} + other_dims
+    """
+    return mtf.einsum(
+        [o, self.wo], output_shape=output_shape,
+        reduced_dims=self.heads_dims + [self.value_dim])
+
+
 def _combined_dim(dims):
   return mtf.Dimension(dims[0].name, mtf.Shape(dims).size)
 
@@ -399,6 +580,85 @@ def local_attention_1d(q,
   return mtf.replace_dimensions(o, [num_blocks, query_block_length], length_dim)
 
 
+def relative_position_bias(values, rp_bucket, buckets_dim):
+  """Look up relative attention biases by bucket.
+
+  Equivalent to mtf.gather(values, rp_bucket, buckets_dim), but when values
+  and rp_bucket have no dimensions in common, the lookup is a tf.gather on
+  each slice, and no one-hot Tensor of shape rp_bucket.shape + [buckets_dim]
+  is built.  buckets_dim must not be split.
+
+  Args:
+    values: a Tensor containing buckets_dim (e.g. [heads, buckets])
+    rp_bucket: an int32 Tensor (e.g. [length, memory_length])
+    buckets_dim: a Dimension
+  Returns:
+    a Tensor with the dimensions of values, where buckets_dim is replaced by
+    the dimensions of rp_bucket
+  Raises:
+    ValueError: when the graph is lowered, if buckets_dim is split.  Only the
+      output dimensions are declared splittable.
+  """
+  if set(values.shape.dims) & set(rp_bucket.shape.dims):
+    return mtf.gather(values, rp_bucket, buckets_dim)
+  axis = values.shape.dims.index(buckets_dim)
+  output_shape = mtf.Shape(values.shape.dims[:axis] + rp_bucket.shape.dims +
+                           values.shape.dims[axis + 1:])
+  def grad_function(op, dy):
+    return [mtf.einsum([mtf.one_hot(rp_bucket, buckets_dim, dtype=dy.dtype),
+                        dy], output_shape=op.inputs[0].shape),
+            None]
+  return mtf.slicewise(
+      lambda v, b: tf.gather(v, b, axis=axis),
+      [values, rp_bucket],
+      output_shape=output_shape,
+      output_dtype=values.dtype,
+      splittable_dims=output_shape.dims,
+      grad_function=grad_function,
+      name="relative_position_bias")
+
+
+def gather_positions(x, indices, length_dim):
+  """Look up positions along length_dim, separately for each batch element.
+
+  Equivalent to mtf.gather(x, indices, length_dim), but indices is a Tensor
+  with dimensions batch_dims + [d], where batch_dims are also dimensions of x
+  (e.g. [batch]), and the lookup is a batched tf.gather on each slice.  Only
+  the selected positions of x are read - no one-hot Tensor is built and
+  there is no reduction over length_dim.  length_dim must not be split.
+
+  Args:
+    x: a Tensor containing length_dim
+    indices: an int32 Tensor with dimensions batch_dims + [d]
+    length_dim: a Dimension
+  Returns:
+    a Tensor with dimensions indices.shape + (x.shape - batch_dims -
+      length_dim)
+  """
+  batch_dims = indices.shape.dims[:-1]
+  other_dims = [d for d in x.shape.dims
+                if d not in batch_dims and d != length_dim]
+  x_shape = mtf.Shape(batch_dims + [length_dim] + other_dims)
+  if x.shape != x_shape:
+    x = mtf.transpose(x, x_shape)
+  output_shape = mtf.Shape(indices.shape.dims + other_dims)
+  def slice_fn(x_slice, indices_slice):
+    return tf.gather(x_slice, indices_slice,
+                     axis=len(batch_dims), batch_dims=len(batch_dims))
+  def grad_function(op, dy):
+    return [mtf.einsum([mtf.one_hot(indices, length_dim, dtype=dy.dtype),
+                        dy], output_shape=op.inputs[0].shape),
+            None]
+  return mtf.slicewise(
+      slice_fn,
+      [x, indices],
+      output_shape=output_shape,
+      output_dtype=x.dtype,
+      splittable_dims=batch_dims + other_dims,
+      grad_function=grad_function,
+      name="gather_positions")
+
+
 def visibility_mask_to_attention_bias(visible, dtype):
   """Convert a boolean visibility mask to an attention bias.
 
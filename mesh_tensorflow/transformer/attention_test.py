@@ -0,0 +1,168 @@
+# coding=utf-8
+# Copyright 2019 The Mesh TensorFlow Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for mesh_tensorflow.transformer.attention."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from absl.testing import parameterized
+
+import mesh_tensorflow as mtf
+from mesh_tensorflow.transformer import attention
+
+import tensorflow.compat.v1 as tf
+
+
+class AttentionTest(parameterized.TestCase, tf.test.TestCase):
+
+  def _relative_position_bias_inputs(self, mesh):
+    heads_dim = mtf.Dimension("heads", 2)
+    buckets_dim = mtf.Dimension("buckets", 4)
+    length_dim = mtf.Dimension("length", 3)
+    memory_length_dim = mtf.Dimension("memory_length", 3)
+    values = mtf.import_tf_tensor(
+        mesh, tf.random_normal([2, 4]), shape=[heads_dim, buckets_dim])
+    rp_bucket = mtf.import_tf_tensor(
+        mesh, tf.constant([[0, 1, 2], [3, 0, 1], [2, 3, 0]]),
+        shape=[length_dim, memory_length_dim])
+    return values, rp_bucket, buckets_dim
+
+  @parameterized.parameters(("",), ("heads:all",), ("length:all",))
+  def testRelativePositionBias(self, layout):
+    graph = mtf.Graph()
+    mesh = mtf.Mesh(graph, "my_mesh")
+    values, rp_bucket, buckets_dim = self._relative_position_bias_inputs(mesh)
+    bias = attention.relative_position_bias(values, rp_bucket, buckets_dim)
+    expected_bias = mtf.gather(values, rp_bucket, buckets_dim)
+    w = mtf.import_tf_tensor(mesh, tf.random_normal([2, 3, 3]),
+                             shape=bias.shape)
+    [dvalues] = mtf.gradients([mtf.reduce_sum(bias * w)], [values])
+    [expected_dvalues] = mtf.gradients(
+        [mtf.reduce_sum(expected_bias * w)], [values])
+    mesh_impl = mtf.placement_mesh_impl.PlacementMeshImpl(
+        shape="all:2", layout=layout, devices=["", ""])
+    lowering = mtf.Lowering(graph, {mesh: mesh_impl})
+    outputs = [lowering.export_to_tf_tensor(t) for t in
+               [bias, expected_bias, dvalues, expected_dvalues]]
+    actual, expected, actual_grad, expected_grad = self.evaluate(outputs)
+    self.assertAllClose(actual, expected)
+    self.assertAllClose(actual_grad, expected_grad)
+
+  def testRelativePositionBiasSplitBuckets(self):
+    graph = mtf.Graph()
+    mesh = mtf.Mesh(graph, "my_mesh")
+    values, rp_bucket, buckets_dim = self._relative_position_bias_inputs(mesh)
+    attention.relative_position_bias(values, rp_bucket, buckets_dim)
+    mesh_impl = mtf.placement_mesh_impl.PlacementMeshImpl(
+        shape="all:2", layout="buckets:all", devices=["", ""])
+    with self.assertRaises(ValueError):
+      mtf.Lowering(graph, {mesh: mesh_impl})
+
+
+  def testLatentAttentionMatchesExplicitKeysAndValues(self):
+    graph = mtf.Graph()
+    mesh = mtf.Mesh(graph, "my_mesh")
+    batch_dim = mtf.Dimension("batch", 2)
+    length_dim = mtf.Dimension("length", 3)
+    memory_length_dim = mtf.Dimension("memory_length", 5)
+    io_dim = mtf.Dimension("io", 6)
+    key_dim = mtf.Dimension("d_k", 4)
+    heads_dim = mtf.Dimension("heads", 2)
+    params = attention.LatentAttentionParams(
+        mesh, input_dim=io_dim, output_dim=io_dim, key_dim=key_dim,
+        value_dim=key_dim, heads_dims=[heads_dim],
+        latent_dim=mtf.Dimension("d_latent", 3),
+        variable_dtype=mtf.VariableDType(tf.float32))
+    x = mtf.import_tf_tensor(mesh, tf.random_normal([2, 3, 6]),
+                             shape=[batch_dim, length_dim, io_dim])
+    m = mtf.import_tf_tensor(mesh, tf.random_normal([2, 5, 6]),
+                             shape=[batch_dim, memory_length_dim, io_dim])
+    q = params.compute_q(x)
+    latent = params.compute_latent(m)
+    o_latent = attention.attention(
+        params.compute_q_latent(q), latent, latent, memory_length_dim,
+        params.latent_dim, params.latent_dim)
+    y = params.compute_output(params.compute_o(o_latent), output_shape=x.shape)
+    k = mtf.einsum([latent, params.wk_up], reduced_dims=[params.latent_dim])
+    v = mtf.einsum([latent, params.wv_up], reduced_dims=[params.latent_dim])
+    o = attention.attention(q, k, v, memory_length_dim, key_dim, key_dim)
+    expected_y = params.compute_output(o, output_shape=x.shape)
+    mesh_impl = mtf.placement_mesh_impl.PlacementMeshImpl(
+        shape=[], layout={}, devices=[""])
+    lowering = mtf.Lowering(graph, {mesh: mesh_impl})
+    outputs = [lowering.export_to_tf_tensor(t) for t in [y, expected_y]]
+    self.evaluate(tf.global_variables_initializer())
+    self.evaluate(lowering.copy_masters_to_slices())
+    actual, expected = self.evaluate(outputs)
+    self.assertAllClose(actual, expected, rtol=1e-5, atol=1e-5)
+
+  @parameterized.parameters(
+      (1, False, True),
+      (2, False, True),
+      (2, True, True),
+      (2, False, False),
+  )
+  def testFusedQKVMatchesUnfused(self, num_heads, shared_kv, combine_dims):
+    graph = mtf.Graph()
+    mesh = mtf.Mesh(graph, "my_mesh")
+    batch_dim = mtf.Dimension("batch", 2)
+    length_dim = mtf.Dimension("length", 3)
+    io_dim = mtf.Dimension("io", 6)
+    key_dim = mtf.Dimension("d_k", 4)
+    heads_dims = [mtf.Dimension("heads", num_heads)] if num_heads > 1 else []
+    params = {}
+    for fuse_qkv in [True, False]:
+      with tf.variable_scope("fused" if fuse_qkv else "unfused"):
+        params[fuse_qkv] = attention.AttentionParams(
+            mesh, query_input_dim=io_dim, memory_input_dim=io_dim,
+            output_dim=io_dim, key_dim=key_dim, value_dim=key_dim,
+            query_heads_dims=heads_dims, memory_heads_dims=heads_dims,
+            variable_dtype=mtf.VariableDType(tf.float32),
+            shared_kv=shared_kv, combine_dims=combine_dims,
+            fuse_qkv=fuse_qkv)
+    x = mtf.import_tf_tensor(mesh, tf.random_normal([2, 3, 6]),
+                             shape=[batch_dim, length_dim, io_dim])
+    unfused = params[False]
+    if shared_kv:
+      names = ["q", "kv"]
+      expected = [unfused.compute_q(x), unfused.compute_kv(x)]
+    else:
+      names = ["q", "k", "v"]
+      expected = [unfused.compute_q(x), unfused.compute_k(x),
+                  unfused.compute_v(x)]
+    actual = [mtf.transpose(t, e.shape)
+              for t, e in zip(params[True].compute_qkv(x), expected)]
+    mesh_impl = mtf.placement_mesh_impl.PlacementMeshImpl(
+        shape=[], layout={}, devices=[""])
+    lowering = mtf.Lowering(graph, {mesh: mesh_impl})
+    outputs = [lowering.export_to_tf_tensor(t) for t in actual + expected]
+
+    # Copy the slices of the stacked variable into the separate variables.
+    wqkv = graph.name_to_variable["fused/qkv"].get_master()
+    assign = tf.group(
+        [graph.name_to_variable["unfused/" + name].assign_to_master(
+            wqkv[:, i]) for i, name in enumerate(names)])
+    self.evaluate(tf.global_variables_initializer())
+    self.evaluate(assign)
+    self.evaluate(lowering.copy_masters_to_slices())
+    outputs = self.evaluate(outputs)
+    for a, e in zip(outputs[:len(names)], outputs[len(names):]):
+      self.assertAllClose(a, e, rtol=1e-5, atol=1e-5)
+
+if __name__ == "__main__":
+  tf.disable_v2_behavior()
+  tf.test.main()
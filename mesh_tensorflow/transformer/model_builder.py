@@ -47,7 +47,7 @@ def simple_layer_stack(include_encdec_attention,
     a LayerStack
   """
   ret = []
-  for _ in xrange(num_layers):
+  for _ in range(num_layers):
     ret.append(
         transformer_layers.SelfAttention(
             num_heads=num_heads,
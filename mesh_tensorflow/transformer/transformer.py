@@ -514,13 +514,14 @@ class Unitransformer(object):
         logits,
         soft_targets,
         output_vocab_dim,
-        z_loss=self.z_loss if context.train else 0.0)
-    weights = mtf.layers.weights_nonzero(
-        targets, dtype=context.activation_dtype)
+        z_loss=self.z_loss if context.train else 0.0,
+        targets_sum_to_one=True)
+    loss = mtf.layers.weights_nonzero_mul(
+        targets, loss, dtype=context.activation_dtype)
     if self.loss_on_targets_only:
-      weights *= mtf.cast(mtf.logical_not(text2self_inputs_mask(targets)),
-                          dtype=context.activation_dtype)
-    return mtf.reduce_sum(loss * weights) / self.loss_denominator(targets)
+      loss *= mtf.cast(mtf.logical_not(text2self_inputs_mask(targets)),
+                       dtype=context.activation_dtype)
+    return mtf.reduce_sum(loss) / self.loss_denominator(targets)
 
   def _call_internal(self, context, inputs, targets=None):
     """Compute logits based on inputs (all positions in parallel).
@@ -1347,9 +1348,9 @@ class StudentTeacher(object):
         z_loss=z_loss)
 
     # Ignore losses from padding regions.
-    weights = mtf.layers.weights_nonzero(
-        targets, dtype=variable_dtype.activation_dtype)
-    soft_loss = (mtf.reduce_sum(soft_loss * weights) /
+    soft_loss = mtf.layers.weights_nonzero_mul(
+        targets, soft_loss, dtype=variable_dtype.activation_dtype)
+    soft_loss = (mtf.reduce_sum(soft_loss) /
                  self.student.loss_denominator(targets))
 
     loss = (1.0 - self.fraction_soft) * hard_loss \
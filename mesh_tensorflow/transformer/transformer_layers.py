@@ -35,15 +35,28 @@ import tensorflow.compat.v1 as tf
 class DenseReluDense(transformer.TransformerLayer):
   """Two fully-connected layers with feed-forward activation."""
 
-  def __init__(self, hidden_size=4096, dropout_rate=0.0):
+  def __init__(self,
+               hidden_size=4096,
+               dropout_rate=0.0,
+               fused_ffn=False,
+               num_hidden_chunks=1):
     """Create a DenseReluDense.
 
     Args:
       hidden_size: an integer - size of the hidden layer
       dropout_rate: a floating-point number
+      fused_ffn: a boolean - when no dropout is applied, compute the layer as
+        a single mtf.fused_ffn operation, so that the hidden activation is
+        recomputed in the backward pass instead of being stored.  Uses the
+        same variables.
+      num_hidden_chunks: an integer - with fused_ffn, each slice of the hidden
+        layer is computed in this many pieces, so that only one piece of it
+        is live at a time.  See mtf.fused_ffn.
     """
     self.hidden_size = hidden_size
     self.dropout_rate = dropout_rate
+    self.fused_ffn = fused_ffn
+    self.num_hidden_chunks = num_hidden_chunks
 
   def call(self, context, x, losses=None):
     """Call the layer."""
@@ -53,11 +66,25 @@ class DenseReluDense(transformer.TransformerLayer):
       expert_dims = [context.model.ensemble_dim]
     else:
       expert_dims = None
+    use_dropout = context.train and self.dropout_rate != 0.0
+    if self.fused_ffn and not use_dropout:
+      with tf.variable_scope("wi"):
+        wi = mtf.layers.dense_kernel(
+            context.mesh, [io_channels], [hidden_channels],
+            context.variable_dtype, expert_dims=expert_dims)
+      with tf.variable_scope("wo"):
+        wo = mtf.layers.dense_kernel(
+            context.mesh, [hidden_channels], [io_channels],
+            context.variable_dtype, expert_dims=expert_dims)
+      return mtf.fused_ffn(
+          x, mtf.cast(wi, x.dtype), mtf.cast(wo, x.dtype),
+          hidden_shape=x.shape - io_channels + hidden_channels,
+          num_hidden_chunks=self.num_hidden_chunks)
     h = mtf.layers.dense(x, hidden_channels,
                          use_bias=False, activation=mtf.relu,
                          variable_dtype=context.variable_dtype,
                          name="wi", expert_dims=expert_dims)
-    if context.train and self.dropout_rate != 0.0:
+    if use_dropout:
       h = mtf.dropout(h, 1.0 - self.dropout_rate,
                       noise_shape=h.shape - context.length_dim)
     return mtf.layers.dense(h, io_channels, use_bias=False, activation=None,
@@ -69,7 +96,8 @@ def attention_params(context,
                      kv_dim,
                      num_heads,
                      num_memory_heads=0,
-                     shared_kv=False):
+                     shared_kv=False,
+                     fuse_qkv=False):
   """Attention Parameters for Transformer Layers.
 
   The num_heads argument indicates the number of read-heads.
@@ -91,6 +119,8 @@ def attention_params(context,
     num_heads: an integer
     num_memory_heads: an optional integer
     shared_kv: a boolean
+    fuse_qkv: a boolean - store the query, key and value weights in one
+      variable (see attention.AttentionParams)
   Returns:
     an attention.AttentionParams object
   """
@@ -120,7 +150,8 @@ def attention_params(context,
       memory_heads_dims=memory_heads_dims,
       variable_dtype=context.variable_dtype,
       shared_kv=shared_kv,
-      ensemble_dim=context.model.ensemble_dim)
+      ensemble_dim=context.model.ensemble_dim,
+      fuse_qkv=fuse_qkv)
 
 
 @gin.configurable
@@ -135,7 +166,9 @@ class SelfAttention(transformer.TransformerLayer):
                dropout_rate=0.0,
                attention_kwargs=None,
                relative_attention_type=None,
-               relative_attention_num_buckets=32):
+               relative_attention_num_buckets=32,
+               fuse_qkv=False,
+               latent_size=None):
     """Create a SelfAttention Layer.
 
     Args:
@@ -148,55 +181,99 @@ class SelfAttention(transformer.TransformerLayer):
       relative_attention_type: an optional string - one of
         (None, "bias", "bias_shared", "contextual")
       relative_attention_num_buckets: an integer
+      fuse_qkv: a boolean - compute the queries, keys and values with a single
+        einsum.  Changes the variables, so checkpoints are not compatible.
+      latent_size: an optional integer - if set, the keys and values are
+        computed from a shared latent of this size, and only the latent is
+        cached for incremental decoding (see attention.LatentAttentionParams).
+        Not compatible with shared_kv or fuse_qkv.
+
+    Raises:
+      ValueError: if latent_size is combined with shared_kv or fuse_qkv.
     """
+    if latent_size and (shared_kv or fuse_qkv):
+      raise ValueError("latent_size can not be used with shared_kv or fuse_qkv")
     self.num_heads = num_heads
     self.num_memory_heads = num_memory_heads
     self.key_value_size = key_value_size
+    self.kv_dim = mtf.Dimension("d_kv", key_value_size)
     self.shared_kv = shared_kv
     self.dropout_rate = dropout_rate
     self.attention_kwargs = attention_kwargs or {}
+    # (train, length_dim) -> merged kwargs - see attention_kwargs_from_context
+    self._attention_kwargs_cache = {}
     self.relative_attention_type = relative_attention_type
     self.relative_attention_num_buckets = relative_attention_num_buckets
+    self.fuse_qkv = fuse_qkv
+    self.latent_size = latent_size
 
   def attention_kwargs_from_context(self, context):
-    kwargs = copy.copy(self.attention_kwargs)
-    kwargs["dropout_rate"] = self.dropout_rate if context.train else 0.0
-    if "dropout_broadcast_dims" not in kwargs:
-      kwargs["dropout_broadcast_dims"] = [context.length_dim]
-    return kwargs
+    # The result is shared between calls, so callers must not modify it.
+    key = (bool(context.train), context.length_dim)
+    if key not in self._attention_kwargs_cache:
+      kwargs = copy.copy(self.attention_kwargs)
+      kwargs["dropout_rate"] = self.dropout_rate if context.train else 0.0
+      if "dropout_broadcast_dims" not in kwargs:
+        kwargs["dropout_broadcast_dims"] = [context.length_dim]
+      self._attention_kwargs_cache[key] = kwargs
+    return self._attention_kwargs_cache[key]
 
   def make_params(self, context):
+    if self.latent_size:
+      return attention.LatentAttentionParams(
+          context.mesh,
+          input_dim=context.model.model_dim,
+          output_dim=context.model.model_dim,
+          key_dim=self.kv_dim,
+          value_dim=self.kv_dim,
+          heads_dims=([mtf.Dimension("heads", self.num_heads)]
+                      if self.num_heads > 1 else []),
+          latent_dim=mtf.Dimension("d_latent", self.latent_size),
+          variable_dtype=context.variable_dtype,
+          ensemble_dim=context.model.ensemble_dim)
     return attention_params(context=context,
                             kv_dim=self.kv_dim,
                             num_heads=self.num_heads,
                             num_memory_heads=self.num_memory_heads,
-                            shared_kv=self.shared_kv)
+                            shared_kv=self.shared_kv,
+                            fuse_qkv=self.fuse_qkv)
 
   def call(self, context, x, losses=None):
     """Call the layer."""
     params = self.make_params(context)
-    q = params.compute_q(x)
     memory_length = self.memory_length(context)
-    if context.mode == "incremental":
-      m = x
-    else:
-      m = mtf.replace_dimensions(x, context.length_dim, memory_length)
-    if self.shared_kv:
-      kv = params.compute_kv(m)
+    if self.latent_size:
+      return self._call_latent(context, x, params, memory_length)
+    if self.fuse_qkv:
+      qkv = params.compute_qkv(x)
+      q = qkv[0]
+      if context.mode != "incremental":
+        qkv = [q] + [mtf.replace_dimensions(t, context.length_dim,
+                                            memory_length) for t in qkv[1:]]
+      if self.shared_kv:
+        kv = qkv[1]
+      else:
+        k, v = qkv[1:]
     else:
-      k = params.compute_k(m)
-      v = params.compute_v(m)
+      q = params.compute_q(x)
+      if context.mode == "incremental":
+        m = x
+      else:
+        m = mtf.replace_dimensions(x, context.length_dim, memory_length)
+      if self.shared_kv:
+        kv = params.compute_kv(m)
+      else:
+        k = params.compute_k(m)
+        v = params.compute_v(m)
     if context.mode == "incremental":
-      one_hot = mtf.one_hot(
-          context.position, memory_length, dtype=context.activation_dtype)
-      inv_one_hot = 1.0 - one_hot
+      # Write only the current position of the cached keys and values.
       if self.shared_kv:
-        old_kv = context.get_states(1)
-        kv = old_kv * inv_one_hot + kv * one_hot
+        old_kv, = context.get_states(1)
+        kv = mtf.scatter_update(old_kv, context.position, kv, memory_length)
       else:
         old_k, old_v = context.get_states(2)
-        k = old_k * inv_one_hot + k * one_hot
-        v = old_v * inv_one_hot + v * one_hot
+        k = mtf.scatter_update(old_k, context.position, k, memory_length)
+        v = mtf.scatter_update(old_v, context.position, v, memory_length)
       memory_position = mtf.range(context.mesh, memory_length, tf.int32)
     else:
       memory_position = self.rename_length_to_memory_length(
@@ -215,6 +292,32 @@ class SelfAttention(transformer.TransformerLayer):
         **self.attention_kwargs_from_context(context))
     return params.compute_output(o, output_shape=x.shape)
 
+  def _call_latent(self, context, x, params, memory_length):
+    """Self-attention through a key/value latent (see latent_size)."""
+    q = params.compute_q(x)
+    if context.mode == "incremental":
+      latent = params.compute_latent(x)
+      old_latent, = context.get_states(1)
+      latent = mtf.scatter_update(
+          old_latent, context.position, latent, memory_length)
+      memory_position = mtf.range(context.mesh, memory_length, tf.int32)
+    else:
+      latent = params.compute_latent(
+          self.rename_length_to_memory_length(x, context))
+      memory_position = self.rename_length_to_memory_length(
+          context.position, context)
+    if context.mode == "incremental" or context.mode == "first_part":
+      context.record_new_states([latent])
+    o_latent = attention.attention(
+        params.compute_q_latent(q), latent, latent,
+        memory_length,
+        params.latent_dim,
+        params.latent_dim,
+        self.compute_bias(context, memory_position, x),
+        **self.attention_kwargs_from_context(context))
+    return params.compute_output(
+        params.compute_o(o_latent), output_shape=x.shape)
+
   def compute_bias(self, context, memory_position, x):
     """Compute attention bias.
 
@@ -239,23 +342,6 @@ class SelfAttention(transformer.TransformerLayer):
                    self.num_heads)
       if cache_key in context.cache:
         return context.cache[cache_key]
-    biases = []
-    relative_position = memory_position - context.position
-    if min_relative_position is not None:
-      visible = mtf.greater_equal(relative_position, min_relative_position)
-      biases.append(attention.visibility_mask_to_attention_bias(
-          visible, context.activation_dtype))
-    if max_relative_position is not None:
-      visible = mtf.less_equal(relative_position, max_relative_position)
-      biases.append(attention.visibility_mask_to_attention_bias(
-          visible, context.activation_dtype))
-    if context.read_priority is not None:
-      visible = mtf.greater_equal(
-          context.read_priority,
-          mtf.layers.rename_length_to_memory_length(context.write_priority))
-      biases.append(attention.visibility_mask_to_attention_bias(
-          visible, context.activation_dtype))
-
     sequence_id = None
     # Subsequence id should only be set if we are in the decoder and have
     # multiple targets per input. This will allow each sub-target to only attend
@@ -264,21 +350,62 @@ class SelfAttention(transformer.TransformerLayer):
       sequence_id = context.subsequence_id
     elif isinstance(context.sequence_id, mtf.Tensor):
       sequence_id = context.sequence_id
-    if (sequence_id is not None and context.length_dim in sequence_id.shape):
-      visible = mtf.equal(
+    if sequence_id is not None and context.length_dim not in sequence_id.shape:
+      sequence_id = None
+    needs_relative_position = (
+        min_relative_position is not None or
+        max_relative_position is not None or
+        self.relative_attention_type is not None)
+    if (not needs_relative_position and
+        context.read_priority is None and sequence_id is None):
+      # No bias at all - don't build any ops.
+      return None
+    # The visibility masks are combined as booleans, and converted to a single
+    # bias, rather than building and summing a float bias for each of them.
+    masks = []
+    if needs_relative_position:
+      # All layers with the same positions share the relative positions.
+      rel_pos_key = ("relative_position", context.position, memory_position)
+      if rel_pos_key not in context.cache:
+        context.cache[rel_pos_key] = memory_position - context.position
+      relative_position = context.cache[rel_pos_key]
+    if min_relative_position is not None:
+      masks.append(
+          mtf.greater_equal(relative_position, min_relative_position))
+    if max_relative_position is not None:
+      masks.append(mtf.less_equal(relative_position, max_relative_position))
+    if context.read_priority is not None:
+      masks.append(mtf.greater_equal(
+          context.read_priority,
+          mtf.layers.rename_length_to_memory_length(context.write_priority)))
+    if sequence_id is not None:
+      masks.append(mtf.equal(
           sequence_id,
-          self.rename_length_to_memory_length(sequence_id, context))
-      biases.append(attention.visibility_mask_to_attention_bias(
-          visible, context.activation_dtype))
+          self.rename_length_to_memory_length(sequence_id, context)))
+    mask_bias = None
+    if masks:
+      visible = masks[0]
+      for mask in masks[1:]:
+        visible = mtf.logical_and(visible, mask)
+      mask_bias = attention.visibility_mask_to_attention_bias(
+          visible, context.activation_dtype)
     if self.relative_attention_type is not None:
       buckets_dim = mtf.Dimension(
           "buckets", self.relative_attention_num_buckets)
       heads_dim = mtf.Dimension("heads", self.num_heads)
       bidirectional = not context.model.fully_autoregressive
-      rp_bucket = _relative_position_bucket(
-          relative_position,
-          bidirectional=bidirectional,
-          num_buckets=buckets_dim.size)
+      # The buckets are the same for all layers with the same positions.
+      bucket_key = ("rp_bucket",
+                    context.position,
+                    memory_position,
+                    bidirectional,
+                    buckets_dim.size)
+      if bucket_key not in context.cache:
+        context.cache[bucket_key] = _relative_position_bucket(
+            relative_position,
+            bidirectional=bidirectional,
+            num_buckets=buckets_dim.size)
+      rp_bucket = context.cache[bucket_key]
       if (self.relative_attention_type == "bias" or
           self.relative_attention_type == "bias_shared"):
         bias_shape = [heads_dim, buckets_dim]
@@ -300,22 +427,33 @@ class SelfAttention(transformer.TransformerLayer):
       else:
         raise ValueError("unrecognized relative_attention_type \"%s\"" %
                          self.relative_attention_type)
-      biases.append(mtf.gather(values, rp_bucket, buckets_dim))
-    ret = mtf.add_n(biases) if biases else None
+      rel_bias = attention.relative_position_bias(
+          values, rp_bucket, buckets_dim)
+      # Summing the biases first keeps a single pass over the full logits.
+      ret = (mtf.add_n([mask_bias, rel_bias]) if mask_bias is not None
+             else rel_bias)
+    else:
+      ret = mask_bias
     if can_cache:
       context.cache[cache_key] = ret
     return ret
 
-  @property
-  def kv_dim(self):
-    return mtf.Dimension("d_kv", self.key_value_size)
-
   def memory_length(self, context):
-    return mtf.Dimension("memory_length", context.length_dim.size)
+    key = ("memory_length", context.length_dim.size)
+    if key not in context.cache:
+      context.cache[key] = mtf.Dimension(
+          "memory_length", context.length_dim.size)
+    return context.cache[key]
 
   def rename_length_to_memory_length(self, x, context):
-    return mtf.replace_dimensions(
-        x, context.length_dim, self.memory_length(context))
+    # Tensors such as context.position are renamed by every layer, so the
+    # renamed Tensor is cached on the context.
+    memory_length = self.memory_length(context)
+    key = ("rename_length_to_memory_length", x, memory_length)
+    if key not in context.cache:
+      context.cache[key] = mtf.replace_dimensions(
+          x, context.length_dim, memory_length)
+    return context.cache[key]
 
   def min_relative_position(self, context):
     return None
@@ -328,6 +466,21 @@ class SelfAttention(transformer.TransformerLayer):
 class EncDecAttention(SelfAttention):
   """Multi-head attention over encoder output."""
 
+  def __init__(self, latent_size=None, **kwargs):
+    """Create an EncDecAttention Layer.
+
+    Args:
+      latent_size: must be None - latent keys and values are only supported
+        in SelfAttention.
+      **kwargs: additional constructor params (see SelfAttention)
+
+    Raises:
+      ValueError: if latent_size is set.
+    """
+    if latent_size:
+      raise ValueError("latent_size is not supported in EncDecAttention")
+    super(EncDecAttention, self).__init__(**kwargs)
+
   def _get_memory_antecedent(self, context):
     return context.encoder_output
 
@@ -425,11 +578,7 @@ class TransparentEncDecAttention(EncDecAttention):
     if hasattr(context, "decoder_layers_per_module"):
       return context.decoder_layers_per_module
 
-    encoder_layer_outputs = [
-        mtf.layers.rename_length_to_memory_length(output)
-        for output in context.encoder_layer_outputs
-    ]
-
+    encoder_layer_outputs = context.encoder_layer_outputs
     layers_per_module = self.layers_per_encoder_module
     encoder_module_outputs_dim = mtf.Dimension(
         "encoder_module_outputs", size=self.encoder_num_modules + 1)
@@ -439,6 +588,9 @@ class TransparentEncDecAttention(EncDecAttention):
         [encoder_layer_outputs[0]] +
         encoder_layer_outputs[layers_per_module::layers_per_module],
         dim_name="encoder_module_outputs")
+    # Rename once on the stacked Tensor rather than once per encoder layer.
+    encoder_module_outputs = mtf.layers.rename_length_to_memory_length(
+        encoder_module_outputs)
     w = mtf.get_variable(
         context.mesh,
         "w",
@@ -452,13 +604,8 @@ class TransparentEncDecAttention(EncDecAttention):
     s = mtf.softmax(w, reduced_dim=encoder_module_outputs_dim)
     z = mtf.einsum([s, encoder_module_outputs],
                    reduced_dims=[encoder_module_outputs_dim])
-    input_per_decoder = mtf.split(
-        z,
-        split_dim=decoder_module_inputs_dim,
-        num_or_size_splits=decoder_module_inputs_dim.size)
-    context.decoder_layers_per_module = [
-        mtf.reshape(inpt, z.shape.dims[1:]) for inpt in input_per_decoder
-    ]
+    context.decoder_layers_per_module = mtf.unstack(
+        z, decoder_module_inputs_dim)
     return context.decoder_layers_per_module
 
 
@@ -473,46 +620,55 @@ class LocalSelfAttention(SelfAttention):
                key_value_size=128,
                shared_kv=False,
                dropout_rate=0.0,
-               attention_kwargs=None,):
+               attention_kwargs=None,
+               fuse_qkv=False):
     super(LocalSelfAttention, self).__init__(
         num_heads,
         num_memory_heads,
         key_value_size,
         shared_kv,
         dropout_rate,
-        attention_kwargs)
+        attention_kwargs,
+        fuse_qkv=fuse_qkv)
     self.radius = radius
+    self.window_dim = mtf.Dimension("window", radius)
 
   def call(self, context, x, losses=None):
     """Call the layer."""
     params = self.make_params(context)
-    q = params.compute_q(x)
-    if self.shared_kv:
-      kv = params.compute_kv(x)
-      k = kv
-      v = kv
+    if self.fuse_qkv:
+      qkv = params.compute_qkv(x)
+      q = qkv[0]
+      if self.shared_kv:
+        kv = qkv[1]
+        k = kv
+        v = kv
+      else:
+        k, v = qkv[1:]
     else:
-      k = params.compute_k(x)
-      v = params.compute_v(x)
+      q = params.compute_q(x)
+      if self.shared_kv:
+        kv = params.compute_kv(x)
+        k = kv
+        v = kv
+      else:
+        k = params.compute_k(x)
+        v = params.compute_v(x)
     if context.mode == "incremental":
       if self.shared_kv:
         prev_kv, = context.get_states(1)
       else:
         prev_k, prev_v = context.get_states(2)
-      current_position = mtf.equal(
-          mtf.range(context.mesh, self.window_dim, dtype=tf.int32),
-          mtf.mod(context.position, self.radius))
+      # Write only the current slot of the window.
+      current_position = mtf.mod(context.position, self.radius)
       if self.shared_kv:
-        kv = mtf.where(current_position, kv, prev_kv,
-                       output_shape=prev_kv.shape)
+        kv = mtf.scatter_update(prev_kv, current_position, kv, self.window_dim)
         k = kv
         v = kv
         context.record_new_states([kv])
       else:
-        k = mtf.where(current_position, params.compute_k(x), prev_k,
-                      output_shape=prev_k.shape)
-        v = mtf.where(current_position, params.compute_v(x), prev_v,
-                      output_shape=prev_v.shape)
+        k = mtf.scatter_update(prev_k, current_position, k, self.window_dim)
+        v = mtf.scatter_update(prev_v, current_position, v, self.window_dim)
         context.record_new_states([k, v])
       window_pos = mtf.range(context.mesh, self.window_dim, tf.int32)
       visible = mtf.greater_equal(context.position, window_pos)
@@ -557,26 +713,20 @@ class LocalSelfAttention(SelfAttention):
           read_priority=context.read_priority,
           attention_kwargs=self.attention_kwargs_from_context(context))
     if context.mode == "first_part":
+      # Window slot w holds the position p in
+      # [initial_position - radius, initial_position) with p % radius == w,
+      # or zeros if p < 0.
       window_pos = mtf.range(context.mesh, self.window_dim, tf.int32)
-      pos = mtf.range(context.mesh, context.length_dim, tf.int32)
-      select_recent = mtf.cast(
-          mtf.equal(mtf.mod(pos, self.radius), window_pos), x.dtype)
-      select_recent *= mtf.cast(
-          mtf.less(pos, context.initial_position), x.dtype)
-      select_recent *= mtf.cast(
-          mtf.greater_equal(
-              pos, context.initial_position - self.radius), x.dtype)
+      start = context.initial_position - self.radius
+      recent_pos = start + mtf.mod(window_pos - start, self.radius)
+      valid = mtf.cast(mtf.greater_equal(recent_pos, 0), x.dtype)
+      recent_pos = mtf.maximum(recent_pos, 0)
       state_shape = (k.shape - [context.length_dim, self.kv_dim]
                      + [self.window_dim, self.kv_dim])
-      k_state = mtf.einsum(
-          [k, select_recent], output_shape=state_shape,
-          reduced_dims=[context.length_dim])
-      context.new_states.append(k_state)
-      if not self.shared_kv:
-        v_state = mtf.einsum(
-            [v, select_recent], output_shape=state_shape,
-            reduced_dims=[context.length_dim])
-        context.new_states.append(v_state)
+      for t in [k] if self.shared_kv else [k, v]:
+        state = attention.gather_positions(t, recent_pos, context.length_dim)
+        state = mtf.multiply(state, valid, output_shape=state_shape)
+        context.new_states.append(state)
     return params.compute_output(o, output_shape=x.shape)
 
   def min_relative_position(self, context):
@@ -585,10 +735,6 @@ class LocalSelfAttention(SelfAttention):
   def max_relative_position(self, context):
     return None if context.model.fully_autoregressive else self.radius
 
-  @property
-  def window_dim(self):
-    return mtf.Dimension("window", self.radius)
-
 
 def _relative_position_bucket(relative_position,
                               bidirectional=True,
@@ -626,10 +772,23 @@ def _relative_position_bucket(relative_position,
     n = mtf.maximum(n, 0)
   # now n is in the range [0, inf)
   max_exact = num_buckets // 2
-  is_small = mtf.less(n, max_exact)
+  # val_if_large is concave in n and equals max_exact at n == max_exact.  If
+  # its slope there is at most 1, then val_if_large <= n for all
+  # n >= max_exact, and the small/large selection is just a minimum.
+  branchless = (
+      num_buckets - max_exact <= max_exact * math.log(max_distance / max_exact))
+  if branchless:
+    # Clamp so the log is defined and val_if_large >= max_exact > n for
+    # small n.
+    n_for_log = mtf.maximum(n, max_exact)
+  else:
+    n_for_log = n
   val_if_large = max_exact + mtf.to_int32(
-      mtf.log(mtf.to_float(n) / max_exact)
+      mtf.log(mtf.to_float(n_for_log) / max_exact)
       / math.log(max_distance / max_exact) * (num_buckets - max_exact))
   val_if_large = mtf.minimum(val_if_large, num_buckets - 1)
-  ret += mtf.where(is_small, n, val_if_large)
+  if branchless:
+    ret += mtf.minimum(n, val_if_large)
+  else:
+    ret += mtf.where(mtf.less(n, max_exact), n, val_if_large)
   return ret
@@ -0,0 +1,198 @@
+# coding=utf-8
+# Copyright 2019 The Mesh TensorFlow Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for mesh_tensorflow.transformer.transformer_layers."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import math
+
+from absl.testing import parameterized
+
+import mesh_tensorflow as mtf
+from mesh_tensorflow.transformer import transformer
+from mesh_tensorflow.transformer import transformer_layers
+
+import tensorflow.compat.v1 as tf
+
+
+# The attributes of a Unitransformer which the attention layers read.
+_Model = collections.namedtuple(
+    "_Model", ["model_dim", "ensemble_dim", "fully_autoregressive"])
+
+
+class TransformerLayersTest(parameterized.TestCase, tf.test.TestCase):
+
+  def setUp(self):
+    super(TransformerLayersTest, self).setUp()
+    self.graph = mtf.Graph()
+    self.mesh = mtf.Mesh(self.graph, "my_mesh")
+    self.batch_dim = mtf.Dimension("batch", 2)
+    self.length_dim = mtf.Dimension("length", 4)
+    self.model = _Model(model_dim=mtf.Dimension("d_model", 6),
+                        ensemble_dim=None,
+                        fully_autoregressive=True)
+    self.variable_dtype = mtf.VariableDType(tf.float32)
+
+  def _context(self, mode, **kwargs):
+    return transformer.Context(
+        model=self.model,
+        mesh=self.mesh,
+        batch_dims=[self.batch_dim],
+        length_dim=self.length_dim,
+        variable_dtype=self.variable_dtype,
+        mode=mode,
+        **kwargs)
+
+  def _evaluate(self, tensors):
+    mesh_impl = mtf.placement_mesh_impl.PlacementMeshImpl(
+        shape=[], layout={}, devices=[""])
+    lowering = mtf.Lowering(self.graph, {self.mesh: mesh_impl})
+    outputs = [lowering.export_to_tf_tensor(t) for t in tensors]
+    self.evaluate(tf.global_variables_initializer())
+    self.evaluate(lowering.copy_masters_to_slices())
+    return self.evaluate(outputs)
+
+  def _incremental_matches_full(self, layer):
+    """Run layer causally over a sequence, and one position at a time.
+
+    Args:
+      layer: a transformer.TransformerLayer with recurrent states
+
+    Returns:
+      a pair of numpy arrays - the full and incremental outputs
+    """
+    x = mtf.import_tf_tensor(
+        self.mesh, tf.random_normal([2, 4, 6]),
+        shape=[self.batch_dim, self.length_dim, self.model.model_dim])
+    length_range = mtf.range(self.mesh, self.length_dim, tf.int32)
+    context_full = self._context(
+        "first_part", position=length_range, new_states=[],
+        read_priority=length_range, write_priority=length_range)
+    with tf.variable_scope("layer"):
+      y_full = layer.call(context_full, x)
+    states = [mtf.zeros_like(t) for t in context_full.new_states]
+    ys = []
+    for i in range(self.length_dim.size):
+      position = mtf.constant(self.mesh, i, dtype=tf.int32)
+      context_incremental = self._context(
+          "incremental", position=position, states=states, new_states=[],
+          read_priority=position, write_priority=length_range)
+      with tf.variable_scope("layer", reuse=True):
+        ys.append(layer.call(
+            context_incremental, mtf.gather(x, position, self.length_dim)))
+      states = context_incremental.new_states
+    y_incremental = mtf.stack(ys, self.length_dim.name, axis=1)
+    return self._evaluate([y_full, y_incremental])
+
+  def testLatentSelfAttentionIncremental(self):
+    layer = transformer_layers.SelfAttention(
+        num_heads=2, key_value_size=4, latent_size=3)
+    y_full, y_incremental = self._incremental_matches_full(layer)
+    self.assertAllClose(y_full, y_incremental, rtol=1e-5, atol=1e-5)
+
+  @parameterized.parameters((False,), (True,))
+  def testLocalSelfAttentionFirstPartStates(self, shared_kv):
+    radius = 3
+    layer = transformer_layers.LocalSelfAttention(
+        radius=radius, num_heads=2, key_value_size=4, shared_kv=shared_kv)
+    x = mtf.import_tf_tensor(
+        self.mesh, tf.random_normal([2, 4, 6]),
+        shape=[self.batch_dim, self.length_dim, self.model.model_dim])
+    length_range = mtf.range(self.mesh, self.length_dim, tf.int32)
+    # The first sequence is shorter than the window.
+    initial_position = mtf.import_tf_tensor(
+        self.mesh, tf.constant([2, 4]), shape=[self.batch_dim])
+    context = self._context(
+        "first_part", position=length_range, new_states=[],
+        initial_position=initial_position,
+        read_priority=length_range, write_priority=length_range)
+    with tf.variable_scope("layer"):
+      layer.call(context, x)
+      params = layer.make_params(context)
+    if shared_kv:
+      kvs = [params.compute_kv(x)]
+    else:
+      kvs = [params.compute_k(x), params.compute_v(x)]
+
+    # The window states as they used to be computed: an einsum with a
+    # [length, window] selection mask.
+    window_pos = mtf.range(self.mesh, layer.window_dim, tf.int32)
+    select_recent = mtf.cast(
+        mtf.equal(mtf.mod(length_range, radius), window_pos), tf.float32)
+    select_recent *= mtf.cast(
+        mtf.less(length_range, initial_position), tf.float32)
+    select_recent *= mtf.cast(
+        mtf.greater_equal(length_range, initial_position - radius),
+        tf.float32)
+    expected_states = []
+    for t in kvs:
+      state_shape = (t.shape - [self.length_dim, layer.kv_dim]
+                     + [layer.window_dim, layer.kv_dim])
+      expected_states.append(mtf.einsum(
+          [t, select_recent], output_shape=state_shape,
+          reduced_dims=[self.length_dim]))
+    self.assertEqual([t.shape for t in context.new_states],
+                     [t.shape for t in expected_states])
+    outputs = self._evaluate(context.new_states + expected_states)
+    for actual, expected in zip(outputs[:len(kvs)], outputs[len(kvs):]):
+      self.assertAllClose(actual, expected, rtol=1e-5, atol=1e-5)
+
+  @parameterized.parameters(
+      (True, 32, 128),
+      (False, 32, 128),
+      (True, 128, 80),
+      (False, 10, 12),
+  )
+  def testRelativePositionBucket(self, bidirectional, num_buckets,
+                                 max_distance):
+    relative_dim = mtf.Dimension("relative", 600)
+    relative_position = mtf.range(self.mesh, relative_dim, tf.int32) - 300
+    bucket = transformer_layers._relative_position_bucket(
+        relative_position, bidirectional=bidirectional,
+        num_buckets=num_buckets, max_distance=max_distance)
+
+    # The original formulation, which selects between the exact and the
+    # logarithmic buckets with a where.
+    expected = 0
+    n = -relative_position
+    if bidirectional:
+      num_buckets //= 2
+      expected += mtf.to_int32(mtf.less(n, 0)) * num_buckets
+      n = mtf.abs(n)
+    else:
+      n = mtf.maximum(n, 0)
+    max_exact = num_buckets // 2
+    is_small = mtf.less(n, max_exact)
+    val_if_large = max_exact + mtf.to_int32(
+        mtf.log(mtf.to_float(n) / max_exact)
+        / math.log(max_distance / max_exact) * (num_buckets - max_exact))
+    val_if_large = mtf.minimum(val_if_large, num_buckets - 1)
+    expected += mtf.where(is_small, n, val_if_large)
+
+    actual, expected = self._evaluate([bucket, expected])
+    self.assertAllEqual(actual, expected)
+
+  def testEncDecAttentionRejectsLatentSize(self):
+    with self.assertRaises(ValueError):
+      transformer_layers.EncDecAttention(latent_size=3)
+
+
+if __name__ == "__main__":
+  tf.disable_v2_behavior()
+  tf.test.main()
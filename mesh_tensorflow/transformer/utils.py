@@ -36,7 +36,6 @@ from mesh_tensorflow.transformer import dataset as transformer_dataset
 from mesh_tensorflow.transformer import transformer
 import numpy as np
 import pkg_resources
-import six
 import tensorflow.compat.v1 as tf
 import tensorflow_datasets as tfds
 
@@ -376,7 +375,7 @@ def tpu_estimator_model_fn(model_type,
         ])
       mtf_features = {
           k: mtf.reshape(v, _feature_shape(k))
-          for k, v in six.iteritems(mtf_features)
+          for k, v in mtf_features.items()
       }
       inputs = mtf_features["inputs"]
       if predict_fn:
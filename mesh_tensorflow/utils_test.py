@@ -20,8 +20,6 @@ from __future__ import print_function
 
 import mesh_tensorflow as mtf
 
-from six.moves import xrange  # pylint: disable=redefined-builtin
-
 import tensorflow.compat.v1 as tf
 
 
@@ -39,11 +37,11 @@ class UtilsTest(tf.test.TestCase):
       hidden_dim = mtf.Dimension('hidden', 10)
       output_dim = mtf.Dimension('output_feature', 10)
 
-      for i in xrange(5):
+      for i in range(5):
         # Each variable takes 400 Bytes, and will be placed from cpu:1.
         mtf.get_variable(mesh, 'w{}'.format(i), [hidden_dim, output_dim])
 
-      for i in xrange(5):
+      for i in range(5):
         var = g.get_tensor_by_name('w{}:0'.format(i))
         device = (i + 1) % len(device_list)
         self.assertEqual('cpu:{}'.format(device), var.device)
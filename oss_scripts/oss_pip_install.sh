@@ -21,4 +21,4 @@ pip install -q -e .
 python -c "import mesh_tensorflow as mtf"
 
 # Then install the test dependencies
-pip install -q -e .[tests]
+pip install -q -e .[tests_full]
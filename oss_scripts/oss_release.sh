@@ -19,7 +19,7 @@ pip install wheel twine pyopenssl
 # Build the distribution
 echo "Building distribution"
 python setup.py sdist
-python setup.py bdist_wheel --universal
+python setup.py bdist_wheel
 
 # Publish to PyPI
 read -p "Publish? (y/n) " -r